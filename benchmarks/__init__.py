@@ -0,0 +1,4 @@
+"""Benchmarks of the mapping and conversion speed of sovabids on synthetic datasets.
+
+Run them from the root of the repository with ``python -m benchmarks`` (see benchmarks/README.rst).
+"""
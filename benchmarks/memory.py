@@ -0,0 +1,257 @@
+"""Module with the memory profile of mapping and converting recordings of increasing size.
+
+Each recording of the grid (channels x duration) is converted with
+``apply_rules_to_single_file(write=True)`` and with ``convert_them``, once per chunk size
+(streamed and loaded whole), while a :py:class:`MemoryProfiler` follows the stages of
+sovabids.timing (``read_raw``, ``write_raw_bids``, ``sidecar_json``...). For each stage it
+records the tracemalloc peak (the python and numpy allocations) and the resident set size
+of the process, so the table shows how the memory of each stage scales with the size of the
+recording. Run it from the root of the repository with ``python -m benchmarks.memory``.
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import logging
+import tempfile
+import tracemalloc
+
+from sovabids.rules import apply_rules_to_single_file,get_files,apply_rules
+from sovabids.convert import convert_them
+from sovabids.streaming import DEFAULT_CHUNK_SIZE
+from sovabids.timing import recording
+
+from benchmarks.synthetic import make_synthetic_dataset,dataset_name,SFREQ
+
+LOGGER = logging.getLogger(__name__)
+
+CHANNELS = (8,32,128)
+"""Channel counts of the recordings of the full grid."""
+
+DURATIONS = (60,300,1200)
+"""Durations in seconds of the recordings of the full grid."""
+
+QUICK_CHANNELS = (8,32)
+QUICK_DURATIONS = (30,120)
+
+CHUNK_SIZES = (DEFAULT_CHUNK_SIZE,0)
+"""Chunk sizes each recording is converted with: streamed and loaded whole."""
+
+MB = 2**20
+
+def _status_kb(field):
+    """Read a field of /proc/self/status in kB (ie VmRSS, VmHWM), None if not available (ie not on linux)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field+':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def current_rss():
+    """Get the resident set size of the process in bytes, None if unknown."""
+    kb = _status_kb('VmRSS')
+    if kb is not None:
+        return kb*1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+def peak_rss():
+    """Get the peak resident set size of the process in bytes (since the last reset_peak_rss), None if unknown."""
+    kb = _status_kb('VmHWM')
+    if kb is not None:
+        return kb*1024
+    try:
+        import resource
+    except ImportError: # windows
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss*1024
+
+def reset_peak_rss():
+    """Reset the peak resident set size to the current one, where the kernel allows it (linux)."""
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+class MemoryProfiler:
+    """Recorder of the memory of each stage of sovabids.timing.
+
+    The tracemalloc and RSS peaks are reset as each stage starts, and the peak of a stage is
+    carried over to the stages enclosing it, so nested stages (ie read_raw inside convert_file)
+    each get their own peak. Only the stages of the current process are seen, so the
+    runs are profiled with a single job.
+
+    Attributes
+    ----------
+
+    stages : list of dict
+        One per stage run, in the order they finished: ``{'stage','traced_peak','traced_growth','rss','rss_peak'}``
+        in bytes. traced_peak is the tracemalloc peak above the memory traced when the stage started,
+        traced_growth what was still allocated when it finished.
+    """
+    def __init__(self):
+        self.stages = []
+        self._stack = [] # [name, traced at the start, traced peak so far, rss peak so far]
+
+    def _carry(self):
+        # the peaks reached so far belong to every stage that is running
+        traced,rss = tracemalloc.get_traced_memory()[1],peak_rss()
+        for frame in self._stack:
+            frame[2] = max(frame[2],traced)
+            if rss is not None:
+                frame[3] = max(frame[3] or 0,rss)
+
+    def _reset(self):
+        tracemalloc.reset_peak()
+        reset_peak_rss()
+
+    def enter(self,name):
+        self._carry()
+        frame = [name,0,0,None]
+        self._stack.append(frame)
+        self._reset()
+        # the baseline is taken once the bookkeeping of the profiler is allocated, so it doesn't count
+        frame[1] = frame[2] = tracemalloc.get_traced_memory()[0]
+
+    def record(self,span):
+        self._exit(span.name)
+
+    def _exit(self,name):
+        if not self._stack or self._stack[-1][0] != name:
+            return # started before the profiler
+        self._carry()
+        name,start,traced_peak,rss_peak = self._stack.pop()
+        self.stages.append({'stage':name,'traced_peak':traced_peak-start,
+                            'traced_growth':tracemalloc.get_traced_memory()[0]-start,
+                            'rss':current_rss(),'rss_peak':rss_peak})
+        self._reset()
+
+    def profile(self,func,*args,**kwargs):
+        """Call a function recording the memory of its stages and of the whole call (as the 'total' stage).
+
+        Returns
+        -------
+
+        object :
+            The result of the call.
+        """
+        started = tracemalloc.is_tracing()
+        if not started:
+            tracemalloc.start()
+        try:
+            with recording(self):
+                self.enter('total')
+                try:
+                    return func(*args,**kwargs)
+                finally:
+                    self._exit('total')
+        finally:
+            if not started:
+                tracemalloc.stop()
+
+def _row(run,params,chunk_size,stage):
+    n_samples = params['duration']*SFREQ
+    data = n_samples*params['channels']*8 # float64, as MNE holds it
+    return {'run':run,'format':params['format'],'channels':params['channels'],'duration':params['duration'],
+            'samples':n_samples,'data_mb':data/MB,'chunk_size':chunk_size,'stage':stage['stage'],
+            'traced_peak_mb':stage['traced_peak']/MB,'traced_growth_mb':stage['traced_growth']/MB,
+            'rss_mb':stage['rss']/MB if stage['rss'] is not None else None,
+            'rss_peak_mb':stage['rss_peak']/MB if stage['rss_peak'] is not None else None,
+            'peak_over_data':stage['traced_peak']/data}
+
+def profile_recording(workdir,params,chunk_sizes=CHUNK_SIZES):
+    """Profile the conversion of a synthetic recording with apply_rules_to_single_file and convert_them.
+
+    Parameters
+    ----------
+
+    workdir : str
+        The folder the recording and the bids directories are written to.
+    params : dict
+        The parameters of benchmarks.synthetic.make_synthetic_dataset, files is always 1.
+    chunk_sizes : tuple of int
+        The chunk sizes to convert the recording with, 0 loading it whole.
+
+    Returns
+    -------
+
+    list of dict :
+        One row per run and stage, see memory_table.
+    """
+    params = dict(params,files=1)
+    source,rules = make_synthetic_dataset(os.path.join(workdir,'datasets'),**params)
+    file = get_files(source,rules)[0]
+    bids = os.path.join(workdir,'bids',dataset_name(**params))
+    rows = []
+    for chunk_size in chunk_sizes:
+        shutil.rmtree(bids,ignore_errors=True)
+        profiler = MemoryProfiler()
+        profiler.profile(apply_rules_to_single_file,file,rules,bids,write=True,persist=False,chunk_size=chunk_size)
+        rows += [_row('apply_rules_to_single_file',params,chunk_size,stage) for stage in profiler.stages]
+
+        shutil.rmtree(bids,ignore_errors=True)
+        mappings = apply_rules([file],bids,rules,persist=False)
+        profiler = MemoryProfiler()
+        profiler.profile(convert_them,mappings,chunk_size=chunk_size)
+        rows += [_row('convert_them',params,chunk_size,stage) for stage in profiler.stages]
+    shutil.rmtree(bids,ignore_errors=True)
+    return rows
+
+def memory_table(rows):
+    """Format the rows of profile_recording as a text table, one line per run and stage.
+
+    The columns are the size of the recording (channels, duration, its float64 size in MB),
+    the chunk size, and for each stage the tracemalloc peak, the RSS at its end and the peak RSS
+    in MB, plus the tracemalloc peak relative to the size of the recording (peak/data).
+    """
+    header = f"{'run':<27} {'ch':>4} {'dur':>5} {'data':>8} {'chunk':>6} {'stage':<20} {'peak':>8} {'rss':>8} {'rss_peak':>8} {'peak/data':>9}"
+    lines = [header]
+    def mb(x):
+        return f'{x:8.1f}' if x is not None else f"{'-':>8}"
+    for row in rows:
+        lines.append(f"{row['run']:<27} {row['channels']:>4} {row['duration']:>5} {mb(row['data_mb'])} {row['chunk_size']:>6} "
+                     f"{row['stage']:<20} {mb(row['traced_peak_mb'])} {mb(row['rss_mb'])} {mb(row['rss_peak_mb'])} {row['peak_over_data']:9.2f}")
+    return '\n'.join(lines)
+
+def main(argv=None):
+    """Console usage of the memory profile, ie ``python -m benchmarks.memory --quick``."""
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.memory',description='Profile the memory of mapping and converting recordings of increasing size.')
+    parser.add_argument('-o','--output', help='The json file the rows of the table are written to.',default=None)
+    parser.add_argument('--quick', action='store_true', help='Only profile small recordings.')
+    parser.add_argument('--channels', type=int, nargs='+', help='The channel counts of the recordings.',default=None)
+    parser.add_argument('--durations', type=int, nargs='+', help='The durations in seconds of the recordings.',default=None)
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', help='The chunk sizes to convert with, 0 loads the recordings whole.',default=list(CHUNK_SIZES))
+    parser.add_argument('--format', choices=['vhdr','fif','edf','set'], help='The format of the recordings.',default='vhdr')
+    parser.add_argument('--workdir', help='Folder where the recordings are generated and kept between runs. A temporary one by default.',default=None)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('sovabids').setLevel(logging.WARN)
+    channels = args.channels or (QUICK_CHANNELS if args.quick else CHANNELS)
+    durations = args.durations or (QUICK_DURATIONS if args.quick else DURATIONS)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='sovabids_memory_')
+    rows = []
+    try:
+        for n in channels:
+            for duration in durations:
+                rows += profile_recording(workdir,{'channels':n,'duration':duration,'format':args.format},tuple(args.chunk_sizes))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir,ignore_errors=True)
+    print(memory_table(rows))
+    if args.output:
+        with open(args.output,'w',encoding='utf-8') as f:
+            json.dump(rows,f,indent=2)
+        print(f'Rows written to {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+"""Module with the microbenchmarks of the path parsers, run once (or more) per file of a dataset.
+
+Each case calls one of ``parsers.placeholder_to_regex``, ``parse_from_placeholder``,
+``parse_from_regex``, ``parse_entities_from_bidspath``, ``parse_path_pattern_from_entities``
+or ``dicts.deep_merge_N`` over synthetic paths (10^4 to 10^6 of them), generated and timed in
+batches so that the memory stays constant. The cost per path of each count should be flat: a case whose cost per
+path at the largest count is more than ``tolerance`` above the one at the smallest count does not scale.
+
+The probes time single calls over pathological inputs of growing size instead: patterns with
+many greedy ``(.+)`` groups over paths they don't match (which backtrack polynomially with the
+length of the path), deeply nested fields and dictionaries, and long lists for deep_merge_N.
+Each probe runs in its own process (see sovabids.parallel.run_isolated) so the ones that backtrack
+for too long are killed at the timeout. Run it from the root of the repository with ``python -m benchmarks.paths``.
+"""
+import sys
+import json
+import time
+import math
+import argparse
+
+from sovabids.parsers import (placeholder_to_regex,parse_from_placeholder,parse_from_regex,
+                              parse_entities_from_bidspath,parse_path_pattern_from_entities)
+from sovabids.dicts import deep_merge_N
+from sovabids.parallel import run_isolated
+
+COUNTS = (10**4,10**5,10**6)
+"""Number of paths of the scaling runs of the full suite."""
+
+QUICK_COUNTS = (10**4,10**5)
+"""Number of paths of the scaling runs of the quick suite."""
+
+BATCH = 10**4
+"""Number of inputs generated (untimed) at a time, the calls over each batch are timed together."""
+
+DEFAULT_TOLERANCE = 0.5
+"""Default relative growth of the cost per path between the smallest and largest count reported as not flat."""
+
+PATTERN = 'T%entities.task%/S%entities.session%/sub%entities.subject%_%entities.acquisition%_%entities.run%.vhdr'
+"""Placeholder pattern of the synthetic source paths, as in the rules of benchmarks.synthetic."""
+
+TASKS = ('resting','oddball','gonogo','nback','sleep')
+SESSIONS = ('V0','V1','V2')
+ACQUISITIONS = ('A','B')
+
+def synthetic_entities(i):
+    """Get the entities of the i-th synthetic path, ie {'sub':'0000012','ses':'V0','task':'nback','acq':'A','run':'3'}."""
+    return {'sub':f'{i:07d}','ses':SESSIONS[i%len(SESSIONS)],'task':TASKS[i%len(TASKS)],
+            'acq':ACQUISITIONS[i%len(ACQUISITIONS)],'run':str(i%4+1)}
+
+def source_path(i):
+    """Get the i-th synthetic source path, matching PATTERN, ie '/data/study/Tnback/SV0/sub0000012_A_3.vhdr'."""
+    e = synthetic_entities(i)
+    return f"/data/study/T{e['task']}/S{e['ses']}/sub{e['sub']}_{e['acq']}_{e['run']}.vhdr"
+
+def bids_path(i):
+    """Get the bids path the i-th synthetic source path is converted to."""
+    e = synthetic_entities(i)
+    stem = f"sub-{e['sub']}_ses-{e['ses']}_task-{e['task']}_acq-{e['acq']}_run-{e['run']}"
+    return f"/bids/sub-{e['sub']}/ses-{e['ses']}/eeg/{stem}_eeg.vhdr"
+
+GENERAL = {'dataset_description':{'Name':'paths','Authors':['sovabids benchmarks']},
+           'sidecar':{'PowerLineFrequency':50,'EEGReference':'FCz'},
+           'non-bids':{'eeg_extension':'.vhdr','path_analysis':{'pattern':PATTERN}}}
+
+def _regex():
+    pattern,fields = placeholder_to_regex(PATTERN)
+    return lambda i:(source_path(i),pattern,fields)
+
+def _rules_of(i):
+    # the general rules, the rules parsed from the path and the individual ones, as apply_rules_to_single_file merges them
+    e = synthetic_entities(i)
+    return ([GENERAL,{'entities':{'subject':e['sub'],'session':e['ses'],'task':e['task']}},
+             {'entities':{'acquisition':e['acq'],'run':e['run']},'sidecar':{'EEGReference':'Cz'}}],)
+
+CASES = {
+    'placeholder_to_regex':(lambda:lambda i:(f'/data/study{i%100}/'+PATTERN,),placeholder_to_regex),
+    'parse_from_placeholder':(lambda:lambda i:(source_path(i),PATTERN),parse_from_placeholder),
+    'parse_from_regex':(_regex,parse_from_regex),
+    'parse_entities_from_bidspath':(lambda:lambda i:(bids_path(i),),parse_entities_from_bidspath),
+    'parse_path_pattern_from_entities':(lambda:lambda i:(source_path(i),synthetic_entities(i)),parse_path_pattern_from_entities),
+    'deep_merge_N':(lambda:_rules_of,deep_merge_N),
+}
+"""Case name -> (factory of the function giving the arguments of the i-th call, the function benchmarked)."""
+
+def time_per_path(name,count,repeats=3,batch=BATCH):
+    """Time a case over a number of synthetic paths.
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the case, one of CASES.
+    count : int
+        The number of paths, ie calls.
+    repeats : int
+        The number of times the paths are run, the fastest one is kept.
+    batch : int
+        The number of inputs generated at a time, outside of the timed section.
+
+    Returns
+    -------
+
+    float :
+        The seconds per path of the fastest repetition.
+    """
+    factory,func = CASES[name]
+    make_args = factory()
+    best = math.inf
+    for _ in range(repeats):
+        total = 0
+        for start in range(0,count,batch):
+            calls = [make_args(i) for i in range(start,min(start+batch,count))]
+            tic = time.perf_counter()
+            for args in calls:
+                func(*args)
+            total += time.perf_counter()-tic
+        best = min(best,total)
+    return best/count
+
+def scaling(counts=COUNTS,cases=tuple(CASES),repeats=3,tolerance=DEFAULT_TOLERANCE):
+    """Time each case over increasing counts of paths and check that the cost per path stays flat.
+
+    Parameters
+    ----------
+
+    counts : tuple of int
+        The numbers of paths, increasing.
+    cases : tuple of str
+        The cases to run, some of CASES.
+    repeats : int
+        See time_per_path.
+    tolerance : float
+        The relative growth of the cost per path between the smallest and the largest count
+        reported as not flat (ie 0.5 for 50% slower per path).
+
+    Returns
+    -------
+
+    list of dict :
+        One row per case: ``{'case','counts','us_per_path','ratio','flat'}``, with the microseconds
+        per path of each count and the ratio of the cost per path of the largest count over the smallest.
+    """
+    rows = []
+    for name in cases:
+        costs = [time_per_path(name,count,repeats)*1e6 for count in counts]
+        ratio = costs[-1]/costs[0] if costs[0] else 1.0
+        rows.append({'case':name,'counts':list(counts),'us_per_path':costs,'ratio':ratio,'flat':ratio <= 1+tolerance})
+    return rows
+
+def backtracking_input(groups,length):
+    """Get a pattern of greedy groups and a path of about length characters it doesn't match.
+
+    The pattern is ``%f0%_%f1%_..._%fk%.vhdr`` and the path is made of one character segments separated
+    by underscores, without the extension, so the regex engine tries every way of splitting the path
+    among the groups, from every starting position, before failing.
+    """
+    placeholder = '_'.join(f'%f{k}%' for k in range(groups))+'.vhdr'
+    path = '_'.join('x'*(length//2+1))[:length]
+    return path,placeholder
+
+def _backtracking(groups,length):
+    path,placeholder = backtracking_input(groups,length)
+    def call():
+        try:
+            parse_from_placeholder(path,placeholder)
+        except AttributeError: # no match
+            pass
+    return call
+
+def _nested_field(depth,_):
+    field = '.'.join(f'l{k}' for k in range(depth))
+    pattern,fields = placeholder_to_regex(f'/data/%{field}%.vhdr')
+    return lambda:parse_from_regex('/data/value.vhdr',pattern,fields)
+
+def _nested_tree(depth,value):
+    tree = value
+    for k in reversed(range(depth)):
+        tree = {f'l{k}':tree,f'k{k}':k}
+    return tree
+
+def _nested_merge(depth,_):
+    trees = [_nested_tree(depth,'general'),_nested_tree(depth,'path'),_nested_tree(depth,'individual')]
+    return lambda:deep_merge_N(list(trees))
+
+def _merge_length(length,_):
+    trees = [{f'k{k}':{'value':k}} for k in range(length)]
+    return lambda:deep_merge_N(list(trees))
+
+PROBES = {
+    'greedy_groups_2':(lambda length,_:_backtracking(2,length),(64,128,256,512)),
+    'greedy_groups_4':(lambda length,_:_backtracking(4,length),(64,128,256,512)),
+    'greedy_groups_6':(lambda length,_:_backtracking(6,length),(32,64,128,256)),
+    'nested_field':(_nested_field,(8,64,256,512)),
+    'deep_merge_N_depth':(_nested_merge,(8,32,128,256)),
+    'deep_merge_N_length':(_merge_length,(10,100,1000,4000)),
+}
+"""Probe name -> (factory of the call of a given size, the sizes). The size is the length of the path
+for the greedy groups, the depth of the nesting or the number of dictionaries merged."""
+
+def run_probe(name,size,repeats=3):
+    """Get the seconds of the fastest of some calls of a probe of a given size. Top-level to run in run_isolated."""
+    factory,_ = PROBES[name]
+    call = factory(size,None)
+    best = math.inf
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        call()
+        best = min(best,time.perf_counter()-tic)
+    return best
+
+def probes(names=tuple(PROBES),timeout=10,repeats=3):
+    """Time the pathological probes over their sizes, each in its own process.
+
+    Parameters
+    ----------
+
+    names : tuple of str
+        The probes to run, some of PROBES.
+    timeout : float
+        The seconds a probe of a size may run before its process is killed. The larger sizes
+        of a probe that timed out are skipped.
+    repeats : int
+        See run_probe.
+
+    Returns
+    -------
+
+    list of dict :
+        One row per probe and size: ``{'probe','size','seconds','exponent'}``. seconds is None if the
+        probe timed out, exponent is the growth of the time with the size since the previous size,
+        ie 1 for linear and 2 for quadratic (None for the first size or after a timeout).
+    """
+    rows = []
+    for name in names:
+        previous = None
+        for size in PROBES[name][1]:
+            (_,seconds,error), = run_isolated(run_probe,[(name,size,repeats)],1,timeout=timeout)
+            if error is not None and seconds is None and 'timed out' not in error:
+                raise RuntimeError(f'The probe {name} of size {size} failed: {error}')
+            exponent = None
+            if seconds is not None and previous is not None and previous[1] > 0 and seconds > 0:
+                exponent = math.log(seconds/previous[1])/math.log(size/previous[0])
+            rows.append({'probe':name,'size':size,'seconds':seconds,'exponent':exponent})
+            if seconds is None:
+                break # larger sizes only take longer
+            previous = (size,seconds)
+    return rows
+
+def scaling_table(rows):
+    """Format the rows of scaling as a text table."""
+    counts = rows[0]['counts'] if rows else []
+    lines = [f"{'case':<34}"+''.join(f'{f"us@{n:.0e}":>12}' for n in counts)+f"{'ratio':>8}  flat"]
+    for row in rows:
+        lines.append(f"{row['case']:<34}"+''.join(f'{us:12.2f}' for us in row['us_per_path'])+f"{row['ratio']:8.2f}  {'yes' if row['flat'] else 'NO'}")
+    return '\n'.join(lines)
+
+def probes_table(rows):
+    """Format the rows of probes as a text table."""
+    lines = [f"{'probe':<22} {'size':>6} {'seconds':>10} {'exponent':>8}"]
+    for row in rows:
+        seconds = f"{row['seconds']:10.6f}" if row['seconds'] is not None else f"{'timeout':>10}"
+        exponent = f"{row['exponent']:8.2f}" if row['exponent'] is not None else f"{'-':>8}"
+        lines.append(f"{row['probe']:<22} {row['size']:>6} {seconds} {exponent}")
+    return '\n'.join(lines)
+
+def main(argv=None):
+    """Console usage of the path microbenchmarks, ie ``python -m benchmarks.paths --quick``."""
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.paths',description='Microbenchmark the path parsers over growing numbers of synthetic paths.')
+    parser.add_argument('-o','--output', help='The json file the rows of the tables are written to.',default=None)
+    parser.add_argument('--quick', action='store_true', help=f'Only run {" and ".join(str(n) for n in QUICK_COUNTS)} paths.')
+    parser.add_argument('--counts', type=int, nargs='+', help='The numbers of paths.',default=None)
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), help='The cases to run.',default=list(CASES))
+    parser.add_argument('--probes', nargs='*', choices=list(PROBES), help='The pathological probes to run, none with an empty list.',default=list(PROBES))
+    parser.add_argument('--tolerance', type=float, help='The relative growth of the cost per path reported as not flat.',default=DEFAULT_TOLERANCE)
+    parser.add_argument('--timeout', type=float, help='The seconds a probe may run before it is killed.',default=10)
+    parser.add_argument('-r','--repeats', type=int, help='Number of times each case and probe is repeated, the fastest is kept.',default=3)
+    args = parser.parse_args(argv)
+
+    counts = tuple(sorted(args.counts or (QUICK_COUNTS if args.quick else COUNTS)))
+    scaling_rows = scaling(counts,tuple(args.cases),args.repeats,args.tolerance)
+    print(scaling_table(scaling_rows))
+    probe_rows = probes(tuple(args.probes),args.timeout,args.repeats) if args.probes else []
+    if probe_rows:
+        print()
+        print(probes_table(probe_rows))
+    if args.output:
+        with open(args.output,'w',encoding='utf-8') as f:
+            json.dump({'scaling':scaling_rows,'probes':probe_rows},f,indent=2)
+        print(f'Rows written to {args.output}')
+    steep = [row['case'] for row in scaling_rows if not row['flat']]
+    if steep:
+        print(f'The cost per path of {len(steep)} case(s) grew more than {args.tolerance:.0%}: {", ".join(steep)}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""Module with the benchmarks of sovabids and the comparison of their results against a baseline.
+
+Each benchmark times one entry point (``get_files``, ``apply_rules``, ``convert_them`` and
+the RPC methods) over a synthetic dataset (see benchmarks.synthetic), repeating it and keeping
+the time of each repetition. The results are stored as json::
+
+    {
+        'meta': {'sovabids','python','platform','machine','cpus','date'},
+        'results': {name: {'benchmark','dataset','params','times','min','median','mean'}}
+    }
+
+and compared against a saved baseline by their medians: a benchmark more than
+``threshold`` slower than in the baseline is a regression.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import statistics
+import tempfile
+from datetime import datetime
+
+from sovabids import __version__
+from sovabids.rules import get_files,apply_rules
+from sovabids.convert import convert_them
+
+from benchmarks.synthetic import make_synthetic_dataset,dataset_name
+
+LOGGER = logging.getLogger(__name__)
+
+DATASETS = [
+    {'files':4,'channels':8,'duration':10,'format':'vhdr'},
+    {'files':16,'channels':8,'duration':10,'format':'vhdr'},
+    {'files':4,'channels':64,'duration':60,'format':'vhdr'},
+    {'files':4,'channels':32,'duration':30,'format':'fif'},
+    {'files':4,'channels':32,'duration':30,'format':'edf'},
+]
+"""Parameters of the synthetic datasets of the full suite."""
+
+QUICK_DATASETS = DATASETS[:1]
+"""Parameters of the synthetic datasets of the quick suite."""
+
+BENCHMARKS = ('get_files','apply_rules','convert_them','rpc')
+"""The benchmarks of the suite, rpc needs the gui extra (fastapi-jsonrpc)."""
+
+DEFAULT_THRESHOLD = 0.25
+"""Default relative slowdown of the median over the baseline reported as a regression."""
+
+MIN_DELTA = 0.005
+"""Slowdowns smaller than this number of seconds are never reported, they are within the noise."""
+
+def _timed(func,repeats,setup=None):
+    """Call func repeats times, returning the seconds of each call. setup is called before each one, untimed."""
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter()-start)
+    return times
+
+def _fresh(path):
+    """Get a function emptying a folder, so that every repetition writes a new bids directory."""
+    def setup():
+        shutil.rmtree(path,ignore_errors=True)
+        os.makedirs(path)
+    return setup
+
+def _rpc_client():
+    from fastapi.testclient import TestClient
+    from sovabids.sovarpc import app
+    client = TestClient(app)
+    def call(method,**params):
+        request = json.dumps({'jsonrpc':'2.0','id':0,'method':method,'params':params})
+        response = client.post(f'/api/sovabids/{method}',content=request).json()
+        if 'error' in response:
+            raise RuntimeError(f"The rpc method {method} failed: {response['error']}")
+        return response['result']
+    return call
+
+def bench_dataset(workdir,params,repeats=3,jobs=1,benchmarks=BENCHMARKS):
+    """Run the benchmarks over a synthetic dataset.
+
+    Parameters
+    ----------
+
+    workdir : str
+        The folder the datasets and bids directories are written to.
+    params : dict
+        The parameters of make_synthetic_dataset (files, channels, duration and format).
+    repeats : int
+        The number of times each benchmark is repeated.
+    jobs : int
+        The jobs of apply_rules and convert_them.
+    benchmarks : tuple of str
+        The benchmarks to run, some of BENCHMARKS.
+
+    Returns
+    -------
+
+    dict :
+        Benchmark name -> its times, ie {'convert_them[vhdr-4f-8ch-10s]': {'benchmark','dataset','params','times'}}.
+    """
+    dataset = dataset_name(**params)
+    source,rules = make_synthetic_dataset(os.path.join(workdir,'datasets'),**params)
+    bids = os.path.join(workdir,'bids',dataset)
+    os.makedirs(bids,exist_ok=True)
+    files = get_files(source,rules)
+    mappings = apply_rules(files,bids,rules,persist=False)
+
+    cases = {}
+    if 'get_files' in benchmarks:
+        cases['get_files'] = (lambda:get_files(source,rules),None)
+    if 'apply_rules' in benchmarks:
+        cases['apply_rules'] = (lambda:apply_rules(files,bids,rules,persist=False,jobs=jobs),None)
+    if 'convert_them' in benchmarks:
+        cases['convert_them'] = (lambda:convert_them(mappings,jobs=jobs),_fresh(bids))
+    if 'rpc' in benchmarks:
+        try:
+            call = _rpc_client()
+        except ImportError:
+            LOGGER.warning('Skipping the rpc benchmarks, fastapi-jsonrpc is not installed (see the gui extra).')
+        else:
+            rpc_rules = dict(rules,IO={'source':source,'target':bids})
+            cases['rpc.get_files'] = (lambda:call('get_files',path=source,rules=rpc_rules),None)
+            cases['rpc.apply_rules_to_single_file'] = (lambda:call('apply_rules_to_single_file',file=files[0],rules=rpc_rules,bids_path=bids),None)
+            cases['rpc.apply_rules'] = (lambda:call('apply_rules',file_list=files,bids_path=bids,rules=rpc_rules,mapping_path=''),None)
+            cases['rpc.convert_them'] = (lambda:call('convert_them',general=mappings['General'],individual=mappings['Individual']),_fresh(bids))
+
+    results = {}
+    for benchmark,(func,setup) in cases.items():
+        LOGGER.info(f'{benchmark} over {dataset}')
+        results[f'{benchmark}[{dataset}]'] = {'benchmark':benchmark,'dataset':dataset,'params':dict(params,jobs=jobs),
+                                              'times':_timed(func,repeats,setup)}
+    return results
+
+def run_suite(datasets=DATASETS,workdir=None,repeats=3,jobs=1,benchmarks=BENCHMARKS):
+    """Run the benchmarks over each synthetic dataset.
+
+    Parameters
+    ----------
+
+    datasets : list of dict
+        The parameters of each dataset (see DATASETS).
+    workdir : str | None
+        The folder the datasets are generated in and kept between runs. None uses a temporary folder.
+    repeats, jobs, benchmarks :
+        See bench_dataset.
+
+    Returns
+    -------
+
+    dict :
+        The results, as described in this module.
+    """
+    temporary = workdir is None
+    if temporary:
+        workdir = tempfile.mkdtemp(prefix='sovabids_benchmarks_')
+    results = {}
+    try:
+        for params in datasets:
+            try:
+                results.update(bench_dataset(workdir,params,repeats,jobs,benchmarks))
+            except ImportError as exc: # ie edfio for the edf datasets
+                LOGGER.warning(f'Skipping the {dataset_name(**params)} dataset: {exc}')
+    finally:
+        if temporary:
+            shutil.rmtree(workdir,ignore_errors=True)
+        else: # the bids directories are not reused, only the datasets
+            shutil.rmtree(os.path.join(workdir,'bids'),ignore_errors=True)
+    for result in results.values():
+        times = result['times']
+        result.update({'min':min(times),'median':statistics.median(times),'mean':statistics.mean(times)})
+    meta = {'sovabids':__version__,'python':platform.python_version(),'platform':platform.platform(),
+            'machine':platform.machine(),'cpus':os.cpu_count(),'date':datetime.now().isoformat(timespec='seconds')}
+    return {'meta':meta,'results':results}
+
+def compare(results,baseline,threshold=DEFAULT_THRESHOLD,min_delta=MIN_DELTA):
+    """Compare the medians of some results against a baseline.
+
+    Parameters
+    ----------
+
+    results : dict
+        The results of run_suite.
+    baseline : dict
+        The results of a previous run_suite.
+    threshold : float
+        The relative slowdown over the baseline reported as a regression (ie 0.25 for 25% slower),
+        and the relative speedup reported as an improvement.
+    min_delta : float
+        Differences smaller than this number of seconds are not reported.
+
+    Returns
+    -------
+
+    list of dict :
+        One row per benchmark: ``{'name','baseline','current','ratio','status'}``, where the status
+        is 'regression', 'improvement', 'ok', 'new' (not in the baseline) or 'missing' (only in the baseline).
+    """
+    rows = []
+    old,new = baseline['results'],results['results']
+    for name in sorted(set(old)|set(new)):
+        if name not in old or name not in new:
+            rows.append({'name':name,'baseline':old.get(name,{}).get('median',None),'current':new.get(name,{}).get('median',None),
+                         'ratio':None,'status':'new' if name in new else 'missing'})
+            continue
+        before,after = old[name]['median'],new[name]['median']
+        ratio = after/before if before else None
+        status = 'ok'
+        if ratio is not None and abs(after-before) >= min_delta:
+            if ratio > 1+threshold:
+                status = 'regression'
+            elif ratio < 1/(1+threshold):
+                status = 'improvement'
+        rows.append({'name':name,'baseline':before,'current':after,'ratio':ratio,'status':status})
+    return rows
+
+def format_comparison(rows):
+    """Format the rows of compare as a text table."""
+    width = max([len(row['name']) for row in rows]+[9])
+    lines = [f"{'benchmark':<{width}}  {'baseline':>10}  {'current':>10}  {'ratio':>7}  status"]
+    def seconds(x):
+        return f'{x:10.4f}' if x is not None else f"{'-':>10}"
+    for row in rows:
+        ratio = f"{row['ratio']:7.2f}" if row['ratio'] is not None else f"{'-':>7}"
+        lines.append(f"{row['name']:<{width}}  {seconds(row['baseline'])}  {seconds(row['current'])}  {ratio}  {row['status']}")
+    return '\n'.join(lines)
+
+def save_results(results,path):
+    """Write results to a json file."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+    with open(path,'w',encoding='utf-8') as f:
+        json.dump(results,f,indent=2)
+
+def load_results(path):
+    """Read results from a json file."""
+    with open(path,encoding='utf-8') as f:
+        return json.load(f)
+
+def main(argv=None):
+    """Console usage of the benchmarks, ie ``python -m benchmarks --baseline baseline.json``."""
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',description='Benchmark sovabids on synthetic datasets.')
+    parser.add_argument('-o','--output', help='The json file the results are written to.',default='benchmarks/results.json')
+    parser.add_argument('--baseline', help='A json file with previous results to compare against. The run fails if some benchmark regressed.',default=None)
+    parser.add_argument('--threshold', type=float, help='The relative slowdown of a median over the baseline reported as a regression.',default=DEFAULT_THRESHOLD)
+    parser.add_argument('--compare-only', action='store_true', help='Only compare the --output results against the --baseline, without running anything.')
+    parser.add_argument('--quick', action='store_true', help='Only benchmark the smallest dataset.')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, help='The benchmarks to run.',default=list(BENCHMARKS))
+    parser.add_argument('-r','--repeats', type=int, help='Number of times each benchmark is repeated.',default=3)
+    parser.add_argument('-j','--jobs', type=int, help='The jobs of apply_rules and convert_them.',default=1)
+    parser.add_argument('--workdir', help='Folder where the synthetic datasets are generated and kept between runs. A temporary one by default.',default=None)
+    parser.add_argument('-v','--verbose', action='store_true', help='Make the output more verbose.')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('sovabids').setLevel(logging.WARN)
+    LOGGER.setLevel(logging.INFO if args.verbose else logging.WARN)
+
+    if args.compare_only:
+        results = load_results(args.output)
+    else:
+        results = run_suite(QUICK_DATASETS if args.quick else DATASETS,args.workdir,args.repeats,args.jobs,tuple(args.benchmarks))
+        save_results(results,args.output)
+        print(f'Results written to {args.output}')
+    if args.baseline is None:
+        for name,result in results['results'].items():
+            print(f"{name}: median {result['median']:.4f}s (min {result['min']:.4f}s)")
+        return
+    rows = compare(results,load_results(args.baseline),args.threshold)
+    print(format_comparison(rows))
+    regressions = [row['name'] for row in rows if row['status'] == 'regression']
+    if regressions:
+        print(f'{len(regressions)} benchmark(s) regressed more than {args.threshold:.0%}: {", ".join(regressions)}')
+        sys.exit(1)
@@ -0,0 +1,98 @@
+"""Module generating the synthetic datasets of the benchmarks with sovabids.datasets."""
+import os
+
+from sovabids.datasets import make_dummy_dataset,save_dummy_vhdr,get_dummy_raw
+from sovabids.parsers import _modify_entities_of_placeholder_pattern
+
+PATTERN = 'T%task%/S%session%/sub%subject%_%acquisition%_%run%'
+"""Placeholder pattern of the files of the synthetic datasets, in the notation of make_dummy_dataset."""
+
+FORMATS = ('vhdr','fif','edf','set')
+"""Formats the synthetic recordings can be written in. edf and set need the formats extra (edfio, eeglabio)."""
+
+SFREQ = 250
+"""Sampling frequency of the synthetic recordings."""
+
+def dataset_name(files,channels,duration,format):
+    """Get the name identifying a synthetic dataset, ie 'vhdr-16f-64ch-60s'."""
+    return f'{format}-{files}f-{channels}ch-{duration}s'
+
+def save_example(fpath,channels,duration,format):
+    """Write the recording every file of a synthetic dataset is a copy of.
+
+    Parameters
+    ----------
+
+    fpath : str
+        The path of the recording, without extension.
+    channels : int
+        The number of channels.
+    duration : int
+        The duration in seconds.
+    format : str
+        One of FORMATS.
+
+    Returns
+    -------
+
+    str | list of str :
+        The files of the recording, as expected by the EXAMPLE of make_dummy_dataset.
+    """
+    dummy_args = {'NCHANNELS':channels,'SFREQ':SFREQ,'STOP':duration,'NUMEVENTS':max(1,min(10,duration))}
+    if format == 'vhdr':
+        return save_dummy_vhdr(fpath+'.vhdr',dummy_args)
+    if format not in FORMATS:
+        raise ValueError(f'Expected format to be one of {FORMATS}, got {format} instead')
+    from datetime import datetime,timezone
+    import mne
+    raw,_ = get_dummy_raw(**dummy_args)
+    raw.set_meas_date(datetime(2000,1,1,tzinfo=timezone.utc)) # EDF needs a date in [1985, 2084]
+    raw.apply_function(lambda x:x*1e-5) # the noise is unit variance, make it look like microvolts
+    if format == 'fif':
+        raw.save(fpath+'.fif',overwrite=True,verbose=False)
+    else:
+        mne.export.export_raw(fpath+'.'+format,raw,overwrite=True,verbose=False)
+    return fpath+'.'+format
+
+def make_synthetic_dataset(root,files=4,channels=8,duration=10,format='vhdr'):
+    """Generate a synthetic dataset and the rules to map it, unless it was already generated in root.
+
+    Parameters
+    ----------
+
+    root : str
+        The folder the dataset is generated in, under a subfolder named after its parameters.
+    files : int
+        The number of recordings (one per subject).
+    channels : int
+        The number of channels of each recording.
+    duration : int
+        The duration of each recording in seconds.
+    format : str
+        The format of the recordings, one of FORMATS.
+
+    Returns
+    -------
+
+    tuple :
+        (source path, rules dictionary).
+    """
+    name = dataset_name(files,channels,duration,format)
+    folder = os.path.join(root,name)
+    source = os.path.join(folder,'source')
+    done = os.path.join(folder,'.done')
+    if not os.path.isfile(done):
+        os.makedirs(folder,exist_ok=True)
+        example = save_example(os.path.join(folder,'example'),channels,duration,format)
+        make_dummy_dataset(EXAMPLE=example,PATTERN=PATTERN,DATASET=name,NSUBS=files,NSESSIONS=1,NTASKS=1,NACQS=1,NRUNS=1,ROOT=source)
+        open(done,'w').close()
+    rules = {
+        'dataset_description':{'Name':name,'Authors':['sovabids benchmarks']},
+        'sidecar':{'PowerLineFrequency':50,'EEGReference':'FCz'},
+        'channels':{},
+        'non-bids':{
+            'eeg_extension':'.'+format,
+            'path_analysis':{'pattern':_modify_entities_of_placeholder_pattern(PATTERN,'append')+'.'+format},
+        },
+    }
+    return source,rules
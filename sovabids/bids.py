@@ -31,4 +31,348 @@ def update_dataset_description(dataset_description,bids_path,do_not_create=False
         info.update(dataset_description)
         if not do_not_create and os.path.isfile(jsonfile):
             _write_json(jsonfile,info,overwrite=True)
-    # Problem: Authors with strange characters are written incorrectly.
\ No newline at end of file
+    # Problem: Authors with strange characters are written incorrectly.
+
+
+_COUNT_FIELDS = ("EEGChannelCount", "EOGChannelCount", "ECGChannelCount", "EMGChannelCount", "MiscChannelCount", "TriggerChannelCount")
+"""Channel counts written by mne-bids to the sidecar json, removed since they may have wrong values."""
+
+def update_sidecar_json(sidecar_path,sidecar,**fields):
+    """Update the sidecar json of a recording with the sidecar rules.
+
+    Parameters
+    ----------
+
+    sidecar_path : str | pathlib.Path
+        The path of the sidecar json (ie the *_eeg.json file).
+    sidecar : dict
+        The ``sidecar`` rules, overwriting the fields of the file.
+    **fields :
+        Other fields to overwrite (ie the RecordingDuration).
+
+    Returns
+    -------
+
+    dict :
+        The updated sidecar.
+    """
+    with open(sidecar_path) as f:
+        sidecarjson = json.load(f)
+    #TODO Validate the sidecar rules so as not to include dangerous stuff??
+    sidecarjson.update(sidecar)
+    sidecarjson.update(fields)
+    # maybe include an overwrite rule
+
+    # remove count fields (may have wrong values)
+    for count in _COUNT_FIELDS:
+        if count in sidecarjson:
+            del sidecarjson[count]
+    _write_json(sidecar_path,sidecarjson,overwrite=True)
+    return sidecarjson
+
+def update_channels_tsv(channels_path,channels):
+    """Update the channels tsv of a recording with the channels rules.
+
+    Only the types are written here, since they are not saved in every data format (ie BrainVision).
+    Note that this will add the types even if they are not supported by mne.
+    Nevertheless, if a type was supported by mne, it was written to it previously.
+
+    Parameters
+    ----------
+
+    channels_path : str | pathlib.Path
+        The path of the channels tsv (ie the *_channels.tsv file).
+    channels : dict
+        The ``channels`` rules.
+
+    Returns
+    -------
+
+    pandas.DataFrame :
+        The updated table, with every value as a string.
+    """
+    from pandas import read_csv
+    channels_table = read_csv (channels_path, sep = '\t',dtype=str,keep_default_na=False,na_filter=False,na_values=[],true_values=[],false_values=[])
+    if 'type' in channels:
+        for ch_name,ch_type in channels['type'].items():
+            channels_table.loc[(channels_table.name==str(ch_name)),'type'] = ch_type
+    channels_table.to_csv(channels_path, index=False,sep='\t')
+    return channels_table
+
+_SHARED_TSV_SUFFIXES = ('participants.tsv','_scans.tsv')
+"""Bookkeeping tables shared between files, whose rows need to be merged instead of replaced."""
+
+_SHARED_FILES = ('dataset_description.json','README','participants.json')
+"""Dataset-level files written by mne-bids for every file; only copied if missing."""
+
+def _merge_tsv(source,target):
+    """Merge the rows of the source tsv into the target tsv, keyed by the first column."""
+    from pandas import read_csv,concat
+    kwargs = dict(sep='\t',dtype=str,keep_default_na=False,na_filter=False)
+    new = read_csv(source,**kwargs)
+    if os.path.isfile(target):
+        old = read_csv(target,**kwargs)
+        new = concat([old,new],ignore_index=True)
+        new = new.fillna('n/a').drop_duplicates(subset=new.columns[0],keep='last')
+    new.to_csv(target + '.tmp',sep='\t',index=False)
+    os.replace(target + '.tmp',target)
+
+def merge_bids_tree(staging_path,bids_path,commit=None):
+    """Move the files of a bids tree written in a staging directory into the bids_path.
+
+    Data files and per-file sidecars replace the ones in the bids_path,
+    the rows of participants.tsv and scans.tsv are merged with the existing ones and
+    dataset-level files are only copied if they do not exist yet.
+    Every file is moved with an atomic rename, so no file of the bids_path is ever half-written.
+
+    Parameters
+    ----------
+
+    staging_path : str | pathlib.Path
+        The root of the staged bids tree, typically holding the output of a single file.
+    bids_path : str | pathlib.Path
+        The root of the bids dataset.
+    commit : str | pathlib.Path | None, optional
+        The path, relative to the bids root, of the file moved last (ie the main file of the recording).
+        If it exists in the bids_path, the rest of the files of the tree are there too.
+
+    Returns
+    -------
+
+    list of str :
+        The paths in bids_path of the files moved or merged.
+    """
+    staging_path = os.fspath(staging_path)
+    bids_path = os.fspath(bids_path)
+    commit = os.path.normpath(os.fspath(commit)) if commit is not None else None
+    merged = []
+    last = None
+    for root, dirs, files in os.walk(staging_path):
+        for name in files:
+            source = os.path.join(root,name)
+            relative = os.path.relpath(source,staging_path)
+            target = os.path.join(bids_path,relative)
+            if relative == commit:
+                last = (source,target)
+                continue
+            os.makedirs(os.path.dirname(target),exist_ok=True)
+            if name.endswith(_SHARED_TSV_SUFFIXES):
+                _merge_tsv(source,target)
+            elif name in _SHARED_FILES or name.endswith('_scans.json'):
+                if os.path.isfile(target):
+                    continue
+                os.replace(source,target)
+            else:
+                os.replace(source,target)
+            merged.append(target)
+    if last is not None:
+        os.makedirs(os.path.dirname(last[1]),exist_ok=True)
+        os.replace(*last)
+        merged.append(last[1])
+    return merged
+
+_SESSION_SUFFIXES = ('_electrodes.tsv','_coordsystem.json')
+"""Suffixes of the files mne-bids writes once per subject, session and datatype, shared by the recordings of their folder."""
+
+def is_session_file(path):
+    """Whether a bids file is shared by the recordings of its folder (ie sub-01_ses-A_space-CapTrak_electrodes.tsv)."""
+    name = os.path.basename(os.fspath(path))
+    return name.endswith(_SESSION_SUFFIXES) and all(e.startswith(('sub-','ses-','acq-','space-')) for e in name.split('_')[:-1])
+
+def _session_prefix(name):
+    """The subject and session entities of a bids filename (ie sub-01_ses-A)."""
+    return '_'.join(e for e in name.split('_')[:-1] if e.startswith(('sub-','ses-')))
+
+def recording_files(target):
+    """Get the files of a bids recording: the files of its folder named with its entities.
+
+    Parameters
+    ----------
+
+    target : str | pathlib.Path
+        The path of the main file of the recording (ie sub-01/eeg/sub-01_task-rest_eeg.vhdr).
+
+    Returns
+    -------
+
+    list of str :
+        The paths of the data file (or its split parts), its sidecars, the channels/events files
+        of the recording and the files it shares with the other recordings of its subject and session
+        (see is_session_file). Files of other recordings whose names start the same (ie with a run entity)
+        are not included.
+    """
+    folder,name = os.path.split(os.fspath(target))
+    prefix = name.rsplit('_',1)[0] + '_'
+    session = _session_prefix(name)
+    files = []
+    for f in os.listdir(folder):
+        rest = f[len(prefix):].split('_') if f.startswith(prefix) else None
+        if rest is not None and (len(rest) == 1 or (len(rest) == 2 and rest[0].startswith('split-'))):
+            files.append(f)
+        elif is_session_file(f) and _session_prefix(f) == session:
+            files.append(f)
+    return sorted(os.path.join(folder,f) for f in files)
+
+def remove_session_files(folder):
+    """Remove the files shared by the recordings of a folder (see is_session_file) if no recording is left in it."""
+    folder = os.fspath(folder)
+    if not os.path.isdir(folder):
+        return
+    files = os.listdir(folder)
+    if all(is_session_file(f) for f in files):
+        for f in files:
+            os.remove(os.path.join(folder,f))
+
+def _point_brainvision(path,name):
+    """Point the DataFile/MarkerFile lines of a BrainVision header or marker file to the files of the given name."""
+    with open(path,'rb') as f:
+        lines = f.readlines()
+    for k,line in enumerate(lines):
+        if line.startswith(b'DataFile='):
+            lines[k] = b'DataFile=' + name.encode() + b'.eeg' + line[len(line.rstrip(b'\r\n')):]
+        elif line.startswith(b'MarkerFile='):
+            lines[k] = b'MarkerFile=' + name.encode() + b'.vmrk' + line[len(line.rstrip(b'\r\n')):]
+    with open(path + '.tmp','wb') as f:
+        f.writelines(lines)
+    os.replace(path + '.tmp',path)
+
+def rename_recording(files,new_target,entities=None):
+    """Move the files of a bids recording to the folder and name of a new main file.
+
+    The entities of the names are replaced, keeping the split entity, suffix and extension of each file.
+    The files shared by the recordings of a session only take the new subject and session, and are
+    dropped if the new folder already has them. BrainVision headers are pointed to the new names and,
+    if the task changed, the TaskName of the sidecar json is updated.
+
+    Parameters
+    ----------
+
+    files : list of str
+        The files of the recording (see recording_files), possibly in another folder (ie a staging one).
+    new_target : str | pathlib.Path
+        The new path of the main file of the recording.
+    entities : dict | None, optional
+        The entities of the new target, used to update the TaskName.
+
+    Returns
+    -------
+
+    list of str :
+        The new paths of the files.
+    """
+    folder,name = os.path.split(os.fspath(new_target))
+    prefix = name.rsplit('_',1)[0]
+    session = _session_prefix(name)
+    os.makedirs(folder,exist_ok=True)
+    moved = []
+    for source in files:
+        parts = os.path.basename(source).split('_')
+        if is_session_file(source):
+            target = os.path.join(folder,'_'.join([session] + [e for e in parts[:-1] if e.startswith(('acq-','space-'))] + parts[-1:]))
+            if os.path.isfile(target):
+                os.remove(source)
+                moved.append(target)
+                continue
+        elif len(parts) > 2 and parts[-2].startswith('split-'):
+            target = os.path.join(folder,'_'.join([prefix] + parts[-2:]))
+        else:
+            target = os.path.join(folder,prefix + '_' + parts[-1])
+        os.replace(source,target)
+        moved.append(target)
+    for target in moved:
+        base,ext = os.path.splitext(target)
+        if ext in ('.vhdr','.vmrk'):
+            _point_brainvision(target,os.path.basename(base))
+        elif ext == '.json' and entities is not None and 'task' in entities and os.path.isfile(target):
+            with open(target) as f:
+                sidecar = json.load(f)
+            if 'TaskName' in sidecar and sidecar['TaskName'] != entities['task']:
+                sidecar['TaskName'] = entities['task']
+                _write_json(target,sidecar,overwrite=True)
+    return moved
+
+def _scans_entry(target,bids_path):
+    """Get the scans.tsv of a recording and its filename in it."""
+    datatype_folder = os.path.dirname(os.fspath(target))
+    folder = os.path.dirname(datatype_folder)
+    label = os.path.basename(folder)
+    if label.startswith('ses-'):
+        label = os.path.basename(os.path.dirname(folder)) + '_' + label
+    filename = os.path.relpath(os.fspath(target),folder).replace(os.sep,'/')
+    return os.path.join(folder,label + '_scans.tsv'),filename
+
+def _read_tsv(path):
+    from pandas import read_csv
+    return read_csv(path,sep='\t',dtype=str,keep_default_na=False,na_filter=False)
+
+def _write_tsv(table,path):
+    table.to_csv(path + '.tmp',sep='\t',index=False)
+    os.replace(path + '.tmp',path)
+
+def move_bookkeeping(renames,bids_path):
+    """Update the rows of the scans.tsv and participants.tsv after moving recordings.
+
+    Parameters
+    ----------
+
+    renames : list of tuple
+        The (old target, new target) of each moved recording.
+    bids_path : str | pathlib.Path
+        The root of the bids dataset.
+    """
+    from pandas import concat
+    bids_path = os.fspath(bids_path)
+    tables = {} # scans.tsv path -> table, written once at the end
+    def table(path):
+        if path not in tables:
+            tables[path] = _read_tsv(path) if os.path.isfile(path) else None
+        return tables[path]
+
+    for old,new in renames:
+        old_scans,old_name = _scans_entry(old,bids_path)
+        new_scans,new_name = _scans_entry(new,bids_path)
+        old_table = table(old_scans)
+        if old_table is None or 'filename' not in old_table.columns:
+            continue
+        rows = old_table[old_table.filename == old_name].copy()
+        tables[old_scans] = old_table[old_table.filename != old_name]
+        rows['filename'] = new_name
+        new_table = table(new_scans)
+        tables[new_scans] = rows if new_table is None else concat([new_table[new_table.filename != new_name],rows],ignore_index=True).fillna('n/a')
+    for path,scans in tables.items():
+        if scans is None:
+            continue
+        if len(scans) == 0:
+            if os.path.isfile(path):
+                os.remove(path)
+            continue
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        _write_tsv(scans,path)
+
+    participants_path = os.path.join(bids_path,'participants.tsv')
+    if not os.path.isfile(participants_path):
+        return
+    participants = _read_tsv(participants_path)
+    old_subs = set()
+    for old,new in renames:
+        old_sub = os.path.relpath(os.fspath(old),bids_path).split(os.sep)[0]
+        new_sub = os.path.relpath(os.fspath(new),bids_path).split(os.sep)[0]
+        old_subs.add(old_sub)
+        if old_sub != new_sub and new_sub not in set(participants.participant_id):
+            row = participants[participants.participant_id == old_sub].copy()
+            row['participant_id'] = new_sub
+            participants = concat([participants,row],ignore_index=True)
+    # participants whose recordings were all moved away
+    participants = participants[[sub not in old_subs or os.path.isdir(os.path.join(bids_path,sub)) for sub in participants.participant_id]]
+    _write_tsv(participants,participants_path)
+
+def remove_empty_folders(path,bids_path):
+    """Remove a folder and its parents while they are empty, up to (excluding) the bids_path."""
+    path = os.path.abspath(os.fspath(path))
+    bids_path = os.path.abspath(os.fspath(bids_path))
+    while path != bids_path and path.startswith(bids_path + os.sep):
+        try:
+            os.rmdir(path)
+        except OSError: # not empty
+            return
+        path = os.path.dirname(path)
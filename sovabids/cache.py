@@ -0,0 +1,326 @@
+"""Module with the persistent cache of individual mappings used by apply_rules,
+and the fingerprints of the sources and mappings used to detect what changed between runs."""
+import os
+import json
+import hashlib
+import logging
+
+from sovabids import __version__
+from sovabids.dicts import copy_tree
+
+LOGGER = logging.getLogger(__name__)
+
+CACHE_VERSION = 2
+"""Version of the cache file layout, part of the fingerprint so old caches are discarded."""
+
+def rules_fingerprint(rules,**extra):
+    """Compute a stable hash of the effective rules of a run.
+
+    Parameters
+    ----------
+
+    rules : dict
+        The rules dictionary.
+    **extra :
+        Other settings that change the resulting mappings (ie the bids_path or the probe).
+
+    Returns
+    -------
+
+    str :
+        The hexadecimal sha1 digest.
+    """
+    payload = {'rules':rules,'extra':extra,'cache':CACHE_VERSION,'sovabids':__version__}
+    payload = json.dumps(payload,sort_keys=True,default=str,ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def _file_key(path):
+    """Get the (size, mtime in ns) of a file, None if it can't be stat'ed."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size,stat.st_mtime_ns]
+
+_COMPANIONS = {'.vhdr':('.eeg','.vmrk'),'.set':('.fdt',)}
+"""Files that hold part of the recording next to the source file, by extension of the source."""
+
+HASH_BLOCK = 1 << 20
+"""Number of bytes of each of the blocks read by content_hash."""
+
+def source_files(path):
+    """Get the files of a recording: the source file and the companion files with the same name.
+
+    Parameters
+    ----------
+
+    path : str
+        The path of the source file (ie the .vhdr of a BrainVision recording).
+
+    Returns
+    -------
+
+    list of str :
+        The source file first, then its companion files that exist.
+    """
+    root,ext = os.path.splitext(path)
+    return [path] + [root + companion for companion in _COMPANIONS.get(ext.lower(),()) if os.path.isfile(root + companion)]
+
+def source_key(path):
+    """Get the (size, mtime in ns) of each file of a recording, without opening them.
+
+    Parameters
+    ----------
+
+    path : str
+        The path of the source file.
+
+    Returns
+    -------
+
+    list | None :
+        The [size, mtime] of each of the source_files, None if the source file can't be stat'ed.
+    """
+    keys = [_file_key(f) for f in source_files(path)]
+    return None if keys[0] is None else keys
+
+def content_hash(path):
+    """Compute a fast hash of the content of the files of a recording.
+
+    Only the size and a block at the start, the middle and the end of each file are hashed,
+    which is enough to tell a re-exported recording from a file that was just touched.
+
+    Parameters
+    ----------
+
+    path : str
+        The path of the source file.
+
+    Returns
+    -------
+
+    str | None :
+        The hexadecimal blake2b digest, None if the files can't be read.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        for fname in source_files(path):
+            size = os.path.getsize(fname)
+            digest.update(str(size).encode())
+            with open(fname,'rb') as f:
+                for offset in sorted({0,max(0,size//2-HASH_BLOCK//2),max(0,size-HASH_BLOCK)}):
+                    f.seek(offset)
+                    digest.update(f.read(HASH_BLOCK))
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+def mapping_fingerprint(mapping,**extra):
+    """Compute a stable hash of the mapping of a file and the settings it was converted with.
+
+    Unlike rules_fingerprint it doesn't depend on the version of sovabids,
+    so upgrading it does not make every file look changed.
+
+    Parameters
+    ----------
+
+    mapping : dict
+        The individual mapping of the file.
+    **extra :
+        Other settings that change the converted files (ie the copy_mode).
+
+    Returns
+    -------
+
+    str :
+        The hexadecimal sha1 digest.
+    """
+    payload = json.dumps({'mapping':mapping,'extra':extra},sort_keys=True,default=str,ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+METADATA_RULES = ('sidecar','dataset_description')
+"""Rules of a mapping that only change the metadata files of a recording, along with the channels types."""
+
+def data_fingerprint(mapping,**extra):
+    """Compute the mapping_fingerprint of the rules the data files of a recording depend on.
+
+    The sidecar and dataset_description rules and the channels types are left out,
+    since sovabids.convert.patch_metadata rewrites them without converting the file again.
+
+    Parameters
+    ----------
+
+    mapping : dict
+        The individual mapping of the file.
+    **extra :
+        Other settings that change the converted files (ie the copy_mode).
+
+    Returns
+    -------
+
+    str :
+        The hexadecimal sha1 digest.
+    """
+    data = {key:value for key,value in mapping.items() if key not in METADATA_RULES}
+    channels = {key:value for key,value in (mapping.get('channels',None) or {}).items() if key != 'type'}
+    data.pop('channels',None)
+    if channels:
+        data['channels'] = channels
+    return mapping_fingerprint(data,**extra)
+
+MAX_SECTIONS = 4
+"""Number of fingerprints whose entries are kept in a cache file, the least recently used ones are dropped by save."""
+
+class MappingCache:
+    """Persistent cache of the individual mappings of a run of apply_rules.
+
+    Entries are keyed by the source path and validated with the size and
+    modification time of the files of the recording (see :py:func:`source_key`),
+    so a changed companion file (ie a .vmrk or .fdt) invalidates the entry too.
+    Only the entries written with the same fingerprint of the rules are used.
+
+    The cache is a json-lines file made of sections: a line with a fingerprint
+    followed by the entries of that fingerprint, one per line. New entries are
+    appended as they are computed, so an interrupted run keeps what it did.
+    The sections of other fingerprints (ie of sovapply and sovarun with another probe)
+    are never truncated, so tools sharing the file don't discard each other's mappings;
+    :py:meth:`save` rewrites the file keeping, for the current fingerprint, only the entries
+    of the current run, and the sections of the other MAX_SECTIONS-1 most recently used fingerprints.
+
+    Parameters
+    ----------
+
+    path : str | pathlib.Path
+        The path of the cache file.
+    fingerprint : str
+        The fingerprint of the rules of the run (see :py:func:`rules_fingerprint`).
+
+    Attributes
+    ----------
+
+    hits : int
+        Number of mappings taken from the cache.
+    misses : int
+        Number of mappings not found (or outdated) in the cache.
+    """
+    def __init__(self,path,fingerprint):
+        self.path = os.fspath(path)
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        self._entries = {} # source -> (key, mapping) read from disk
+        self._used = {} # source -> (key, mapping) of the current run
+        self._others = {} # fingerprint -> {source: line} of the other sections, least recently used first
+        self._tail = None # fingerprint of the last section of the file
+        self._complete = True # whether the file ends with a newline
+        self._file = None
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path,encoding='utf-8') as f:
+                section = None
+                for line in f:
+                    self._complete = line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except ValueError: # ie a line cut by an interrupted run
+                        continue
+                    if 'source' not in entry:
+                        section = entry.get('fingerprint',None)
+                        self._tail = section
+                        if section != self.fingerprint:
+                            self._others[section] = self._others.pop(section,{})
+                    elif section == self.fingerprint:
+                        self._entries[entry['source']] = (entry['key'],entry['mapping'])
+                    elif section is not None:
+                        self._others[section][entry['source']] = line.rstrip('\n')
+        except (OSError,ValueError,KeyError,TypeError,AttributeError):
+            LOGGER.warning(f'Could not read the mapping cache {self.path}, ignoring it.',exc_info=True)
+            self._entries,self._others,self._tail = {},{},None
+        if not self._entries and self._others:
+            LOGGER.info(f'The mapping cache {self.path} has no mappings for these rules.')
+
+    def get(self,source):
+        """Get the cached mapping of a file, if it is still valid.
+
+        Parameters
+        ----------
+
+        source : str
+            The path of the file.
+
+        Returns
+        -------
+
+        dict | None :
+            A copy of the cached mapping, None if it is missing or outdated.
+        """
+        key = source_key(source)
+        entry = self._entries.get(source,None)
+        if key is None or entry is None or entry[0] != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used[source] = entry
+        return copy_tree(entry[1])
+
+    def put(self,source,mapping):
+        """Store the mapping of a file, appending it to the cache file.
+
+        Mappings that don't survive a json round trip unchanged (ie non-string keys) are not cached.
+
+        Parameters
+        ----------
+
+        source : str
+            The path of the file.
+        mapping : dict
+            The mapping of the file.
+        """
+        key = source_key(source)
+        if key is None:
+            return
+        line = json.dumps({'source':source,'key':key,'mapping':mapping},ensure_ascii=False,default=str)
+        if json.loads(line)['mapping'] != mapping:
+            return
+        self._used[source] = (key,mapping)
+        try:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or '.',exist_ok=True)
+                self._file = open(self.path,'a',encoding='utf-8')
+                if not self._complete:
+                    self._file.write('\n')
+                if self._tail != self.fingerprint:
+                    self._file.write(json.dumps({'fingerprint':self.fingerprint})+'\n')
+                    self._tail = self.fingerprint
+            self._file.write(line+'\n')
+            self._file.flush()
+        except OSError:
+            LOGGER.warning(f'Could not write to the mapping cache {self.path}',exc_info=True)
+
+    def save(self):
+        """Rewrite the cache file with the entries used or stored in this run and the sections of the other fingerprints."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if not self._used and not self._entries and not self._others:
+            return
+        tmp_path = self.path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.',exist_ok=True)
+            with open(tmp_path,'w',encoding='utf-8') as f:
+                others = list(self._others.items())
+                for fingerprint,lines in others[max(0,len(others)-MAX_SECTIONS+1):]:
+                    f.write(json.dumps({'fingerprint':fingerprint})+'\n')
+                    for line in lines.values():
+                        f.write(line+'\n')
+                f.write(json.dumps({'fingerprint':self.fingerprint})+'\n')
+                for source,(key,mapping) in self._used.items():
+                    f.write(json.dumps({'source':source,'key':key,'mapping':mapping},ensure_ascii=False,default=str)+'\n')
+            os.replace(tmp_path,self.path)
+            self._tail,self._complete = self.fingerprint,True
+        except OSError:
+            LOGGER.warning(f'Could not write the mapping cache {self.path}',exc_info=True)
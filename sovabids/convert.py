@@ -3,50 +3,154 @@
 import argparse
 import os
 import sys
+import shutil
+from collections.abc import Sequence
+from traceback import format_exc
 
 import logging
 from sovabids.dicts import deep_get
-from sovabids.rules import load_rules,apply_rules_to_single_file,_expand_path
-from sovabids.bids import update_dataset_description
+from sovabids.rules import apply_rules_to_single_file,_expand_path
+from sovabids.mappings import load_mappings
+from sovabids.bids import update_dataset_description,merge_bids_tree,update_sidecar_json,update_channels_tsv,recording_files,rename_recording,move_bookkeeping,remove_empty_folders,is_session_file,remove_session_files
+from sovabids.parallel import resolve_jobs,run_isolated,get_pool,call_safely
 from sovabids.loggers import setup_logging
 from sovabids.settings import SECTION_STRING
+from sovabids.streaming import DEFAULT_CHUNK_SIZE,conversion_footprint
+from sovabids.files import COPY_MODES
+from sovabids.journal import ConversionJournal
+from sovabids.cache import source_key,content_hash,mapping_fingerprint,data_fingerprint
+from sovabids.misc import parse_size
+from sovabids.timing import StageTimer,stage,collect_stages,record_stages,source_bytes
+from sovabids.tracing import tracing
 
 LOGGER = logging.getLogger(__name__)
 
-def convert_them(mappings_input):
+def _convert_in_worker(input_file,mapping,staging_path,chunk_size=DEFAULT_CHUNK_SIZE,copy_mode=None,native_dtype=True):
+    """Convert a single file into its own staging bids tree. Runs in a worker process, returning the spans of its stages (see sovabids.timing)."""
+    with collect_stages() as stages, stage('convert_file',file=input_file):
+        apply_rules_to_single_file(input_file,mapping,staging_path,write=True,persist=False,chunk_size=chunk_size,copy_mode=copy_mode,native_dtype=native_dtype)
+    return list(stages)
+
+def _relative_target(output_file,bids_path):
+    """The path of the output file relative to the bids root, None if there is no output file."""
+    return os.path.relpath(output_file,bids_path) if output_file is not None else None
+
+def _provenance(input_file,mapping,copy_mode,native_dtype):
+    """What the converted files of a source depend on: the stat and content hash of the source and the mapping."""
+    options = {'copy_mode':copy_mode,'native_dtype':native_dtype}
+    return {'key':source_key(input_file),'hash':content_hash(input_file),
+            'mapping':mapping_fingerprint(mapping,**options),'data':data_fingerprint(mapping,**options),'options':options}
+
+def _already_converted(journal,input_file,output_file,fingerprint,resume):
+    """Whether a file was converted and neither its source nor its mapping changed since.
+
+    Files in the journal are checked against the provenance recorded when they were converted,
+    stat'ing the source and only hashing it if its size or modification time changed,
+    and are converted again if their output file was deleted.
+    Files not in the journal (ie converted by an older version) are checked by the existence of
+    their output file, which is moved into the bids directory after the rest of their files.
+    When resuming, the files the journal records as done are skipped without checking anything.
+    """
+    entry = journal.entries.get(input_file,None)
+    if entry is None:
+        return output_file is not None and os.path.isfile(output_file)
+    if entry['state'] != 'done' or entry.get('target',None) != output_file:
+        return False
+    if resume:
+        return True
+    if entry.get('mapping',None) != fingerprint or not os.path.isfile(output_file):
+        return False
+    key = source_key(input_file)
+    if key is not None and key == entry.get('key',None):
+        return True
+    if key is None or [k[0] for k in key] != [k[0] for k in entry.get('key',None) or []]:
+        return False
+    # Touched but maybe not changed (ie copied again), compare the contents
+    digest = content_hash(input_file)
+    if digest is None or digest != entry.get('hash',None):
+        return False
+    journal.mark(input_file,output_file,'done',key=key,hash=digest,mapping=fingerprint,
+                 **{k:entry[k] for k in ('data','options') if k in entry})
+    return True
+
+def convert_them(mappings_input,jobs=1,timeout=None,chunk_size=DEFAULT_CHUNK_SIZE,copy_mode=None,native_dtype=True,resume=False,max_memory=None):
     """Convert eeg files to bids according to the mappings given.
 
     Parameters
     ----------
-    mappings_input : str | pathlib.Path | dict
+    mappings_input : str | pathlib.Path | dict | sovabids.mappings.Mappings
         The path to the mapping file or the mapping dictionary:
             {
                 'General': dict with the general rules,
                 'Individual':  list of dicts with the individual mappings of each file.
             }
+        Mapping files ending in .jsonl are read lazily as JSON Lines (see sovabids.mappings),
+        any other file is read as YAML. Delta-encoded Individual mappings are expanded as they are converted.
+    jobs : int, optional
+        Number of files converted at the same time, each one in its own worker process.
+        1 converts them serially in the current process, 0 or a negative number uses one process per cpu.
+        In worker mode a crash of a worker only fails its own file.
+    timeout : float | None, optional
+        Only for worker mode. Maximum number of seconds the conversion of a single file may take
+        before its worker is killed and the file marked as failed. None means no limit.
+    chunk_size : int | None, optional
+        Number of samples per channel read and written at a time, which bounds the memory used by the
+        conversion of long recordings (see sovabids.streaming). None or 0 loads each recording whole.
+    copy_mode : str | None, optional
+        If 'copy', 'reflink' or 'hardlink', BrainVision, EDF and BDF files that would be written unchanged
+        are copied, reflinked or hardlinked instead of converted (see rules.apply_rules_to_single_file).
+        None converts every file.
+    native_dtype : bool, optional
+        Whether BrainVision output keeps the sample format and resolution of int16 and 24-bit sources
+        instead of being written as float32 (see sovabids.streaming). Only with a chunk_size.
+    resume : bool, optional
+        Whether to take the state of each file from the journal of the previous runs,
+        converting again the ones that were pending, running or failed and skipping
+        the ones that were done without checking the bids directory nor the sources.
+        Otherwise a file is converted again if its source (size, modification time and content)
+        or its mapping changed since it was converted, or if its output file doesn't exist.
+    max_memory : int | str | None, optional
+        Only for worker mode. The memory the workers converting at the same time may use, in bytes
+        or with a unit suffix (ie '8G'). The footprint of each file is estimated from the header of its
+        source (see sovabids.streaming.conversion_footprint) and a file only starts while it fits in the
+        budget left by the running ones. None means no limit besides the number of jobs.
+
+    Notes
+    -----
+    Each file is written to a staging directory under bids_path/code/sovabids/staging and then
+    moved into the bids_path with atomic renames, its output file (``IO.target``) last. An interrupted
+    conversion thus never leaves a half-written file in the bids_path, nor an output file without the rest
+    of its files. The state of each file (pending, running, done or failed, with its timing and error)
+    and the provenance of the converted ones (see sovabids.cache.source_key, content_hash and mapping_fingerprint)
+    are recorded in the journal bids_path/code/sovabids/convert_journal.jsonl.
+
+    The time spent in each stage of the conversion of the files (ie read_raw, write_raw_bids,
+    the sidecar and channels rewrites) and the throughput of the converted and failed files are
+    logged and written to bids_path/code/sovabids/convert_timing.json (see sovabids.timing.StageTimer.summary).
+
+    In worker mode the files are converted longest-processing-time first, the largest sources
+    (samples x channels x bytes per sample) first, so that a large file started last doesn't
+    keep the rest of the workers idle.
     
     Returns
     -------
     dict
         ``{'succeeded': [str, ...], 'skipped': [str, ...], 'failed': [str, ...]}`` —
-        source paths of files that were newly converted, skipped because their BIDS
-        output already existed, and those that raised an error.
+        source paths of files that were newly converted, skipped because they were
+        already converted, and those that raised an error.
     """
 
     if isinstance(mappings_input, os.PathLike):
         mappings_input = os.fspath(mappings_input)
-    # Loading Mappings
-    mappings = load_rules(mappings_input)
+    # Loading and Verifying Mappings
+    mappings = load_mappings(mappings_input)
     mapping_file = mappings_input if isinstance(mappings_input,str) else None
-    
-    # Verifying Mappings
-    assert 'Individual' in mappings,f'`Individual` does not exist in the mapping dictionary'
-    assert 'General' in mappings,f'`General` does not exist in the mapping dictionary'
-    
+    general = mappings.general
+
     # Getting input,output and log path (expand ~ / $VARS so a path from the
     # mappings YAML isn't used literally, e.g. creating a "$HOME" directory) (#94)
-    bids_path = _expand_path(mappings['General']['IO']['target'])
-    source_path = _expand_path(mappings['General']['IO']['source'])
+    bids_path = _expand_path(general['IO']['target'])
+    source_path = _expand_path(general['IO']['source'])
     log_file = os.path.join(bids_path,'code','sovabids','sovabids.log')
 
     # Setup the logging
@@ -56,24 +160,53 @@ def convert_them(mappings_input):
     LOGGER.info(f"source_path={source_path} bids_path={bids_path} mapping_file={str(mapping_file)} ")
 
     LOGGER.info(f"Converting Individual Mappings")
-    num_files = len(mappings['Individual'])
+    num_files = len(mappings)
     succeeded = []
     skipped = []
     failed = []
-    for i,mapping in enumerate(mappings['Individual']):
-        input_file=_expand_path(deep_get(mapping,'IO.source',None))
-        output_file=_expand_path(deep_get(mapping,'IO.target',None))
-        try:
-            LOGGER.info(f"File {i+1} of {num_files} ({(i+1)*100/num_files}%) : {input_file}")
-            if not os.path.isfile(output_file):
-                apply_rules_to_single_file(input_file,mapping,bids_path,write=True)
-                succeeded.append(input_file)
+    journal = ConversionJournal(os.path.join(bids_path,'code','sovabids','convert_journal.jsonl'))
+    staging_root = os.path.join(bids_path,'code','sovabids','staging')
+    shutil.rmtree(staging_root,ignore_errors=True) # leftovers of an interrupted run
+    jobs = resolve_jobs(jobs)
+    if max_memory is not None:
+        max_memory = parse_size(max_memory)
+    timer = StageTimer('convert_them')
+    try:
+        with timer.recording():
+            if jobs == 1:
+                for i,mapping in enumerate(mappings):
+                    input_file=_expand_path(deep_get(mapping,'IO.source',None))
+                    output_file=_expand_path(deep_get(mapping,'IO.target',None))
+                    LOGGER.info(f"File {i+1} of {num_files} ({(i+1)*100/num_files}%) : {input_file}")
+                    fingerprint = mapping_fingerprint(mapping,copy_mode=copy_mode,native_dtype=native_dtype)
+                    if _already_converted(journal,input_file,output_file,fingerprint,resume):
+                        LOGGER.warning(f'SKIPPED (already converted): {input_file}')
+                        skipped.append(input_file)
+                        continue
+                    staging = os.path.join(staging_root,str(i))
+                    journal.mark(input_file,output_file,'running')
+                    try:
+                        with stage('provenance',file=input_file):
+                            provenance = _provenance(input_file,mapping,copy_mode,native_dtype)
+                        with stage('convert_file',file=input_file):
+                            apply_rules_to_single_file(input_file,mapping,staging,write=True,persist=False,chunk_size=chunk_size,copy_mode=copy_mode,native_dtype=native_dtype)
+                        with stage('merge_bids_tree',file=input_file):
+                            merge_bids_tree(staging,bids_path,commit=_relative_target(output_file,bids_path))
+                        journal.mark(input_file,output_file,'done',**provenance)
+                        succeeded.append(input_file)
+                    except Exception:
+                        LOGGER.exception(f'Error converting {input_file}')
+                        journal.mark(input_file,output_file,'failed',error=format_exc())
+                        failed.append(input_file)
+                    finally:
+                        shutil.rmtree(staging,ignore_errors=True)
             else:
-                LOGGER.warning(f'SKIPPED (already converted): {input_file}')
-                skipped.append(input_file)
-        except Exception:
-            LOGGER.exception(f'Error converting {input_file}')
-            failed.append(input_file)
+                succeeded,skipped,failed = _convert_in_workers(mappings,bids_path,jobs,timeout,chunk_size,copy_mode,native_dtype,journal,resume,max_memory)
+    finally:
+        shutil.rmtree(staging_root,ignore_errors=True)
+        journal.save()
+    for f in succeeded+failed:
+        timer.add_file(source_bytes(f))
 
     LOGGER.info(
         f"Conversion Done! {len(succeeded)} converted, "
@@ -81,17 +214,20 @@ def convert_them(mappings_input):
         f"(total {num_files})."
     )
     if skipped:
-        LOGGER.warning(f"{len(skipped)} file(s) skipped (output already exists — delete to re-convert).")
+        LOGGER.warning(f"{len(skipped)} file(s) skipped (already converted — delete the output to re-convert).")
     if failed:
         LOGGER.warning(f"{len(failed)} file(s) failed conversion:")
         for f in failed:
             LOGGER.warning(f"  FAILED: {f}")
 
+    timer.log(LOGGER)
+    timer.write(os.path.join(bids_path,'code','sovabids','convert_timing.json'))
+
     LOGGER.info(f"Updating Dataset Description")
 
     # Grab the info from the last file to make the dataset description
-    if 'dataset_description' in mappings['General']:
-        dataset_description = mappings['General']['dataset_description']
+    if 'dataset_description' in general:
+        dataset_description = general['dataset_description']
         update_dataset_description(dataset_description,bids_path)
 
     LOGGER.info(f"Dataset Description Updated!")
@@ -101,6 +237,344 @@ def convert_them(mappings_input):
     return {'succeeded': succeeded, 'skipped': skipped, 'failed': failed}
 
 
+class _WorkerArgs(Sequence):
+    """The arguments of the worker converting each task, built when run_isolated starts it."""
+    def __init__(self,tasks,build):
+        self._tasks = tasks
+        self._build = build
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __getitem__(self,k):
+        return self._build(*self._tasks[k])
+
+def _convert_in_workers(individuals,bids_path,jobs,timeout=None,chunk_size=DEFAULT_CHUNK_SIZE,copy_mode=None,native_dtype=True,journal=None,resume=False,max_memory=None):
+    """Convert the individual mappings with one worker process per file.
+
+    Each worker writes into its own staging bids tree, which is merged into the bids_path
+    by this (parent) process as soon as the worker finishes. This way the files shared by
+    every conversion (participants.tsv, scans.tsv, dataset_description.json) are never
+    written by two processes at the same time. The files are started longest-processing-time
+    first within the max_memory budget (see sovabids.parallel.run_isolated).
+
+    Returns
+    -------
+    tuple
+        The (succeeded, skipped, failed) lists of source paths, in the order of the mappings.
+    """
+    staging_root = os.path.join(bids_path,'code','sovabids','staging')
+    if journal is None:
+        journal = ConversionJournal(os.path.join(bids_path,'code','sovabids','convert_journal.jsonl'))
+
+    sources = []
+    status = {}
+    tasks = [] # (index, source, target, staging) of the files to convert, the mappings themselves are read lazily
+    for i,mapping in enumerate(individuals):
+        input_file=_expand_path(deep_get(mapping,'IO.source',None))
+        output_file=_expand_path(deep_get(mapping,'IO.target',None))
+        sources.append(input_file)
+        if _already_converted(journal,input_file,output_file,mapping_fingerprint(mapping,copy_mode=copy_mode,native_dtype=native_dtype),resume):
+            LOGGER.warning(f'SKIPPED (already converted): {input_file}')
+            status[i] = 'skipped'
+        else:
+            journal.mark(input_file,output_file,'pending')
+            tasks.append((i,input_file,output_file,os.path.join(staging_root,str(i))))
+
+    provenances = {} # index -> provenance of the files being converted
+    def worker_args(i,input_file,output_file,staging):
+        # called by run_isolated as the workers are started
+        mapping = individuals[i]
+        journal.mark(input_file,output_file,'running')
+        with stage('provenance',file=input_file):
+            provenances[i] = _provenance(input_file,mapping,copy_mode,native_dtype)
+        return (input_file,mapping,staging,chunk_size,copy_mode,native_dtype)
+
+    costs = [conversion_footprint(input_file,chunk_size) for _,input_file,_,_ in tasks]
+    if max_memory is not None:
+        max_memory = parse_size(max_memory)
+        LOGGER.info(f"Memory budget of {max_memory} bytes, the largest file is estimated to need {max([m for m,_ in costs],default=0)}")
+    LOGGER.info(f"Converting {len(tasks)} files with {min(jobs,max(len(tasks),1))} worker processes")
+    for done,(k,stages,error) in enumerate(run_isolated(_convert_in_worker,_WorkerArgs(tasks,worker_args),jobs,timeout,costs,max_memory)):
+        i,input_file,output_file,staging = tasks[k]
+        LOGGER.info(f"File {done+1} of {len(tasks)} ({(done+1)*100/len(tasks)}%) : {input_file}")
+        if error is None:
+            record_stages(stages)
+            try:
+                with stage('merge_bids_tree',file=input_file):
+                    merge_bids_tree(staging,bids_path,commit=_relative_target(output_file,bids_path))
+                status[i] = 'succeeded'
+                journal.mark(input_file,output_file,'done',**provenances.pop(i))
+            except Exception:
+                LOGGER.exception(f'Error moving the converted files of {input_file} into {bids_path}')
+                status[i] = 'failed'
+                provenances.pop(i,None)
+                journal.mark(input_file,output_file,'failed',error=format_exc())
+        else:
+            LOGGER.error(f'Error converting {input_file}\n{error}')
+            status[i] = 'failed'
+            provenances.pop(i,None)
+            journal.mark(input_file,output_file,'failed',error=error)
+        shutil.rmtree(staging,ignore_errors=True)
+
+    return tuple([sources[i] for i in range(len(sources)) if status.get(i) == key] for key in ('succeeded','skipped','failed'))
+
+def _metadata_files(output_file):
+    """The paths of the sidecar json and the channels tsv of a bids recording."""
+    base = os.path.splitext(output_file)[0]
+    return base + '.json', base.rsplit('_',1)[0] + '_channels.tsv'
+
+def _patch_single_file(output_file,sidecar,channels):
+    """Apply the sidecar and channels rules to the metadata files of a converted recording."""
+    sidecar_path,channels_path = _metadata_files(output_file)
+    update_sidecar_json(sidecar_path,sidecar)
+    if os.path.isfile(channels_path):
+        update_channels_tsv(channels_path,channels)
+
+def _call_chunk_in_worker(func,tasks):
+    """Call a function with the arguments of each task of a chunk inside a worker, returning the (result, traceback string or None) of each one."""
+    return [call_safely(func,*task) for task in tasks]
+
+def _call_in_chunks(func,tasks,jobs):
+    """Call a function with the arguments of each task, in a pool of warm workers if jobs > 1.
+
+    Used for the light per-file work (patching and moving files), where starting a process per file would cost more than the work.
+
+    Yields
+    ------
+
+    tuple :
+        (result, traceback string or None) of each task, in order.
+    """
+    jobs = min(resolve_jobs(jobs),max(len(tasks),1))
+    if jobs == 1:
+        for task in tasks:
+            yield call_safely(func,*task)
+        return
+    chunksize = max(1,min(64,len(tasks)//(jobs*4)))
+    with get_pool(jobs) as pool:
+        chunks = [tasks[k:k+chunksize] for k in range(0,len(tasks),chunksize)]
+        for chunk in pool.map(_call_chunk_in_worker,[func]*len(chunks),chunks):
+            yield from chunk
+
+def patch_metadata(mappings_input,jobs=1):
+    """Apply the sidecar, channels and dataset_description rules of the mappings to an existing bids output.
+
+    Only the metadata files (``*_<datatype>.json``, ``*_channels.tsv`` and dataset_description.json)
+    are rewritten, the data files are left untouched. Use it when only those rules changed since
+    the conversion, instead of converting every file again. Note that channel types stored in the
+    data files themselves (ie FIF) are not changed. Files whose other rules changed too (ie the channel
+    names) are patched but recorded as pending in the journal, so the next convert_them converts them
+    again, even when resuming.
+
+    Parameters
+    ----------
+    mappings_input : str | pathlib.Path | dict | sovabids.mappings.Mappings
+        The path to the mapping file or the mapping dictionary, see convert_them.
+    jobs : int, optional
+        Number of worker processes patching the files.
+        1 patches them serially in the current process, 0 or a negative number uses one process per cpu.
+
+    Returns
+    -------
+    dict
+        ``{'succeeded': [str, ...], 'skipped': [str, ...], 'failed': [str, ...]}`` —
+        source paths of files whose metadata was patched, skipped because they were
+        not converted yet, and those that raised an error.
+    """
+    if isinstance(mappings_input, os.PathLike):
+        mappings_input = os.fspath(mappings_input)
+    mappings = load_mappings(mappings_input)
+    general = mappings.general
+    bids_path = _expand_path(general['IO']['target'])
+
+    setup_logging(os.path.join(bids_path,'code','sovabids','sovabids.log'))
+    LOGGER.info('')
+    LOGGER.info(SECTION_STRING + ' START PATCH_METADATA ' + SECTION_STRING)
+
+    journal = ConversionJournal(os.path.join(bids_path,'code','sovabids','convert_journal.jsonl'))
+    sources = []
+    status = {}
+    tasks = [] # (index, (output_file, sidecar rules, channels rules))
+    fingerprints = {}
+    for i,mapping in enumerate(mappings):
+        input_file=_expand_path(deep_get(mapping,'IO.source',None))
+        output_file=_expand_path(deep_get(mapping,'IO.target',None))
+        sources.append(input_file)
+        if output_file is None or not os.path.exists(output_file):
+            LOGGER.warning(f'SKIPPED (not converted): {input_file}')
+            status[i] = 'skipped'
+            continue
+        tasks.append((i,(output_file,mapping.get('sidecar',{}) or {},mapping.get('channels',{}) or {})))
+        entry = journal.entries.get(input_file,None)
+        if entry is None or entry['state'] != 'done' or entry.get('target',None) != output_file or 'options' not in entry:
+            continue
+        if entry.get('data',None) == data_fingerprint(mapping,**entry['options']):
+            fingerprints[i] = mapping_fingerprint(mapping,**entry['options'])
+        else:
+            # other rules changed too, the data files have to be converted again
+            fingerprints[i] = None
+
+    LOGGER.info(f"Patching {len(tasks)} files")
+    try:
+        for (i,(output_file,_,_)),(_,error) in zip(tasks,_call_in_chunks(_patch_single_file,[task for _,task in tasks],jobs)):
+            if error is None:
+                status[i] = 'succeeded'
+                if fingerprints.get(i,None) is not None:
+                    # the data files still match the source, only the metadata rules changed
+                    entry = journal.entries[sources[i]]
+                    journal.mark(sources[i],output_file,'done',key=entry.get('key',None),hash=entry.get('hash',None),
+                                 mapping=fingerprints[i],data=entry['data'],options=entry['options'])
+                elif i in fingerprints:
+                    journal.mark(sources[i],output_file,'pending')
+            else:
+                LOGGER.error(f'Error patching the metadata of {sources[i]}\n{error}')
+                status[i] = 'failed'
+    finally:
+        journal.save()
+
+    if 'dataset_description' in general:
+        update_dataset_description(general['dataset_description'],bids_path)
+
+    succeeded,skipped,failed = ([sources[i] for i in range(len(sources)) if status.get(i) == key] for key in ('succeeded','skipped','failed'))
+    LOGGER.info(f"Metadata Patch Done! {len(succeeded)} patched, {len(skipped)} skipped, {len(failed)} failed (total {len(sources)}).")
+    LOGGER.info(SECTION_STRING + ' END PATCH_METADATA ' + SECTION_STRING)
+    return {'succeeded': succeeded, 'skipped': skipped, 'failed': failed}
+
+def _has_outputs(target):
+    """Whether the main file of a bids recording, or its split parts (ie *_split-01_meg.fif), exist."""
+    if os.path.exists(target):
+        return True
+    return os.path.isdir(os.path.dirname(target)) and any('_split-' in os.path.basename(f) for f in recording_files(target))
+
+def _stage_recording(old_target,staging):
+    """Move the files of a bids recording into a staging folder, returning their new paths.
+
+    The files shared with the other recordings of the session are copied, they are removed
+    from the old folder once no recording is left in it (see sovabids.bids.remove_session_files).
+    """
+    os.makedirs(staging,exist_ok=True)
+    staged = []
+    for f in recording_files(old_target):
+        dest = os.path.join(staging,os.path.basename(f))
+        if is_session_file(f):
+            shutil.copy2(f,dest)
+        else:
+            os.replace(f,dest)
+        staged.append(dest)
+    return staged
+
+def remap_outputs(mappings_input,previous=None,jobs=1):
+    """Move the converted files whose target changed in the mappings, instead of converting them again.
+
+    Use it when a new mappings file only changes the entities of the files (ie a wrong session label
+    given by the path pattern). The files of each recording (data, sidecars, channels and events, along
+    with the electrodes and coordsystem files of its session) are renamed to the new target, the BrainVision headers pointed to the new names and the rows of the
+    scans.tsv and participants.tsv moved along. The files are first moved into a staging folder and
+    then to their new place, so targets can be swapped between files.
+
+    Parameters
+    ----------
+    mappings_input : str | pathlib.Path | dict | sovabids.mappings.Mappings
+        The new mappings, see convert_them.
+    previous : str | pathlib.Path | dict | sovabids.mappings.Mappings | None, optional
+        The mappings the files were converted with. If None, the targets recorded in
+        the conversion journal of the bids directory are used.
+    jobs : int, optional
+        Number of worker processes moving the files.
+        1 moves them serially in the current process, 0 or a negative number uses one process per cpu.
+
+    Returns
+    -------
+    dict
+        ``{'succeeded': [str, ...], 'skipped': [str, ...], 'failed': [str, ...]}`` —
+        source paths of files whose outputs were moved, skipped because their target didn't change
+        (or they were not converted) and those that could not be moved (ie the new target is taken).
+    """
+    if isinstance(mappings_input, os.PathLike):
+        mappings_input = os.fspath(mappings_input)
+    mappings = load_mappings(mappings_input)
+    general = mappings.general
+    bids_path = _expand_path(general['IO']['target'])
+
+    setup_logging(os.path.join(bids_path,'code','sovabids','sovabids.log'))
+    LOGGER.info('')
+    LOGGER.info(SECTION_STRING + ' START REMAP_OUTPUTS ' + SECTION_STRING)
+
+    journal = ConversionJournal(os.path.join(bids_path,'code','sovabids','convert_journal.jsonl'))
+    if previous is not None:
+        if isinstance(previous, os.PathLike):
+            previous = os.fspath(previous)
+        old_targets = {_expand_path(deep_get(m,'IO.source',None)):_expand_path(deep_get(m,'IO.target',None)) for m in load_mappings(previous)}
+    else:
+        old_targets = {source:entry.get('target',None) for source,entry in journal.entries.items() if entry['state'] == 'done'}
+
+    sources = []
+    status = {}
+    plan = [] # (index, old target, new target, mapping)
+    for i,mapping in enumerate(mappings):
+        input_file=_expand_path(deep_get(mapping,'IO.source',None))
+        new_target=_expand_path(deep_get(mapping,'IO.target',None))
+        sources.append(input_file)
+        old_target = old_targets.get(input_file,None)
+        if old_target is None or old_target == new_target:
+            status[i] = 'skipped'
+        elif not _has_outputs(old_target):
+            LOGGER.warning(f'SKIPPED (no output at {old_target}): {input_file}')
+            status[i] = 'skipped'
+        else:
+            plan.append((i,old_target,new_target,mapping))
+
+    moving_away = {old for _,old,_,_ in plan}
+    new_targets = [new for _,_,new,_ in plan]
+    moves = []
+    for i,old,new,mapping in plan:
+        if (os.path.exists(new) and new not in moving_away) or new_targets.count(new) > 1:
+            LOGGER.error(f'Cannot move the outputs of {sources[i]} to {new}, the target is taken.')
+            status[i] = 'failed'
+        else:
+            moves.append((i,old,new,mapping))
+
+    LOGGER.info(f"Moving the outputs of {len(moves)} files")
+    staging_root = os.path.join(bids_path,'code','sovabids','staging','remap')
+    shutil.rmtree(staging_root,ignore_errors=True)
+    staged = {}
+    for (i,old,_,_),(files,error) in zip(moves,_call_in_chunks(_stage_recording,[(old,os.path.join(staging_root,str(i))) for i,old,_,_ in moves],jobs)):
+        if error is None:
+            staged[i] = files
+        else:
+            LOGGER.error(f'Error moving the outputs of {sources[i]}\n{error}')
+            status[i] = 'failed'
+
+    moves = [move for move in moves if move[0] in staged]
+    renames = []
+    tasks = [(staged[i],new,mapping.get('entities',None)) for i,_,new,mapping in moves]
+    try:
+        for (i,old,new,mapping),(_,error) in zip(moves,_call_in_chunks(rename_recording,tasks,jobs)):
+            if error is not None:
+                LOGGER.error(f'Error moving the outputs of {sources[i]}, they were left in {staging_root}\n{error}')
+                status[i] = 'failed'
+                continue
+            status[i] = 'succeeded'
+            renames.append((old,new))
+            entry = journal.entries.get(sources[i],None)
+            if entry is not None and entry['state'] == 'done' and 'options' in entry:
+                journal.mark(sources[i],new,'done',key=entry.get('key',None),hash=entry.get('hash',None),
+                             mapping=mapping_fingerprint(mapping,**entry['options']),options=entry['options'])
+        move_bookkeeping(renames,bids_path)
+    finally:
+        journal.save()
+    for old,_ in renames:
+        remove_session_files(os.path.dirname(old))
+        remove_empty_folders(os.path.dirname(old),bids_path)
+    if all(status[i] == 'succeeded' for i in staged):
+        shutil.rmtree(staging_root,ignore_errors=True)
+
+    succeeded,skipped,failed = ([sources[i] for i in range(len(sources)) if status.get(i) == key] for key in ('succeeded','skipped','failed'))
+    LOGGER.info(f"Remap Done! {len(succeeded)} moved, {len(skipped)} skipped, {len(failed)} failed (total {len(sources)}).")
+    LOGGER.info(SECTION_STRING + ' END REMAP_OUTPUTS ' + SECTION_STRING)
+    return {'succeeded': succeeded, 'skipped': skipped, 'failed': failed}
+
 def sovaconvert():
     """Console script usage for conversion."""
     # see https://github.com/Donders-Institute/bidscoin/blob/master/bidscoin/bidsmapper.py for example of how to make this
@@ -114,13 +588,30 @@ def sovaconvert():
 
     parser = subparsers.add_parser('convert_them')
     parser.add_argument('mappings',help='The mapping file of the conversion.')
+    parser.add_argument('-j','--jobs', type=int, help='Number of files converted at the same time, each in its own worker process. 0 uses one per cpu.',default=1)
+    parser.add_argument('--timeout', type=float, help='With --jobs, the maximum number of seconds the conversion of a single file may take.',default=None)
+    parser.add_argument('--chunk-size', type=int, help='Number of samples per channel converted at a time, which bounds the memory used by long recordings. 0 loads each recording whole.',default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--max-memory', help='With --jobs, the memory the files converted at the same time may use, ie 8G. The largest files are started first.',default=None)
+    parser.add_argument('--copy-mode', choices=COPY_MODES, help='Copy, reflink or hardlink the BrainVision, EDF and BDF files that do not need to be converted instead of converting them.',default=None)
+    parser.add_argument('--metadata-only', action="store_true", help='Only apply the sidecar, channel type and dataset_description rules to the files already converted, without touching their data.')
+    parser.add_argument('--remap', action="store_true", help='Only move the files already converted to the targets of the mapping file, without converting them again.')
+    parser.add_argument('--previous', help='With --remap, the mapping file the files were converted with. By default the targets recorded by the previous conversions are used.',default=None)
+    parser.add_argument('--resume', action="store_true", help='Convert again only the files the journal of the previous runs does not record as done.')
+    parser.add_argument('--float32', action="store_true", help='Write BrainVision data as float32 even when the source stores int16 or 24-bit samples.')
+    parser.add_argument('--trace', help='Write a trace of the stages of each file in every worker, in the Chrome trace-event format, to this json file.',default=None)
     parser.add_argument('-v','--verbose', action="store_true", help='Make the output more verbose.')
     args = parser.parse_args()
 
     if args.verbose:
         LOGGER.setLevel(logging.INFO)
 
-    result = convert_them(args.mappings)
+    with tracing(args.trace):
+        if args.metadata_only:
+            result = patch_metadata(args.mappings,jobs=args.jobs)
+        elif args.remap:
+            result = remap_outputs(args.mappings,previous=args.previous,jobs=args.jobs)
+        else:
+            result = convert_them(args.mappings,jobs=args.jobs,timeout=args.timeout,chunk_size=args.chunk_size,copy_mode=args.copy_mode,native_dtype=not args.float32,resume=args.resume,max_memory=args.max_memory)
     if result['failed']:
         sys.exit(1)
 
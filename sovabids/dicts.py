@@ -1,6 +1,7 @@
 """Module with dictionary utilities."""
 
 import collections
+from copy import deepcopy
 from functools import reduce
 def deep_get(dictionary, keys, default=None,sep='.'):
     """Safe nested dictionary getter.
@@ -29,6 +30,32 @@ def deep_get(dictionary, keys, default=None,sep='.'):
     """
     return reduce(lambda d, key: d.get(key, default) if isinstance(d, dict) else default, keys.split(sep), dictionary)
 
+def copy_tree(obj):
+    """Copy a tree of dictionaries and lists, such as the ones loaded from a yaml file.
+
+    A faster equivalent of copy.deepcopy for these trees, since immutable leaves
+    (str, int, float, bool, None) are shared instead of copied.
+
+    Parameters
+    ----------
+
+    obj : object
+        The tree to copy.
+
+    Returns
+    -------
+
+    object :
+        The copy of the tree.
+    """
+    if isinstance(obj,dict):
+        return {key:copy_tree(value) for key,value in obj.items()}
+    if isinstance(obj,list):
+        return [copy_tree(value) for value in obj]
+    if obj is None or isinstance(obj,(str,int,float,bool)):
+        return obj
+    return deepcopy(obj)
+
 def deep_merge_N(l):
     """Merge the list of dictionaries, such that the latest one has the greater precedence.
     
@@ -55,6 +82,35 @@ def deep_merge_N(l):
         d = deep_merge(d1,d2)
         l.insert(0, d)
 
+def deep_update(a, b):
+    """Merge `b` into the dictionary `a` in place, with the same semantics as deep_merge.
+
+    Faster than deep_merge when `a` can be modified, as only the branches of `b` are visited.
+    The sub-dictionaries of `b` may end up inside `a`, so `b` should not be used afterwards.
+
+    Parameters
+    ----------
+
+    a : dict
+        The dictionary to update.
+    b : dict
+        The dictionary with the values that take precedence.
+
+    Returns
+    -------
+
+    dict :
+        `a`, updated.
+    """
+    for key, value in b.items():
+        if key not in a:
+            a[key] = value
+        elif isinstance(value, dict) and isinstance(a[key], dict):
+            deep_update(a[key], value)
+        elif value is not None:
+            a[key] = value
+    return a
+
 def deep_merge(a, b):
     """
     Merge two values, with `b` taking precedence over `a`.
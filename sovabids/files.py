@@ -1,7 +1,118 @@
 """Module with file utilities."""
 import os
+import re
+import shutil
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import yaml
+
+LOGGER = logging.getLogger(__name__)
+
+COPY_MODES = ('copy','reflink','hardlink')
+"""Ways of transferring a file with :py:func:`transfer_file`."""
+
+_FICLONE = 0x40049409 # linux ioctl to clone (reflink) a whole file
+
+def _scan_dir(path):
+    """List a directory, returning its subdirectories (full paths) and its files (names).
+
+    As os.walk, symbolic links to directories are neither followed nor listed as files,
+    and directories that can't be listed are treated as empty.
+    """
+    dirs,files = [],[]
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(entry.name)
+                elif not entry.is_symlink():
+                    dirs.append(entry.path)
+    except OSError:
+        pass
+    return dirs,files
+
+def _compile_filters(filters):
+    """Compile the include/exclude regexes of the 'non-bids.file_filter' rule into a list of (include, regex)."""
+    compiled = []
+    for filter_ in filters or []:
+        for key,val in filter_.items():
+            if key in ('include','exclude'):
+                compiled.append((key == 'include',re.compile(val)))
+    return compiled
+
+def _walk(path,listing,submit,accept,descend):
+    """Yield the accepted files under path, bottom-up like os.walk(topdown=False)."""
+    dirs,files = listing()
+    if descend is not None:
+        dirs = [subdir for subdir in dirs if descend(subdir)]
+    # Request the listings of every subdirectory before descending into the first one,
+    # so that with a thread pool they are fetched while the previous ones are walked.
+    subdirs = [(subdir,submit(subdir)) for subdir in dirs]
+    for subdir,sublisting in subdirs:
+        yield from _walk(subdir,sublisting,submit,accept,descend)
+    for name in files:
+        filepath = accept(path,name)
+        if filepath is not None:
+            yield filepath
+
+def iter_files(root_path,extensions=None,filters=None,threads=None,descend=None):
+    """Recursively scan a directory, lazily yielding the full-paths of the files that pass the given checks.
+
+    The files are yielded in the same order as os.walk(root_path,topdown=False) would list them,
+    with '/' as separator. The checks are done in a single pass while scanning.
+
+    Parameters
+    ----------
+
+    root_path : str | pathlib.Path
+        The path we want to obtain the files from.
+    extensions : list of str | None, optional
+        The extensions (with the dot) of the files to yield. If None, files with any extension are yielded.
+    filters : list of dict | None, optional
+        Filters following the 'non-bids.file_filter' rule: dictionaries with an 'include' and/or
+        an 'exclude' regex. A file is yielded only if it matches every include and no exclude.
+    threads : int | None, optional
+        Number of threads listing directories concurrently, which hides the latency of network
+        filesystems. None or 1 lists them sequentially. The order of the files is the same in both cases.
+    descend : callable | None, optional
+        Function taking the path of a subdirectory and returning whether to scan it.
+        Subdirectories for which it returns False are skipped entirely. If None, every subdirectory is scanned.
+
+    Yields
+    ------
+
+    str :
+        The path to each file.
+    """
+    root_path = os.fspath(root_path)
+    extensions = None if extensions is None else frozenset(extensions)
+    filters = _compile_filters(filters)
+
+    def accept(path,name):
+        if extensions is not None and os.path.splitext(name)[1] not in extensions:
+            return None
+        filepath = os.path.join(path,name).replace('\\','/')
+        for include,regex in filters:
+            if (regex.search(filepath) is None) == include:
+                return None
+        return filepath
+
+    if threads is None or threads <= 1:
+        yield from _walk(root_path,partial(_scan_dir,root_path),lambda path: partial(_scan_dir,path),accept,descend)
+        return
+    pool = ThreadPoolExecutor(max_workers=threads)
+    try:
+        submit = lambda path: pool.submit(_scan_dir,path).result
+        yield from _walk(root_path,submit(root_path),submit,accept,descend)
+    finally:
+        pool.shutdown(wait=True,cancel_futures=True)
+
 def _get_files(root_path):
     """Recursively scan the directory for files, returning a list with the full-paths to each.
 
@@ -17,12 +128,60 @@ def _get_files(root_path):
     filepaths : list of str
         A list containing the path to each file in root_path.
     """
-    root_path = os.fspath(root_path)
-    filepaths = []
-    for root, dirs, files  in os.walk(root_path, topdown=False):
-        for name in files:
-            filepaths.append(os.path.join(root, name).replace('\\','/'))
-    return filepaths
+    return list(iter_files(root_path))
+
+def _reflink(src,dst):
+    """Clone src into dst sharing its data blocks, raising OSError if the filesystem can't."""
+    import fcntl # not available on windows, ImportError is handled by the caller
+    with open(src,'rb') as fin, open(dst,'wb') as fout:
+        try:
+            fcntl.ioctl(fout.fileno(),_FICLONE,fin.fileno())
+        except OSError:
+            fout.close()
+            os.remove(dst)
+            raise
+
+def transfer_file(src,dst,mode='copy'):
+    """Copy a file, or make dst share the data of src, replacing dst if it exists.
+
+    Parameters
+    ----------
+
+    src : str | pathlib.Path
+        The path of the file.
+    dst : str | pathlib.Path
+        The path of the new file.
+    mode : str, optional
+        'copy' copies the file.
+        'reflink' clones it (copy-on-write, ie btrfs or xfs), so no data is copied until one of them is modified.
+        'hardlink' makes dst another name of src, so modifying one modifies the other.
+        If the filesystem doesn't support the mode, the file is copied.
+
+    Returns
+    -------
+
+    str :
+        The mode actually used.
+    """
+    if mode not in COPY_MODES:
+        raise ValueError(f'Expected mode to be one of {COPY_MODES}, got {mode} instead')
+    src,dst = os.fspath(src),os.fspath(dst)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode == 'hardlink':
+        try:
+            os.link(src,dst)
+            return mode
+        except OSError: # ie different filesystems
+            LOGGER.debug(f'Could not hardlink {src} to {dst}, copying it instead.')
+    elif mode == 'reflink':
+        try:
+            _reflink(src,dst)
+            return mode
+        except (OSError,ImportError):
+            LOGGER.debug(f'Could not reflink {src} to {dst}, copying it instead.')
+    shutil.copyfile(src,dst)
+    return 'copy'
 
 def _write_yaml(dictionary,path=None):
     """Write a yaml file based on the dictionary to the specified path.
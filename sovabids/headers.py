@@ -0,0 +1,461 @@
+"""Module with header-only readers of the supported formats.
+
+Reading just the header of a recording gives what the mapping of a file needs
+(channels, sampling frequency, number of samples and datatype) without building
+a full MNE Raw object. Formats without a header reader fall back to MNE.
+
+Every reader returns a dictionary with the following keys:
+
+- ``filename`` : the path of the file that was read.
+- ``sfreq`` : the sampling frequency in Hz.
+- ``n_samples`` : the number of samples per channel.
+- ``ch_names`` : the channel names, as MNE would name them.
+- ``ch_types`` : the MNE channel types, as MNE would infer them.
+- ``datatype`` : the bids datatype inferred from the channel types, None if it cannot be inferred.
+- ``dtype`` : the format of the samples on disk (ie 'int16', 'int24', 'float32'), None if unknown.
+- ``reader`` : 'header' if the header was parsed natively, 'mne' if MNE was used,
+  'path' if the file was not opened at all (see :py:func:`path_header`).
+"""
+import os
+import re
+import configparser
+
+HEADER_READERS = {}
+"""Registry of header readers, keyed by the (lowercase) file extension."""
+
+_IEEG_TYPES = ('seeg','ecog','dbs')
+_MEG_TYPES = ('mag','grad')
+
+_PATH_DATATYPES = {'.con':'meg','.sqd':'meg','.fif':'meg','.pdf':'meg','.mefd':'ieeg','.nwb':'ieeg','.snirf':'nirs'}
+"""Datatype guessed from the extension of a file that is not opened, 'eeg' if not listed."""
+
+def register_header_reader(*extensions):
+    """Register a function as the header reader of the given extensions.
+
+    The function should take the path of the file and return the dictionary
+    described in this module. It may raise NotImplementedError for variants of
+    the format it can't parse, in which case MNE is used instead.
+
+    Parameters
+    ----------
+
+    *extensions : str
+        The extensions handled by the function, ie '.vhdr'.
+
+    Returns
+    -------
+
+    callable :
+        A decorator registering the function.
+    """
+    def decorator(func):
+        for ext in extensions:
+            HEADER_READERS[ext.lower()] = func
+        return func
+    return decorator
+
+def infer_datatype(ch_types):
+    """Infer the bids datatype from a list of MNE channel types.
+
+    Mirrors the inference done by mne-bids when writing a file.
+
+    Parameters
+    ----------
+
+    ch_types : list of str
+        The MNE channel types.
+
+    Returns
+    -------
+
+    str :
+        One of 'meg', 'eeg', 'ieeg', 'emg' or 'nirs'.
+    """
+    ch_types = set(ch_types)
+    datatypes = list()
+    if ch_types.intersection(_IEEG_TYPES):
+        datatypes.append('ieeg')
+    if ch_types.intersection(_MEG_TYPES):
+        datatypes.append('meg')
+    if 'eeg' in ch_types:
+        datatypes.append('eeg')
+    if 'emg' in ch_types:
+        datatypes.append('emg')
+    if 'fnirs_cw_amplitude' in ch_types:
+        datatypes.append('nirs')
+    if len(datatypes) == 0:
+        raise ValueError('No MEG, EEG, iEEG, EMG, or fNIRS channels found in data. '
+            'Please set the channel types of the data.')
+    if len(datatypes) == 1:
+        return datatypes[0]
+    if 'meg' in datatypes and 'ieeg' not in datatypes:
+        return 'meg'
+    if 'ieeg' in datatypes and 'meg' not in datatypes:
+        return 'ieeg'
+    raise ValueError(f'Multiple data types (``{datatypes}``) were found in the data.')
+
+def _header(fname,sfreq,n_samples,ch_names,ch_types,dtype,reader='header'):
+    try:
+        datatype = infer_datatype(ch_types)
+    except ValueError:
+        datatype = None
+    return {
+        'filename':fname,
+        'sfreq':float(sfreq),
+        'n_samples':int(n_samples),
+        'ch_names':list(ch_names),
+        'ch_types':list(ch_types),
+        'datatype':datatype,
+        'dtype':dtype,
+        'reader':reader,
+    }
+
+def _unique_names(names):
+    """Make the channel names unique the way MNE does, appending -0, -1... to the repeated ones."""
+    seen = {}
+    for name in names:
+        seen[name] = seen.get(name,0) + 1
+    counters = {}
+    unique = []
+    for name in names:
+        if seen[name] > 1:
+            unique.append(f'{name}-{counters.get(name,0)}')
+            counters[name] = counters.get(name,0) + 1
+        else:
+            unique.append(name)
+    return unique
+
+_BV_VERSION = re.compile(r"Brain ?Vision( Core| V-Amp)? Data( Exchange)? Header File,? Version [12]\.0")
+_BV_DTYPES = {'INT_16':'int16','INT_32':'int32','IEEE_FLOAT_32':'float32'}
+_BV_VOLTS = ('V','mV','µV','uV','nV')
+_BV_EOG = ('HEOGL','HEOGR','VEOGb')
+
+@register_header_reader('.vhdr')
+def _read_vhdr_header(fname):
+    """Read the header of a BrainVision file (.vhdr)."""
+    with open(fname,'rb') as f:
+        first_line = f.readline().decode('ascii','ignore').strip()
+        if not _BV_VERSION.search(first_line):
+            raise ValueError(f'{fname} is not a BrainVision header file, got {first_line!r}.')
+        content = f.read()
+    codepage = re.search('Codepage=(.+)',content.decode('ascii','ignore'))
+    codepage = codepage.group(1).strip() if codepage else 'utf-8'
+    codepage = 'cp1252' if codepage == 'ANSI' else codepage
+    try:
+        content = content.decode(codepage)
+    except UnicodeDecodeError:
+        content = content.decode('latin-1')
+    cfg = configparser.ConfigParser(interpolation=None)
+    cfg.read_string(content.split('[Comment]')[0])
+
+    info = 'Common Infos'
+    nchan = cfg.getint(info,'NumberOfChannels')
+    sfreq = 1e6 / cfg.getfloat(info,'SamplingInterval')
+    if cfg.get(info,'DataFormat',fallback='BINARY') != 'BINARY':
+        raise NotImplementedError('Only binary BrainVision files are read natively.')
+    dtype = _BV_DTYPES.get(cfg.get('Binary Infos','BinaryFormat'),None)
+    if dtype is None:
+        raise NotImplementedError(f"BinaryFormat {cfg.get('Binary Infos','BinaryFormat')} is not supported.")
+    if cfg.has_option(info,'DataPoints'):
+        n_samples = cfg.getint(info,'DataPoints')
+    else:
+        data_file = os.path.join(os.path.dirname(fname),cfg.get(info,'DataFile'))
+        n_samples = os.path.getsize(data_file) // (int(dtype[-2:])//8) // nchan
+
+    ch_names = [None]*nchan
+    ch_types = ['eeg']*nchan
+    for key,props in cfg.items('Channel Infos'):
+        n = int(re.findall(r'ch(\d+)',key)[0]) - 1
+        if n >= nchan:
+            continue
+        props = props.split(',')
+        name = props[0].replace(r'\1',',')
+        unit = props[3] if len(props) > 3 and props[3] != '' else 'µV'
+        unit = unit.replace('\xc2','')
+        ch_names[n] = name
+        if name in _BV_EOG:
+            ch_types[n] = 'eog'
+        elif unit not in _BV_VOLTS:
+            ch_types[n] = 'misc'
+    if None in ch_names:
+        raise NotImplementedError('Incomplete [Channel Infos] section.')
+    return _header(fname,sfreq,n_samples,ch_names,ch_types,dtype)
+
+_EDF_TAL = ('EDF Annotations','BDF Annotations')
+_EDF_STIM = ('status','trigger')
+
+def _parse_edf(fname):
+    """Parse the fixed and the per-channel fields of an EDF/BDF header."""
+    with open(fname,'rb') as f:
+        fixed = f.read(256)
+        if len(fixed) < 256:
+            raise ValueError(f'{fname} is too short to be an EDF/BDF file.')
+        nchan = int(fixed[252:256].decode('latin-1'))
+        variable = f.read(256*nchan)
+
+    def field(offset,size,i):
+        start = nchan*offset + i*size
+        return variable[start:start+size].decode('latin-1').strip()
+    # label, transducer, dimension, physical min/max, digital min/max, prefiltering, samples per record
+    return {
+        'bdf':fixed[:1] == b'\xff',
+        'header_bytes':int(fixed[184:192].decode('latin-1')),
+        'n_records':int(fixed[236:244].decode('latin-1')),
+        'duration':float(fixed[244:252].decode('latin-1')),
+        'labels':[field(0,16,i) for i in range(nchan)],
+        'dimensions':[field(16+80,8,i) for i in range(nchan)],
+        'physical':[(float(field(16+80+8,8,i)),float(field(16+80+8*2,8,i))) for i in range(nchan)],
+        'digital':[(float(field(16+80+8*3,8,i)),float(field(16+80+8*4,8,i))) for i in range(nchan)],
+        'samples_per_record':[int(field(16+80+8*5+80,8,i)) for i in range(nchan)],
+    }
+
+@register_header_reader('.edf','.bdf')
+def _read_edf_header(fname):
+    """Read the header of an EDF/EDF+ or BDF file."""
+    edf = _parse_edf(fname)
+    if edf['duration'] <= 0:
+        raise NotImplementedError('EDF/BDF files without a record duration are not read natively.')
+    labels,samples_per_record = edf['labels'],edf['samples_per_record']
+    n_records = edf['n_records']
+    bytes_per_sample = 3 if edf['bdf'] else 2
+    if n_records < 0: # unknown, deduce it from the size of the file
+        n_records = (os.path.getsize(fname)-edf['header_bytes']) // (sum(samples_per_record)*bytes_per_sample)
+
+    keep = [i for i in range(len(labels)) if labels[i] not in _EDF_TAL]
+    ch_names = _unique_names([labels[i] for i in keep])
+    ch_types = ['stim' if name.lower() in _EDF_STIM else 'eeg' for name in ch_names]
+    max_samples = max(samples_per_record[i] for i in keep) if keep else 0
+    sfreq = max_samples / edf['duration']
+    return _header(fname,sfreq,n_records*max_samples,ch_names,ch_types,'int24' if edf['bdf'] else 'int16')
+
+_EDF_VOLTS = {'V':1.,'mV':1e-3,'uV':1e-6,'µV':1e-6,'nV':1e-9}
+
+def read_edf_steps(fname):
+    """Read the value of one digital step of each channel of an EDF/BDF file.
+
+    The channels are the ones MNE reads (without the annotation channels), in the same order.
+    Voltages are given in V and every other unit as is, like the data MNE reads.
+
+    Parameters
+    ----------
+
+    fname : str | pathlib.Path
+        The path of the file.
+
+    Returns
+    -------
+
+    list of float | None :
+        The step of each channel. None for the channels whose physical values
+        are not a whole number of steps (ie the physical and digital ranges have an offset).
+    """
+    edf = _parse_edf(os.fspath(fname))
+    steps = []
+    for label,dimension,(pmin,pmax),(dmin,dmax) in zip(edf['labels'],edf['dimensions'],edf['physical'],edf['digital']):
+        if label in _EDF_TAL:
+            continue
+        if dmax == dmin:
+            steps.append(None)
+            continue
+        gain = (pmax-pmin)/(dmax-dmin)
+        offset = pmin - gain*dmin
+        step = gain*_EDF_VOLTS.get(dimension,1.)
+        steps.append(step if step != 0 and abs(offset) <= abs(gain)*1e-6 else None)
+    return steps
+
+def _mat_field(struct,key,default=None):
+    if isinstance(struct,dict):
+        return struct.get(key,default)
+    return getattr(struct,key,default)
+
+@register_header_reader('.set')
+def _read_set_header(fname):
+    """Read the header of an EEGLAB file (.set), without its data."""
+    from scipy.io import loadmat,whosmat
+    from mne.io import get_channel_type_constants
+    try:
+        variables = {name:kind for name,_,kind in whosmat(fname)}
+    except NotImplementedError: # matlab v7.3 (hdf5) files
+        raise NotImplementedError('Matlab v7.3 files are not read natively.')
+    if 'EEG' in variables:
+        # the fields of a struct can't be loaded apart, so only read it when the data is in a .fdt file
+        stem = os.path.splitext(fname)[0]
+        if not any(os.path.isfile(stem+ext) for ext in ('.fdt','.FDT')):
+            raise NotImplementedError('EEGLAB files with the data inside the EEG struct are not read natively.')
+        eeg = loadmat(fname,variable_names=['EEG'],squeeze_me=True,simplify_cells=True)['EEG']
+    else:
+        # fields saved as variables, load all but the data unless it is the name of the .fdt
+        names = ['srate','pnts','trials','nbchan','chanlocs']
+        if variables.get('data',None) == 'char':
+            names.append('data')
+        eeg = loadmat(fname,variable_names=[x for x in names if x in variables],squeeze_me=True,simplify_cells=True)
+
+    trials = int(_mat_field(eeg,'trials',1))
+    if trials != 1:
+        raise ValueError(f'The number of trials is {trials:d}. It must be 1 for raw files.')
+    nbchan = int(_mat_field(eeg,'nbchan'))
+    chanlocs = _mat_field(eeg,'chanlocs',[])
+    if isinstance(chanlocs,dict):
+        chanlocs = [chanlocs]
+    chanlocs = [x for x in chanlocs] if len(chanlocs) else []
+    if len(chanlocs) > 0:
+        known_types = get_channel_type_constants(include_defaults=True)
+        ch_names = [str(x.get('labels','')) for x in chanlocs]
+        ch_types = []
+        for chanloc in chanlocs:
+            ch_type = chanloc.get('type',None)
+            ch_type = ch_type.strip().lower() if isinstance(ch_type,str) else 'eeg'
+            ch_types.append(ch_type if ch_type in known_types and ch_type != 'meg' else 'eeg')
+    else:
+        ch_names = [f"EEG {ii:03d}" for ii in range(nbchan)]
+        ch_types = ['eeg']*nbchan
+    return _header(fname,_mat_field(eeg,'srate'),_mat_field(eeg,'pnts'),ch_names,ch_types,'float32')
+
+_MNE_DTYPES = {'short':'int16','int':'int32','single':'float32','double':'float64'}
+
+def header_from_raw(raw,fname=None):
+    """Build the header dictionary from an MNE Raw object.
+
+    Parameters
+    ----------
+
+    raw : mne.io.Raw
+        The raw object.
+    fname : str | None, optional
+        The path of the file read. If None, the first filename of the raw object.
+
+    Returns
+    -------
+
+    dict :
+        The header dictionary described in this module.
+    """
+    if fname is None:
+        fname = os.fspath(raw.filenames[0])
+    ch_types = raw.get_channel_types()
+    dtype = _MNE_DTYPES.get(getattr(raw,'orig_format',None),None)
+    return _header(fname,raw.info['sfreq'],raw.n_times,raw.ch_names,ch_types,dtype,reader='mne')
+
+def read_header(fname,fallback=True):
+    """Read the header of a recording, without reading its data.
+
+    Parameters
+    ----------
+
+    fname : str | pathlib.Path
+        The path of the file.
+    fallback : bool, optional
+        Whether to use MNE to read the file if there is no header reader for its format,
+        or if the reader cannot parse this particular file.
+
+    Returns
+    -------
+
+    dict :
+        The header dictionary described in this module.
+    """
+    fname = os.fspath(fname)
+    reader = HEADER_READERS.get(os.path.splitext(fname)[1].lower(),None)
+    if reader is not None:
+        try:
+            return reader(fname)
+        except NotImplementedError:
+            if not fallback:
+                raise
+    elif not fallback:
+        raise NotImplementedError(f'There is no header reader for {fname}.')
+    from mne.io import read_raw
+    return header_from_raw(read_raw(fname,preload=False,verbose=False),fname)
+
+def path_header(fname,ch_types=(),datatype=None):
+    """Build the header dictionary of a recording from its path alone, without opening it.
+
+    The channels, sampling frequency, number of samples and dtype are unknown (empty or None).
+    The datatype is, in order of preference, the one given, the one implied by
+    iEEG or MEG channel types (ie the types set by the rules), the one implied by the
+    extension (ie .fif or a file inside a .ds folder for MEG) or 'eeg'.
+
+    Parameters
+    ----------
+
+    fname : str | pathlib.Path
+        The path of the file.
+    ch_types : list of str, optional
+        The MNE channel types known for the file.
+    datatype : str | None, optional
+        The bids datatype of the file, if known.
+
+    Returns
+    -------
+
+    dict :
+        The header dictionary described in this module.
+    """
+    fname = os.fspath(fname)
+    if datatype is None:
+        ch_types = set(ch_types)
+        if ch_types.intersection(_IEEG_TYPES) or ch_types.intersection(_MEG_TYPES):
+            datatype = infer_datatype(ch_types)
+        elif '.ds' in os.path.dirname(fname):
+            datatype = 'meg'
+        else:
+            datatype = _PATH_DATATYPES.get(os.path.splitext(fname)[1].lower(),'eeg')
+    return {
+        'filename':fname,
+        'sfreq':None,
+        'n_samples':None,
+        'ch_names':[],
+        'ch_types':list(ch_types),
+        'datatype':datatype,
+        'dtype':None,
+        'reader':'path',
+    }
+
+def rename_header_channels(header,mapping):
+    """Rename the channels of a header dictionary in place, like mne's rename_channels.
+
+    Parameters
+    ----------
+
+    header : dict
+        The header dictionary.
+    mapping : dict
+        Old name -> new name.
+
+    Returns
+    -------
+
+    dict :
+        The header dictionary.
+    """
+    bad = [key for key in mapping if key not in header['ch_names']]
+    if bad:
+        raise ValueError(f'Invalid channel name(s) {bad} is not present in data')
+    header['ch_names'] = [mapping.get(name,name) for name in header['ch_names']]
+    if len(set(header['ch_names'])) != len(header['ch_names']):
+        raise ValueError('New channel names are not unique, renaming failed')
+    return header
+
+def set_header_channel_types(header,mapping):
+    """Set the channel types of a header dictionary in place, like mne's set_channel_types.
+
+    Parameters
+    ----------
+
+    header : dict
+        The header dictionary.
+    mapping : dict
+        Channel name -> MNE channel type.
+
+    Returns
+    -------
+
+    dict :
+        The header dictionary, with its datatype updated.
+    """
+    for name,ch_type in mapping.items():
+        if name not in header['ch_names']:
+            raise ValueError(f"This channel name ({name}) doesn't exist in info.")
+        header['ch_types'][header['ch_names'].index(name)] = ch_type
+    header['datatype'] = _header(header['filename'],header['sfreq'],header['n_samples'],[],header['ch_types'],None)['datatype']
+    return header
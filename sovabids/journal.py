@@ -0,0 +1,141 @@
+"""Module with the journal of the conversions done by convert_them."""
+import os
+import json
+import time
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+STATES = ('pending','running','done','failed')
+"""States of a file in the journal."""
+
+class ConversionJournal:
+    """Persistent record of the state of each file of a conversion.
+
+    The journal is a json-lines file with one entry per change of state of a file:
+    ``{'source','target','state','started','seconds','error'}``, plus the provenance
+    of the converted files (see :py:meth:`mark`). Entries are appended
+    and flushed as they happen, so after a crash the last entry of each file tells
+    whether it was converted. :py:meth:`save` rewrites the file keeping only the
+    last entry of each file. It can be shared between the threads of a process.
+
+    Parameters
+    ----------
+
+    path : str | pathlib.Path
+        The path of the journal file.
+
+    Attributes
+    ----------
+
+    entries : dict
+        Source path -> last entry of the file.
+    """
+    def __init__(self,path):
+        self.path = os.fspath(path)
+        self.entries = {}
+        self._started = {} # source -> time.time() of the current run
+        self._file = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path,encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError: # ie a line cut by a crash
+                        continue
+                    self.entries[entry['source']] = entry
+        except (OSError,KeyError):
+            LOGGER.warning(f'Could not read the conversion journal {self.path}, ignoring it.',exc_info=True)
+            self.entries = {}
+
+    def state(self,source,target=None):
+        """Get the last state of a file.
+
+        Parameters
+        ----------
+
+        source : str
+            The path of the source file.
+        target : str | None, optional
+            If given, the state is only returned if the file was converted to this target.
+
+        Returns
+        -------
+
+        str | None :
+            One of STATES, None if the file is not in the journal.
+        """
+        entry = self.entries.get(source,None)
+        if entry is None or (target is not None and entry.get('target',None) != target):
+            return None
+        return entry['state']
+
+    def mark(self,source,target,state,error=None,**provenance):
+        """Record the new state of a file, appending it to the journal file.
+
+        Parameters
+        ----------
+
+        source : str
+            The path of the source file.
+        target : str
+            The path of the bids file it is converted to.
+        state : str
+            One of STATES. The time spent by the file is measured from when it was marked as running.
+        error : str | None, optional
+            The error of a failed file.
+        **provenance :
+            What the file was converted from, stored as is in the entry
+            (ie the ``key`` and ``hash`` of the source and the ``mapping`` fingerprint).
+        """
+        if state not in STATES:
+            raise ValueError(f'Expected state to be one of {STATES}, got {state} instead')
+        with self._lock:
+            self._mark(source,target,state,error,provenance)
+
+    def _mark(self,source,target,state,error,provenance):
+        now = time.time()
+        if state == 'running':
+            self._started[source] = now
+        started = self._started.get(source,None)
+        entry = {'source':source,'target':target,'state':state,'started':started,
+                 'seconds':None if started is None or state in ('pending','running') else round(now-started,6),
+                 'error':error}
+        entry.update(provenance)
+        self.entries[source] = entry
+        try:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or '.',exist_ok=True)
+                self._file = open(self.path,'a',encoding='utf-8')
+            self._file.write(json.dumps(entry,ensure_ascii=False,default=str)+'\n')
+            self._file.flush()
+        except OSError:
+            LOGGER.warning(f'Could not write to the conversion journal {self.path}',exc_info=True)
+
+    def save(self):
+        """Rewrite the journal file with only the last entry of each file."""
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if not self.entries:
+            return
+        tmp_path = self.path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.',exist_ok=True)
+            with open(tmp_path,'w',encoding='utf-8') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry,ensure_ascii=False,default=str)+'\n')
+            os.replace(tmp_path,self.path)
+        except OSError:
+            LOGGER.warning(f'Could not write the conversion journal {self.path}',exc_info=True)
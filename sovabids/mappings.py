@@ -0,0 +1,526 @@
+"""Module dealing with the storage of the mappings files.
+
+Two formats are supported, chosen by the extension of the file:
+
+- YAML (.yml, .yaml), the default, meant to be read and edited by humans.
+- JSON Lines (.jsonl), meant for big datasets. The first line holds the General
+  section and every other line one Individual mapping. A binary index with the
+  offset of each line (the same path plus '.idx') allows random access, so the
+  Individual mappings can be read lazily without parsing the whole file.
+
+In both formats the Individual mappings may be delta-encoded: instead of a full
+copy of the rules, each entry holds only what differs from the General section
+(see :py:func:`compress_mapping`). Such entries carry a ``Delta`` key and are
+expanded transparently when the mappings are loaded.
+"""
+import os
+import json
+from array import array
+from collections.abc import Sequence
+
+import yaml
+
+from sovabids.dicts import copy_tree
+
+JSONL_EXTENSIONS = ('.jsonl',)
+"""Extensions of the mappings files stored as JSON Lines."""
+
+_YAML_LOADER = getattr(yaml,'CFullLoader',yaml.FullLoader) # libyaml is much faster, if available
+
+def is_jsonl(path):
+    """Whether a mappings file path is (or should be) stored as JSON Lines, given its extension.
+
+    Parameters
+    ----------
+
+    path : str | pathlib.Path
+        The path of the mappings file.
+
+    Returns
+    -------
+
+    bool
+    """
+    return os.path.splitext(os.fspath(path))[1].lower() in JSONL_EXTENSIONS
+
+DELTA_KEY = 'Delta'
+"""Key marking a delta-encoded Individual mapping, holding the keys removed from the base."""
+
+_BASE_EXCLUDED = ('IO',)
+"""Sections of General that are not part of the base of the delta-encoded mappings."""
+
+def _delta_base(general):
+    return {key:value for key,value in general.items() if key not in _BASE_EXCLUDED}
+
+def _diff(base,target,path,removed):
+    """Get what changes base into target, appending the paths of the removed keys to `removed`."""
+    delta = {}
+    for key,value in target.items():
+        if key not in base:
+            delta[key] = value
+        elif isinstance(value,dict) and isinstance(base[key],dict):
+            sub_delta = _diff(base[key],value,path+[key],removed)
+            if sub_delta:
+                delta[key] = sub_delta
+        elif value != base[key] or type(value) is not type(base[key]):
+            delta[key] = value
+    for key in base:
+        if key not in target:
+            removed.append(path+[key])
+    return delta
+
+def _patch(base,delta):
+    """Apply a delta to a copy of base (in place for the dictionaries already copied)."""
+    for key,value in delta.items():
+        if isinstance(value,dict) and isinstance(base.get(key,None),dict):
+            _patch(base[key],value)
+        else:
+            base[key] = copy_tree(value)
+
+def is_delta(mapping):
+    """Whether an Individual mapping is delta-encoded.
+
+    Parameters
+    ----------
+
+    mapping : dict
+        The Individual mapping.
+
+    Returns
+    -------
+
+    bool
+    """
+    return isinstance(mapping,dict) and DELTA_KEY in mapping
+
+def compress_mapping(mapping,general):
+    """Delta-encode an Individual mapping relative to the General section.
+
+    Parameters
+    ----------
+
+    mapping : dict
+        The (expanded) Individual mapping.
+    general : dict
+        The General section of the mappings.
+
+    Returns
+    -------
+
+    dict :
+        The mapping with only the keys that differ from General (the IO section is
+        always kept whole), plus ``{'Delta': {'removed': [...]}}`` with the key paths
+        of General that are absent in the mapping.
+    """
+    if is_delta(mapping):
+        return mapping
+    removed = []
+    delta = _diff(_delta_base(general),mapping,[],removed)
+    for key in _BASE_EXCLUDED:
+        if key in mapping:
+            delta[key] = mapping[key]
+    delta[DELTA_KEY] = {'removed':removed}
+    return delta
+
+def expand_mapping(mapping,general):
+    """Expand an Individual mapping that may be delta-encoded relative to the General section.
+
+    Parameters
+    ----------
+
+    mapping : dict
+        The Individual mapping, delta-encoded or not.
+    general : dict
+        The General section of the mappings.
+
+    Returns
+    -------
+
+    dict :
+        The full Individual mapping. Mappings that are not delta-encoded are returned as they are.
+    """
+    if not is_delta(mapping):
+        return mapping
+    expanded = copy_tree(_delta_base(general))
+    for keys in mapping[DELTA_KEY].get('removed',None) or []:
+        parent = expanded
+        for key in keys[:-1]:
+            parent = parent.get(key,None) if isinstance(parent,dict) else None
+        if isinstance(parent,dict):
+            parent.pop(keys[-1],None)
+    _patch(expanded,{key:value for key,value in mapping.items() if key != DELTA_KEY})
+    return expanded
+
+def _index_path(path):
+    return os.fspath(path) + '.idx'
+
+class MappingsWriter:
+    """Write a mappings file incrementally, one individual mapping at a time.
+
+    The General section is written when the writer is created and every
+    individual mapping is appended (and flushed) as soon as it is given,
+    so the file on disk always holds the mappings computed so far and
+    the memory used does not grow with the number of files.
+
+    The resulting file is the same yaml document that dumping the whole
+    ``{'General':...,'Individual':[...]}`` dictionary at once produces.
+
+    Can be used as a context manager.
+
+    Parameters
+    ----------
+
+    path : str | pathlib.Path
+        The path of the mappings file. Its folder is created if needed.
+    general : dict
+        The General section of the mappings.
+    delta : bool, optional
+        Whether to delta-encode the individual mappings relative to General (see :py:func:`compress_mapping`).
+
+    Attributes
+    ----------
+
+    count : int
+        Number of individual mappings written so far.
+    """
+    def __init__(self,path,general,delta=False):
+        self.path = os.fspath(path)
+        self.general = general
+        self.delta = delta
+        self.count = 0
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder,exist_ok=True)
+        self._file = open(self.path,'w',encoding='utf-8')
+        self._file.write(yaml.dump({'General':general},default_flow_style=False))
+        self._file.flush()
+
+    def write(self,mapping):
+        """Append an individual mapping to the file.
+
+        Parameters
+        ----------
+
+        mapping : dict
+            The individual mapping of a file.
+        """
+        if self.delta:
+            mapping = compress_mapping(mapping,self.general)
+        if self.count == 0:
+            self._file.write('Individual:\n')
+        self._file.write(yaml.dump([mapping],default_flow_style=False))
+        self._file.flush()
+        self.count += 1
+
+    def close(self):
+        """Finish the document and close the file."""
+        if self._file is None:
+            return
+        if self.count == 0:
+            self._file.write('Individual: []\n')
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+
+class JsonlMappingsWriter:
+    """Write a JSON Lines mappings file incrementally, along with its index.
+
+    Has the same interface as :py:class:`MappingsWriter`.
+
+    Parameters
+    ----------
+
+    path : str | pathlib.Path
+        The path of the mappings file. Its folder is created if needed.
+    general : dict
+        The General section of the mappings.
+    delta : bool, optional
+        Whether to delta-encode the individual mappings relative to General (see :py:func:`compress_mapping`).
+
+    Attributes
+    ----------
+
+    count : int
+        Number of individual mappings written so far.
+    """
+    def __init__(self,path,general,delta=False):
+        self.path = os.fspath(path)
+        self.general = general
+        self.delta = delta
+        self.count = 0
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder,exist_ok=True)
+        self._file = open(self.path,'wb')
+        self._index = open(_index_path(self.path),'wb')
+        self._write_line({'General':general})
+        self._file.flush()
+
+    def _write_line(self,obj):
+        self._file.write(json.dumps(obj,ensure_ascii=False,default=str).encode('utf-8') + b'\n')
+
+    def write(self,mapping):
+        """Append an individual mapping to the file and its offset to the index.
+
+        Parameters
+        ----------
+
+        mapping : dict
+            The individual mapping of a file.
+        """
+        if self.delta:
+            mapping = compress_mapping(mapping,self.general)
+        offset = self._file.tell()
+        self._write_line(mapping)
+        self._file.flush()
+        self._index.write(array('Q',[offset]).tobytes())
+        self._index.flush()
+        self.count += 1
+
+    def close(self):
+        """Close the file and its index."""
+        if self._file is None:
+            return
+        self._file.close()
+        self._index.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+def get_mappings_writer(path,general,delta=False):
+    """Get the incremental writer for a mappings file, according to its extension.
+
+    Parameters
+    ----------
+
+    path : str | pathlib.Path
+        The path of the mappings file.
+    general : dict
+        The General section of the mappings.
+    delta : bool, optional
+        Whether to delta-encode the individual mappings relative to General.
+
+    Returns
+    -------
+
+    MappingsWriter | JsonlMappingsWriter :
+        The writer.
+    """
+    if is_jsonl(path):
+        return JsonlMappingsWriter(path,general,delta=delta)
+    return MappingsWriter(path,general,delta=delta)
+
+class Mappings(Sequence):
+    """The mappings of a conversion: the General section and a sequence of Individual mappings.
+
+    The object itself is the (read-only) sequence of Individual mappings.
+    Delta-encoded mappings are expanded when accessed.
+
+    Parameters
+    ----------
+
+    general : dict
+        The General section.
+    individual : list of dict
+        The Individual mappings.
+
+    Attributes
+    ----------
+
+    general : dict
+        The General section.
+    """
+    def __init__(self,general,individual):
+        self.general = general
+        self._individual = individual
+
+    def __len__(self):
+        return len(self._individual)
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            return [expand_mapping(mapping,self.general) for mapping in self._individual[index]]
+        return expand_mapping(self._individual[index],self.general)
+
+    def to_dict(self):
+        """Get the mappings as a dictionary, with the Individual mappings expanded.
+
+        Returns
+        -------
+
+        dict :
+            {'General': dict, 'Individual': list of dict}
+        """
+        return {'General':self.general,'Individual':list(self)}
+
+class JsonlMappings(Mappings):
+    """Lazy view of a JSON Lines mappings file.
+
+    Only the General section and the offsets of the Individual mappings are kept
+    in memory; each mapping is parsed when accessed. Iterating reads the file
+    sequentially.
+
+    Parameters
+    ----------
+
+    path : str | pathlib.Path
+        The path of the mappings file.
+    """
+    def __init__(self,path):
+        self.path = os.fspath(path)
+        with open(self.path,'rb') as f:
+            first = f.readline()
+            self.general = json.loads(first)['General']
+            self._offsets = self._read_index(len(first))
+
+    def _read_index(self,start):
+        """Read the offsets from the index, or rebuild them if the index is missing or outdated.
+
+        A partial last line, left by a crash while it was written, is not indexed.
+        """
+        size = os.path.getsize(self.path)
+        index = _index_path(self.path)
+        offsets = array('Q')
+        if os.path.isfile(index) and os.path.getmtime(index) >= os.path.getmtime(self.path):
+            with open(index,'rb') as f:
+                offsets.frombytes(f.read())
+            if all(offset < size for offset in offsets[-1:]):
+                return offsets
+            offsets = array('Q')
+        with open(self.path,'rb') as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                # a last line without its newline was cut by a crash while it was written
+                if line.strip() and line.endswith(b'\n'):
+                    offsets.append(offset)
+                offset += len(line)
+        return offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _read_at(self,f,offset):
+        f.seek(offset)
+        return expand_mapping(json.loads(f.readline()),self.general)
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            with open(self.path,'rb') as f:
+                return [self._read_at(f,offset) for offset in self._offsets[index]]
+        with open(self.path,'rb') as f:
+            return self._read_at(f,self._offsets[index])
+
+    def __iter__(self):
+        with open(self.path,'rb') as f:
+            for offset in self._offsets:
+                yield self._read_at(f,offset)
+
+def load_mappings(mappings):
+    """Load the mappings of a conversion.
+
+    Parameters
+    ----------
+
+    mappings : str | pathlib.Path | dict | Mappings
+        The path to the mappings file (YAML or JSON Lines, by extension), the mappings
+        dictionary ({'General':...,'Individual':[...]}) or an already loaded Mappings.
+
+    Returns
+    -------
+
+    Mappings :
+        The mappings. JSON Lines files are read lazily.
+    """
+    if isinstance(mappings,Mappings):
+        return mappings
+    if isinstance(mappings,os.PathLike):
+        mappings = os.fspath(mappings)
+    if isinstance(mappings,str):
+        if is_jsonl(mappings):
+            return JsonlMappings(mappings)
+        try:
+            with open(mappings,encoding='utf-8') as f:
+                mappings = yaml.load(f,_YAML_LOADER)
+        except Exception as exc:
+            raise IOError(f"Couldnt read {mappings} file as a mappings file: {exc}") from exc
+    if not isinstance(mappings,dict):
+        raise ValueError(f'Expected str or dict as mappings, got {type(mappings)} instead.')
+    assert 'Individual' in mappings,f'`Individual` does not exist in the mapping dictionary'
+    assert 'General' in mappings,f'`General` does not exist in the mapping dictionary'
+    return Mappings(mappings['General'],mappings['Individual'] or [])
+
+def expand_mappings(mappings):
+    """Expand the delta-encoded Individual mappings of a whole set of mappings.
+
+    Parameters
+    ----------
+
+    mappings : str | pathlib.Path | dict | Mappings
+        The mappings, see :py:func:`load_mappings`.
+
+    Returns
+    -------
+
+    dict :
+        {'General': dict, 'Individual': list of expanded mappings}
+    """
+    return load_mappings(mappings).to_dict()
+
+def compress_mappings(mappings):
+    """Delta-encode the Individual mappings of a whole set of mappings relative to their General section.
+
+    Parameters
+    ----------
+
+    mappings : str | pathlib.Path | dict | Mappings
+        The mappings, see :py:func:`load_mappings`.
+
+    Returns
+    -------
+
+    dict :
+        {'General': dict, 'Individual': list of delta-encoded mappings}
+    """
+    mappings = load_mappings(mappings)
+    return {'General':mappings.general,'Individual':[compress_mapping(mapping,mappings.general) for mapping in mappings]}
+
+def save_mappings(mappings,path,delta=False):
+    """Save a set of mappings to a file, streaming the Individual mappings.
+
+    Can be used to convert between the formats (by the extension of the path) and
+    between the expanded and the delta-encoded layouts.
+
+    Parameters
+    ----------
+
+    mappings : str | pathlib.Path | dict | Mappings
+        The mappings, see :py:func:`load_mappings`.
+    path : str | pathlib.Path
+        The path of the mappings file to write. If it ends in .jsonl it is written as JSON Lines, otherwise as YAML.
+    delta : bool, optional
+        Whether to delta-encode the Individual mappings, if False they are written expanded.
+
+    Returns
+    -------
+
+    str :
+        The path of the file written.
+    """
+    mappings = load_mappings(mappings)
+    if isinstance(mappings,JsonlMappings) and os.path.abspath(mappings.path) == os.path.abspath(os.fspath(path)):
+        mappings = Mappings(mappings.general,list(mappings)) # read it all before overwriting it
+    with get_mappings_writer(path,mappings.general,delta=delta) as writer:
+        for mapping in mappings:
+            writer.write(mapping)
+    return writer.path
@@ -93,3 +93,33 @@ def get_num_digits(N):
     return int(np.log10(N))+1
 
 
+_SIZE_UNITS = {'':1,'B':1,'K':2**10,'M':2**20,'G':2**30,'T':2**40}
+
+def parse_size(size):
+    """Parse a size in bytes given with an optional binary unit suffix, ie '512M', '8G' or '1.5T'.
+
+    Parameters
+    ----------
+    size : str | int | float
+        The size. Numbers are taken as bytes; the suffix may be followed by 'B' or 'iB' ('8GB', '8GiB').
+
+    Returns
+    -------
+    int :
+        The number of bytes.
+    """
+    if isinstance(size,(int,float)):
+        return int(size)
+    string = size.strip().upper()
+    for suffix in ('IB','B'):
+        if string.endswith(suffix) and len(string) > len(suffix) and string[-len(suffix)-1] in _SIZE_UNITS:
+            string = string[:-len(suffix)]
+            break
+    unit = string[-1:] if string[-1:] in _SIZE_UNITS else ''
+    try:
+        value = float(string[:len(string)-len(unit)])
+    except ValueError:
+        raise ValueError(f'Could not parse the size {size!r}, expected a number of bytes optionally followed by K, M, G or T') from None
+    if value < 0:
+        raise ValueError(f'Expected a positive size, got {size!r}')
+    return int(value*_SIZE_UNITS[unit])
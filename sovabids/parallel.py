@@ -0,0 +1,250 @@
+"""Module with process-pool utilities for parallel mapping and conversion."""
+import os
+import time
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+from concurrent.futures import ProcessPoolExecutor
+from traceback import format_exc
+
+LOGGER = logging.getLogger(__name__)
+
+_WORKER_STATE = {}
+"""Per-process state set once by the pool initializer (ie the rules of the run)."""
+
+def resolve_jobs(jobs):
+    """Translate a user given number of jobs to an effective number of worker processes.
+
+    Parameters
+    ----------
+
+    jobs : int | None
+        The number of jobs requested. None or 1 means serial execution,
+        0 or a negative number means one job per available cpu.
+
+    Returns
+    -------
+
+    int :
+        The effective number of jobs, always >= 1.
+    """
+    if jobs is None:
+        return 1
+    jobs = int(jobs)
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+    return max(jobs,1)
+
+def _init_worker(state):
+    """Warm up a worker process.
+
+    Imports MNE and MNE-BIDS once so that each task does not pay for it,
+    and stores the state shared by all the tasks of the run.
+
+    Parameters
+    ----------
+
+    state : dict
+        The state shared by every task of the worker.
+    """
+    import mne # noqa: F401
+    import mne_bids # noqa: F401
+    _WORKER_STATE.clear()
+    _WORKER_STATE.update(state)
+
+def get_worker_state():
+    """Get the state set by the pool initializer of the current worker process.
+
+    Returns
+    -------
+
+    dict :
+        The state given to :py:func:`get_pool`.
+    """
+    return _WORKER_STATE
+
+def get_pool(jobs,state=None):
+    """Get a process pool of warm workers.
+
+    Parameters
+    ----------
+
+    jobs : int
+        The number of worker processes.
+    state : dict, optional
+        State shared by all the tasks, sent once to each worker.
+        Inside the tasks it is available through :py:func:`get_worker_state`.
+
+    Returns
+    -------
+
+    concurrent.futures.ProcessPoolExecutor :
+        The pool of workers.
+    """
+    return ProcessPoolExecutor(max_workers=jobs,initializer=_init_worker,initargs=(state or {},))
+
+def call_safely(func,*args,**kwargs):
+    """Call a function returning its result and a traceback string instead of raising.
+
+    Parameters
+    ----------
+
+    func : callable
+        The function to call.
+
+    Returns
+    -------
+
+    tuple :
+        (result, None) if the call succeeded, (None, traceback string) otherwise.
+    """
+    try:
+        return func(*args,**kwargs),None
+    except Exception:
+        return None,format_exc()
+
+def _isolated_target(conn,func,args):
+    """Run a task inside its own process, sending back (result, traceback string)."""
+    result,error = call_safely(func,*args)
+    try:
+        conn.send((result,error))
+    except Exception:
+        conn.send((None,format_exc()))
+    finally:
+        conn.close()
+
+def lpt_order(costs):
+    """Order the tasks longest-processing-time first.
+
+    Parameters
+    ----------
+
+    costs : list of tuple
+        The (memory, work) estimated for each task, in any units.
+
+    Returns
+    -------
+
+    list of int :
+        The indexes of the tasks, the ones with the most work first.
+    """
+    return sorted(range(len(costs)),key=lambda i:costs[i][1],reverse=True)
+
+def run_isolated(func,tasks,jobs,timeout=None,costs=None,max_memory=None):
+    """Run each task in its own process, with at most `jobs` of them at the same time.
+
+    A task that crashes its process (ie a segfault in a reader) or that exceeds the
+    timeout only fails itself; the rest of the tasks are unaffected.
+
+    Parameters
+    ----------
+
+    func : callable
+        The function to run. Should be importable (defined at the top-level of a module).
+    tasks : iterable of tuple
+        The positional arguments of each call to `func`. Consumed lazily, as processes are started.
+        With `costs` it must be a sequence, indexed as each task is started.
+    jobs : int
+        The maximum number of processes running at the same time.
+    timeout : float | None, optional
+        Maximum number of seconds a single task may run before its process is killed.
+        None means no limit.
+    costs : list of tuple | None, optional
+        The (memory in bytes, work) estimated for each task. If given the tasks are started
+        longest-processing-time first (see :py:func:`lpt_order`) instead of in order.
+    max_memory : int | None, optional
+        With `costs`, the maximum memory of the tasks running at the same time. A task is only started
+        while it fits in what the running ones leave free, the largest one that fits first. A task
+        that doesn't fit even alone is run by itself. None means no limit.
+
+    Yields
+    ------
+
+    tuple :
+        (index of the task, result, traceback string or None) as each task finishes.
+    """
+    ctx = multiprocessing.get_context()
+    if costs is None:
+        pending = enumerate(tasks)
+        waiting = None
+    else:
+        waiting = lpt_order(costs)
+    exhausted = False
+    running = {} # receiving connection -> (index, process, start time)
+    used_memory = 0
+
+    def next_task():
+        # the next (index, args) to start, None if none can be started now, StopIteration if there are no more
+        if waiting is None:
+            return next(pending)
+        if not waiting:
+            raise StopIteration
+        for k,i in enumerate(waiting):
+            if max_memory is None or used_memory+costs[i][0] <= max_memory:
+                break
+        else:
+            if running:
+                return None
+            k,i = 0,waiting[0]
+            LOGGER.warning(f'Task {i} is estimated to need {costs[i][0]} bytes, more than the memory budget of {max_memory}, running it alone')
+        del waiting[k]
+        return i,tasks[i]
+
+    try:
+        while not exhausted or running:
+            while not exhausted and len(running) < jobs:
+                try:
+                    task = next_task()
+                except StopIteration:
+                    exhausted = True
+                    break
+                if task is None: # wait for some memory to be freed
+                    break
+                i,args = task
+                recv_conn,send_conn = ctx.Pipe(duplex=False)
+                proc = ctx.Process(target=_isolated_target,args=(send_conn,func,args))
+                proc.start()
+                send_conn.close() # so that a dead child is seen as an EOF on recv_conn
+                running[recv_conn] = (i,proc,time.monotonic())
+                if costs is not None:
+                    used_memory += costs[i][0]
+
+            if not running:
+                break
+            wait_time = None
+            if timeout is not None:
+                oldest = min(start for _,_,start in running.values())
+                wait_time = max(0,oldest+timeout-time.monotonic())
+
+            finished = []
+            for conn in wait(list(running),timeout=wait_time):
+                i,proc,_ = running.pop(conn)
+                try:
+                    result,error = conn.recv()
+                except EOFError:
+                    proc.join()
+                    result,error = None,f'Worker process died with exit code {proc.exitcode}'
+                conn.close()
+                proc.join()
+                finished.append((i,result,error))
+
+            if timeout is not None:
+                now = time.monotonic()
+                for conn,(i,proc,start) in list(running.items()):
+                    if now-start >= timeout:
+                        running.pop(conn)
+                        proc.kill()
+                        proc.join()
+                        conn.close()
+                        finished.append((i,None,f'Worker process timed out after {timeout} seconds'))
+
+            for i,result,error in finished:
+                if costs is not None:
+                    used_memory -= costs[i][0]
+                yield i,result,error
+    finally:
+        # Only reached with running processes if the caller stopped iterating early
+        for conn,(i,proc,_) in running.items():
+            proc.kill()
+            proc.join()
+            conn.close()
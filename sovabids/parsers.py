@@ -4,7 +4,7 @@ import re
 from copy import deepcopy
 
 from sovabids.misc import flat_paren_counter
-from sovabids.dicts import deep_merge_N,nested_notation_to_tree
+from sovabids.dicts import deep_update,nested_notation_to_tree
 
 def placeholder_to_regex(placeholder,encloser='%',matcher='(.+)'):
     """Translate a placeholder pattern to a regex pattern.
@@ -38,6 +38,36 @@ def placeholder_to_regex(placeholder,encloser='%',matcher='(.+)'):
     pattern = pattern.replace('/','\\/')
     return pattern,fields
 
+def placeholder_to_level_regexes(placeholder,encloser='%',matcher='(.+)'):
+    """Translate the folders of a placeholder pattern to one regex per folder level.
+
+    Parameters
+    ----------
+    placeholder : str
+        The placeholder pattern to translate.
+    encloser : str, optional
+        The symbol which encloses the fields of the placeholder pattern.
+    matcher : str, optional
+        The regex pattern to use for the placeholder, ie : (.*?),(.*),(.+).
+
+    Returns
+    -------
+
+    list of re.Pattern | None :
+        The compiled regexes, to be fullmatched against a single folder name, from the first
+        folder of the pattern to the folder of the file (the filename is not included).
+        As the pattern is searched anywhere in the path, the first one may match just the end
+        of a folder name. None if some folder has an unbalanced encloser.
+    """
+    levels = placeholder.replace('\\','/').split('/')[:-1]
+    regexes = []
+    for i,level in enumerate(levels):
+        if level.count(encloser) % 2 != 0:
+            return None
+        regex = matcher.join(level.split(encloser)[::2])
+        regexes.append(re.compile(('.*' if i == 0 else '') + regex))
+    return regexes
+
 def parse_from_placeholder(string,pattern,encloser='%',matcher='(.+)'):
     """Parse string from a placeholder pattern.
 
@@ -102,18 +132,35 @@ def parse_from_regex(string,pattern,fields,invalid_replace=''):
 
     if not num_groups == len(match.groups()):
         return {}
-    
-    l = []
-    
-    for field,value in zip(fields,list(match.groups())):
+
+    return _fields_from_match(match,fields,invalid_replace)
+
+def _fields_from_match(match,fields,invalid_replace=''):
+    """Build the dictionary of fields from the groups of a regex match.
+
+    Parameters
+    ----------
+    match : re.Match
+        The match of the regex pattern, with as many groups as fields.
+    fields : list of str
+        List of fields in the same order as they appear in the regex pattern.
+    invalid_replace: str
+        String that will replace '-' and '_' that appear on extracted fields.
+
+    Returns
+    -------
+
+    dict
+        The dictionary with the fields and values requested.
+    """
+    d = {}
+    for field,value in zip(fields,match.groups()):
         if field != 'ignore' and ('_' in value or '-' in value):
-            value2 = value.replace('_',invalid_replace)
-            value2 = value2.replace('-',invalid_replace)
-            d = nested_notation_to_tree(field,value2)
-        else:
-            d = nested_notation_to_tree(field,value)        
-        l.append(d)
-    return deep_merge_N(l)
+            value = value.replace('_',invalid_replace)
+            value = value.replace('-',invalid_replace)
+        # the trees are new objects, so they can be merged in place
+        deep_update(d,nested_notation_to_tree(field,value))
+    return d
 
 def parse_entity_from_bidspath(path,entity,mode='r2l'):
     """Get the value of a bids-entity from a path.
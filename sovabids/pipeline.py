@@ -0,0 +1,314 @@
+"""Module with the fused pipeline that maps and converts each file in a single pass.
+
+``sovapply`` followed by ``sovaconvert`` reads every file twice: once to map it and once to convert it.
+:py:func:`apply_and_convert` maps each file while converting it instead, so each one is opened once,
+and the stages overlap:
+
+- scanning the source folder, which feeds the files found to the next stage,
+- mapping and converting each file (in worker processes with ``jobs`` > 1),
+- moving the converted files into the bids directory and writing the mappings file.
+
+Serially the stages run in their own threads, connected by bounded queues. With worker
+processes the main thread scans and merges while the workers convert, with at most ``jobs``
+files in flight. The mappings file is still written (in the order of the files), as a record of the run.
+"""
+import os
+import sys
+import queue
+import shutil
+import logging
+import argparse
+import threading
+from traceback import format_exc
+
+from sovabids.dicts import deep_get
+from sovabids.rules import CompiledRules,load_rules,iter_source_files,apply_rules_to_single_file,_expand_path
+from sovabids.bids import update_dataset_description,merge_bids_tree
+from sovabids.cache import MappingCache,rules_fingerprint,mapping_fingerprint,source_key,content_hash
+from sovabids.convert import _already_converted
+from sovabids.journal import ConversionJournal
+from sovabids.mappings import get_mappings_writer
+from sovabids.parallel import resolve_jobs,run_isolated
+from sovabids.loggers import setup_logging
+from sovabids.settings import SECTION_STRING
+from sovabids.streaming import DEFAULT_CHUNK_SIZE
+from sovabids.files import COPY_MODES
+
+LOGGER = logging.getLogger(__name__)
+
+QUEUE_SIZE = 64
+"""Default number of items each queue between the stages may hold."""
+
+_DONE = object()
+"""Marks the end of the items of a queue."""
+
+def _apply_and_convert_file(file,rules,staging_path,chunk_size=DEFAULT_CHUNK_SIZE,copy_mode=None,native_dtype=True):
+    """Map a file and convert it into its own staging bids tree, returning its mapping. Runs in a worker process with jobs > 1."""
+    mapping,_ = apply_rules_to_single_file(file,rules,staging_path,write=True,persist=False,chunk_size=chunk_size,copy_mode=copy_mode,native_dtype=native_dtype)
+    return mapping
+
+def _threaded(iterable,maxsize):
+    """Iterate over an iterable in a thread, through a bounded queue, so it runs ahead of the consumer.
+
+    If the consumer stops early (ie it raised or closed the generator) the producer is stopped,
+    the iterable is closed and the thread is joined before returning.
+    """
+    items = queue.Queue(maxsize)
+    failure = []
+    stop = threading.Event()
+    def put(item):
+        # wait for room in the queue unless the consumer is gone
+        while not stop.is_set():
+            try:
+                items.put(item,timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+        except BaseException as exc:
+            failure.append(exc)
+        finally:
+            close = getattr(iterable,'close',None)
+            if close is not None:
+                close()
+            put(_DONE)
+    thread = threading.Thread(target=produce,daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                break
+            yield item
+    finally:
+        stop.set()
+        while thread.is_alive(): # drain, so a producer blocked on a full queue sees the stop
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+    if failure:
+        raise failure[0]
+
+def apply_and_convert(source_path,bids_path,rules,mapping_path='',jobs=1,timeout=None,chunk_size=DEFAULT_CHUNK_SIZE,
+                      copy_mode=None,native_dtype=True,use_cache=True,delta=False,queue_size=QUEUE_SIZE):
+    """Map and convert the files of a folder in a single pass, opening each file once.
+
+    Equivalent to apply_rules followed by convert_them, but each file is converted as soon as it is found
+    (see the module documentation). Files already converted whose source, rules and output didn't change
+    are skipped without opening them, taking their mapping from the mapping cache of apply_rules.
+
+    Parameters
+    ----------
+
+    source_path : str | pathlib.Path
+        The path with the files we want to convert to bids.
+    bids_path : str | pathlib.Path
+        The path we want the converted files in.
+    rules : str | pathlib.Path | dict
+        The path to the rules file, or a dictionary with the rules.
+    mapping_path : str | pathlib.Path, optional
+        The fullpath of the mappings file written as a record of the run, see apply_rules.
+        If '', then bids_path/code/sovabids/mappings.yml will be used.
+    jobs : int, optional
+        Number of files converted at the same time, each one in its own worker process, see convert_them.
+    timeout : float | None, optional
+        Only for worker mode. Maximum number of seconds a single file may take, see convert_them.
+    chunk_size : int | None, optional
+        Number of samples per channel converted at a time, see convert_them.
+    copy_mode : str | None, optional
+        How the files that need no conversion are transferred, see convert_them.
+    native_dtype : bool, optional
+        Whether to keep the sample format of integer sources, see convert_them.
+    use_cache : bool, optional
+        Whether to use the mapping cache to skip the files already converted, see apply_rules.
+    delta : bool, optional
+        Whether to delta-encode the Individual mappings of the mappings file, see apply_rules.
+    queue_size : int, optional
+        Number of items each queue between the stages may hold when running serially.
+
+    Returns
+    -------
+
+    dict :
+        ``{'succeeded': [str, ...], 'skipped': [str, ...], 'failed': [str, ...]}`` —
+        source paths of files that were converted, skipped because they were already converted,
+        and those that could not be mapped or converted, in the order they were found.
+    """
+    bids_path = _expand_path(os.fspath(bids_path))
+    source_path = _expand_path(os.fspath(source_path))
+    mapping_path = _expand_path(os.fspath(mapping_path))
+    rules_copy = load_rules(rules)
+    compiled = CompiledRules(rules_copy)
+
+    outputfolder,outputname = os.path.split(mapping_path)
+    full_mapping_path = os.path.join(outputfolder or os.path.join(bids_path,'code','sovabids'),outputname or 'mappings.yml')
+
+    setup_logging(os.path.join(bids_path,'code','sovabids','sovabids.log'))
+    LOGGER.info('')
+    LOGGER.info(SECTION_STRING + ' START APPLY_AND_CONVERT ' + SECTION_STRING)
+    LOGGER.info(f"source_path={source_path} bids_path={bids_path} mapping={full_mapping_path} ")
+
+    general = dict(rules_copy)
+    general['IO'] = {'source':source_path,'target':bids_path}
+    writer = get_mappings_writer(full_mapping_path,general,delta=delta)
+    journal = ConversionJournal(os.path.join(bids_path,'code','sovabids','convert_journal.jsonl'))
+    cache = None
+    if use_cache:
+        # the mappings of a conversion are the ones of apply_rules reading the files with MNE
+        fingerprint = rules_fingerprint(rules_copy,bids_path=bids_path,probe='mne')
+        cache = MappingCache(os.path.join(bids_path,'code','sovabids','mappings_cache.jsonl'),fingerprint)
+    cache_lock = threading.Lock()
+    staging_root = os.path.join(bids_path,'code','sovabids','staging')
+    shutil.rmtree(staging_root,ignore_errors=True) # leftovers of an interrupted run
+    options = {'copy_mode':copy_mode,'native_dtype':native_dtype}
+
+    sources = []
+    status = {}
+    finished = {} # index -> mapping or None, waiting to be written in order
+    next_index = [0]
+
+    def tasks(files):
+        """Yield (index, source, staging, provenance, mapping) of each file.
+
+        The files already converted are skipped, with a None staging and their cached mapping.
+        """
+        for i,f in enumerate(files):
+            sources.append(f)
+            mapping = None
+            if cache is not None:
+                with cache_lock:
+                    mapping = cache.get(f)
+            if mapping is not None:
+                target = _expand_path(deep_get(mapping,'IO.target',None))
+                if _already_converted(journal,f,target,mapping_fingerprint(mapping,**options),False):
+                    LOGGER.warning(f'SKIPPED (already converted): {f}')
+                    yield i,f,None,None,mapping
+                    continue
+            journal.mark(f,None,'running')
+            # the provenance of the source is taken before converting it
+            yield i,f,os.path.join(staging_root,str(i)),{'key':source_key(f),'hash':content_hash(f),'options':options},None
+
+    def finish(i,f,staging,provenance,mapping,error):
+        """Move a converted file into the bids directory and write its mapping once the ones before it are written."""
+        if staging is None: # skipped
+            status[i] = 'skipped'
+        elif error is None:
+            try:
+                relative = os.path.relpath(_expand_path(deep_get(mapping,'IO.target',None)),staging)
+                mapping['IO']['target'] = os.path.join(bids_path,relative)
+                merge_bids_tree(staging,bids_path,commit=relative)
+                journal.mark(f,mapping['IO']['target'],'done',mapping=mapping_fingerprint(mapping,**options),**provenance)
+                if cache is not None:
+                    with cache_lock:
+                        cache.put(f,mapping)
+                status[i] = 'succeeded'
+            except Exception:
+                LOGGER.exception(f'Error moving the converted files of {f} into {bids_path}')
+                journal.mark(f,None,'failed',error=format_exc())
+                status[i] = 'failed'
+        else:
+            LOGGER.error(f'Error converting {f}\n{error}')
+            journal.mark(f,None,'failed',error=error)
+            status[i] = 'failed'
+        if staging is not None:
+            shutil.rmtree(staging,ignore_errors=True)
+        finished[i] = mapping if status[i] != 'failed' else None
+        while next_index[0] in finished:
+            mapping = finished.pop(next_index[0])
+            if mapping is not None:
+                writer.write(mapping)
+            next_index[0] += 1
+        LOGGER.info(f"File {len(status)} : {f} ({status[i]})")
+
+    jobs = resolve_jobs(jobs)
+    files = iter_source_files(source_path,rules_copy)
+    try:
+        if jobs == 1:
+            def convert():
+                for i,f,staging,provenance,mapping in tasks(_threaded(files,queue_size)):
+                    if staging is None:
+                        yield i,f,None,None,mapping,None
+                        continue
+                    try:
+                        yield i,f,staging,provenance,_apply_and_convert_file(f,compiled,staging,chunk_size,copy_mode,native_dtype),None
+                    except Exception:
+                        yield i,f,staging,provenance,None,format_exc()
+            # the scan and the conversion run in threads of their own, the merges and writes in this one
+            for result in _threaded(convert(),queue_size):
+                finish(*result)
+        else:
+            # fork the workers without threads running, the scan is pulled by run_isolated as workers are free
+            dispatched = []
+            def worker_args():
+                for i,f,staging,provenance,mapping in tasks(files):
+                    if staging is None:
+                        finish(i,f,None,None,mapping,None)
+                        continue
+                    dispatched.append((i,f,staging,provenance))
+                    yield (f,compiled,staging,chunk_size,copy_mode,native_dtype)
+            LOGGER.info(f"Converting with {jobs} worker processes")
+            for k,mapping,error in run_isolated(_apply_and_convert_file,worker_args(),jobs,timeout):
+                finish(*dispatched[k],mapping,error)
+                dispatched[k] = None
+    finally:
+        writer.close()
+        journal.save()
+        if cache is not None:
+            cache.save()
+        shutil.rmtree(staging_root,ignore_errors=True)
+
+    if 'dataset_description' in rules_copy and any(v == 'succeeded' for v in status.values()):
+        update_dataset_description(rules_copy['dataset_description'],bids_path)
+
+    succeeded,skipped,failed = ([sources[i] for i in range(len(sources)) if status.get(i) == key] for key in ('succeeded','skipped','failed'))
+    LOGGER.info(f"Apply and Convert Done! {len(succeeded)} converted, {len(skipped)} skipped, {len(failed)} failed (total {len(sources)}).")
+    if failed:
+        LOGGER.warning(f"{len(failed)} file(s) failed:")
+        for f in failed:
+            LOGGER.warning(f"  FAILED: {f}")
+    LOGGER.info(f"Mapping file written to:{full_mapping_path}")
+    LOGGER.info(SECTION_STRING + ' END APPLY_AND_CONVERT ' + SECTION_STRING)
+    return {'succeeded': succeeded, 'skipped': skipped, 'failed': failed}
+
+def sovarun():
+    """Console script usage for mapping and converting in a single pass."""
+    from sovabids.misc import handle_unicode_dashes
+    handle_unicode_dashes()
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    logging.basicConfig(format="%(message)s")
+    LOGGER.setLevel(logging.WARN)
+
+    parser = subparsers.add_parser('apply_and_convert')
+    parser.add_argument('source_path',help='The path to the input data directory that will be converted to bids')
+    parser.add_argument('bids_path',help='The path to the output bids directory')
+    parser.add_argument('rules',help='The fullpath of the rules file')
+    parser.add_argument('-m','--mapping', help='The fullpath of the mapping file to be written. If not set it will be located in bids_path/code/sovabids/mappings.yml. Use a .jsonl extension for the compact JSON Lines format.',default='')
+    parser.add_argument('-j','--jobs', type=int, help='Number of files converted at the same time, each in its own worker process. 0 uses one per cpu.',default=1)
+    parser.add_argument('--timeout', type=float, help='With --jobs, the maximum number of seconds a single file may take.',default=None)
+    parser.add_argument('--chunk-size', type=int, help='Number of samples per channel converted at a time, which bounds the memory used by long recordings. 0 loads each recording whole.',default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--copy-mode', choices=COPY_MODES, help='Copy, reflink or hardlink the BrainVision, EDF and BDF files that do not need to be converted instead of converting them.',default=None)
+    parser.add_argument('--float32', action="store_true", help='Write BrainVision data as float32 even when the source stores int16 or 24-bit samples.')
+    parser.add_argument('--delta', action="store_true", help='Store in the mapping file only what each file changes from the General rules.')
+    parser.add_argument('--no-cache', action="store_true", help='Convert every file again instead of skipping the ones that did not change.')
+    parser.add_argument('-v','--verbose', action="store_true", help='Make the output more verbose.')
+    args = parser.parse_args()
+
+    if args.verbose:
+        LOGGER.setLevel(logging.INFO)
+
+    result = apply_and_convert(args.source_path,args.bids_path,args.rules,args.mapping,jobs=args.jobs,timeout=args.timeout,
+        chunk_size=args.chunk_size,copy_mode=args.copy_mode,native_dtype=not args.float32,use_cache=not args.no_cache,delta=args.delta)
+    if result['failed']:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    sovarun()
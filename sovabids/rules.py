@@ -7,23 +7,33 @@ import argparse
 import logging
 import re
 from pathlib import Path
+from collections import deque
 
 from copy import deepcopy
+from contextlib import nullcontext
 from mne_bids import write_raw_bids,BIDSPath
-from mne_bids.utils import _handle_datatype,_write_json,_get_ch_type_mapping
+from mne_bids.utils import _handle_datatype,_get_ch_type_mapping
 from mne_bids.path import _parse_ext
+from mne_bids.config import ALLOWED_DATATYPE_EXTENSIONS
 from mne.io import read_raw
-from pandas import read_csv
 from traceback import format_exc
 
 from sovabids.settings import NULL_VALUES,SUPPORTED_EXTENSIONS
-from sovabids.files import _get_files
-from sovabids.dicts import deep_merge_N,deep_get,nested_notation_to_tree
-from sovabids.parsers import parse_from_regex,parse_from_placeholder
-from sovabids.bids import update_dataset_description
+from sovabids.files import _get_files,iter_files,COPY_MODES
+from sovabids.dicts import deep_merge_N,deep_get,nested_notation_to_tree,copy_tree,deep_update
+from sovabids.parsers import placeholder_to_regex,placeholder_to_level_regexes,_fields_from_match
+from sovabids.misc import flat_paren_counter
+from sovabids.bids import update_dataset_description,update_sidecar_json,update_channels_tsv
 from sovabids.loggers import setup_logging
 from sovabids.settings import SECTION_STRING
 from sovabids.heuristics import from_io_example
+from sovabids.parallel import resolve_jobs,get_pool,get_worker_state,call_safely
+from sovabids.cache import MappingCache,rules_fingerprint
+from sovabids.mappings import get_mappings_writer
+from sovabids.headers import read_header,path_header,infer_datatype,rename_header_channels,set_header_channel_types
+from sovabids.streaming import DEFAULT_CHUNK_SIZE,COPY_THROUGH_FORMATS,streamed_writers,copied_writers
+from sovabids.timing import StageTimer,stage,collect_stages,record_stages,source_bytes
+from sovabids.tracing import tracing
 
 LOGGER = logging.getLogger(__name__)
 
@@ -31,6 +41,160 @@ def _regex_match(pattern,string):
     match = re.search(pattern,string)
     match = True if match else False
     return match 
+def _to_mne_channel_types(types):
+    """Map a dictionary of channel name -> bids type to channel name -> mne type, dropping the types mne does not support."""
+    bids_to_mne = _get_ch_type_mapping(fro='bids',to='mne')
+    types = {key:bids_to_mne.get(val,None) for key,val in types.items()}
+    return {k: v for k, v in types.items() if v is not None} # invalid types for mne will be None,remove them
+
+class CompiledRules:
+    """Rules preprocessed once so that analysing the path of each file only costs a regex match.
+
+    Everything that is the same for every file of a run is computed here once:
+    the pattern derived from an example (``non-bids.path_analysis.source/target``),
+    its translation to a compiled regex, the list of fields, the ``operation``
+    expressions and the channel type maps.
+
+    Parameters
+    ----------
+
+    rules : str | pathlib.Path | dict
+        The path to the rules file, or the rules dictionary (ie the output of load_rules).
+
+    Attributes
+    ----------
+
+    rules : dict
+        The rules dictionary, including the pattern derived from the example if any.
+    pattern : str | None
+        The path pattern in regex notation. None if the rules have no pattern.
+    regex : re.Pattern | None
+        The compiled pattern. None if the rules have no pattern or if the number of
+        groups of the pattern does not match the number of fields.
+    fields : list of str
+        The fields as they appear in the regex pattern.
+    operations : list of tuple
+        (field, expression) pairs of the ``non-bids.path_analysis.operation`` rule.
+    channel_types : dict
+        The ``channels.type`` rule, mapping channel names to bids types.
+    mne_channel_types : dict
+        The ``channels.type`` rule mapped to the types supported by mne.
+    """
+    def __init__(self,rules):
+        self.rules = load_rules(rules)
+
+        # Check first if we have an example-based conversion
+        target = deep_get(self.rules,'non-bids.path_analysis.target',None)
+        source = deep_get(self.rules,'non-bids.path_analysis.source',None)
+        if target is not None and source is not None:
+            # Example based path pattern
+            pattern = from_io_example(source,target).get('pattern',None)
+            self.rules = deep_merge_N([self.rules,{'non-bids':{'path_analysis':{'pattern':pattern}}}])
+
+        self.pattern = None
+        self.regex = None
+        self.fields = []
+        pattern = deep_get(self.rules,'non-bids.path_analysis.pattern',None)
+        if pattern is not None:
+            fields = deep_get(self.rules,'non-bids.path_analysis.fields',None)
+            if fields is None: # assume placeholder pattern
+                encloser = deep_get(self.rules,'non-bids.path_analysis.encloser','%')
+                matcher = deep_get(self.rules,'non-bids.path_analysis.matcher','(.+)')
+                pattern,fields = placeholder_to_regex(pattern,encloser,matcher)
+            elif isinstance(fields,str):
+                fields = [fields]
+            self.pattern = pattern
+            self.fields = list(fields)
+            if flat_paren_counter(pattern) == len(self.fields):
+                self.regex = re.compile(pattern)
+
+        operations = deep_get(self.rules,'non-bids.path_analysis.operation',None) or {}
+        self.operations = [(key,val) for key,val in operations.items()]
+        self._compile_operations()
+
+        self.channel_types = deep_get(self.rules,'channels.type',None) or {}
+        self.mne_channel_types = _to_mne_channel_types(self.channel_types)
+
+    def _compile_operations(self):
+        self._operation_codes = []
+        for key,val in self.operations:
+            scoped_expression=val.replace('[',"patterns_extracted['").replace("]","']")
+            self._operation_codes.append((key,compile(scoped_expression,'<operation>','eval')))
+
+    def __getstate__(self):
+        # code objects can't be pickled (ie to send the rules to worker processes)
+        state = self.__dict__.copy()
+        del state['_operation_codes']
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._compile_operations()
+
+    def parse_path(self,path):
+        """Extract the fields of the pattern from a path.
+
+        Parameters
+        ----------
+
+        path : str | pathlib.Path
+            The path from where we want to extract information.
+
+        Returns
+        -------
+
+        dict :
+            The fields extracted from the path, after applying the operations.
+            The `ignore` field is removed.
+        """
+        if self.pattern is None:
+            return {}
+        if self.regex is None: # Number of fields and groups mismatch
+            patterns_extracted = {}
+        else:
+            string = os.fspath(path).replace('\\','/') # USE POSIX PLEASE
+            match = self.regex.search(string)
+            if match is None:
+                raise AttributeError(f"Couldn't find fields in the string {string} using the pattern {self.pattern}. Recheck the pattern for errors.")
+            if len(match.groups()) != len(self.fields):
+                patterns_extracted = {}
+            else:
+                patterns_extracted = _fields_from_match(match,self.fields)
+
+        # If operations between values extracted should be carried out, it should be here
+        if self._operation_codes:
+            l=[]
+            for key,code in self._operation_codes:
+                treated_value=eval(code,{},{'patterns_extracted':patterns_extracted})
+                d = nested_notation_to_tree(key,treated_value.replace('-','').replace('_',''))
+                l.append(d)
+            patterns_extracted = deep_merge_N([patterns_extracted]+l)
+        if 'ignore' in patterns_extracted:
+            del patterns_extracted['ignore']
+        return patterns_extracted
+
+    def info_from_path(self,path):
+        """Get a new rules dictionary with the information of the path merged in.
+
+        Parameters
+        ----------
+
+        path : str | pathlib.Path
+            The path from where we want to extract information.
+
+        Returns
+        -------
+
+        dict :
+            A copy of the rules updated with the fields extracted from the path.
+        """
+        if self.pattern is None: # No path_patten rule
+            LOGGER.warning(f"Warning.No path pattern found.")
+            return copy_tree(self.rules)
+        patterns_extracted = self.parse_path(path)
+        # merge needed because using rules_copy.update(patterns_extracted) replaced it all
+        return deep_update(copy_tree(self.rules),patterns_extracted)
+
 def get_info_from_path(path,rules):
     """Parse information from a given path, given a set of rules.
 
@@ -39,56 +203,25 @@ def get_info_from_path(path,rules):
 
     path : str | pathlib.Path
         The path from where we want to extract information.
-    rules : dict
-        A dictionary following the "Rules File Schema".
+    rules : dict | CompiledRules
+        A dictionary following the "Rules File Schema", or the compiled version of it.
+        When analysing many paths with the same rules, pass a CompiledRules to avoid
+        preprocessing the rules for every path.
+
+    Returns
+    -------
+
+    dict :
+        A copy of the rules updated with the information extracted from the path.
 
     Notes
     --------
 
     See the Rules File Schema documentation for the expected schema of the dictionary.
     """
-    path = os.fspath(path)
-    rules_copy = deepcopy(rules)
-    patterns_extracted = {}
-
-    # Check first if we have an example-based conversion
-    target = deep_get(rules_copy,'non-bids.path_analysis.target',None)
-    source = deep_get(rules_copy,'non-bids.path_analysis.source',None)
-
-    if target is not None and source is not None:
-        # Example based path pattern
-        pattern = from_io_example(source,target).get('pattern',None)
-        rules_copy = deep_merge_N([rules_copy,{'non-bids':{'path_analysis':{'pattern':pattern}}}])
-
-    pattern = deep_get(rules_copy,'non-bids.path_analysis.pattern',None)
-    if pattern is None: # No path_patten rule
-        LOGGER.warning(f"Warning.No path pattern found.")
-        return rules_copy
-    else:
-        fields = deep_get(rules_copy,'non-bids.path_analysis.fields',None)
-        if fields is None: # assume placeholder pattern
-            encloser = deep_get(rules_copy,'non-bids.path_analysis.encloser','%')
-            matcher = deep_get(rules_copy,'non-bids.path_analysis.matcher','(.+)')
-            patterns_extracted = parse_from_placeholder(path,pattern,encloser,matcher)
-        else: # is a regex pattern
-            patterns_extracted = parse_from_regex(path,pattern,fields)
-    
-    # If operations between values extracted should be carried out, it should be here
-    postprocess = deep_get(rules_copy,'non-bids.path_analysis.operation',None)
-
-    if postprocess:
-        l=[]
-        for key,val in postprocess.items():
-            scoped_expression=val.replace('[',"patterns_extracted['").replace("]","']")
-            treated_value=eval(scoped_expression)
-            d = nested_notation_to_tree(key,treated_value.replace('-','').replace('_',''))
-            l.append(d)
-        patterns_extracted = deep_merge_N([patterns_extracted]+l)
-    if 'ignore' in patterns_extracted:
-        del patterns_extracted['ignore']
-    # merge needed because using rules_copy.update(patterns_extracted) replaced it all
-    rules_copy = deep_merge_N([rules_copy,patterns_extracted])
-    return rules_copy
+    if not isinstance(rules,CompiledRules):
+        rules = CompiledRules(rules)
+    return rules.info_from_path(path)
 
 def _expand_path(p):
     """Expand a leading ``~`` and ``$VAR``/``${VAR}`` in a filesystem path string, so
@@ -99,10 +232,58 @@ def _expand_path(p):
         return os.path.expanduser(os.path.expandvars(p))
     return p
 
-def get_files(source_path,rules):
-    """Recursively scan the directory for valid files, returning a list with the full-paths to each.
-    
-    The valid files are given by the 'non-bids.eeg_extension' rule. See the "Rules File Schema".
+def _directory_filter(source_path,rules):
+    """Get the function telling which folders under source_path may hold files matching the path pattern.
+
+    Only if the 'non-bids.path_analysis.prune' rule is true. The placeholder pattern is then taken
+    to start at the source_path or at one of its parents, with every field inside a single folder,
+    so that folders whose names or depth can't match the pattern are skipped.
+
+    Parameters
+    ----------
+
+    source_path : str
+        The path being scanned.
+    rules : dict
+        The rules dictionary.
+
+    Returns
+    -------
+
+    callable | None :
+        A function taking the path of a folder and returning whether to scan it.
+        None if pruning is not requested or not possible with the pattern given.
+    """
+    if not deep_get(rules,'non-bids.path_analysis.prune',False):
+        return None
+    compiled_rules = CompiledRules(rules).rules # includes the pattern derived from an example
+    pattern = deep_get(compiled_rules,'non-bids.path_analysis.pattern',None)
+    if pattern is None or deep_get(compiled_rules,'non-bids.path_analysis.fields',None) is not None:
+        LOGGER.warning('Folder pruning needs a placeholder pattern (or a paired example), scanning every folder.')
+        return None
+    encloser = deep_get(compiled_rules,'non-bids.path_analysis.encloser','%')
+    matcher = deep_get(compiled_rules,'non-bids.path_analysis.matcher','(.+)')
+    levels = placeholder_to_level_regexes(pattern,encloser,matcher)
+    if levels is None:
+        return None
+
+    def matches(names,start):
+        return start+len(names) <= len(levels) and all(levels[start+i].fullmatch(name) for i,name in enumerate(names))
+
+    # The pattern may start at any parent of the source_path, so find how many of its levels
+    # the source_path itself can take up
+    parents = [x for x in source_path.replace('\\','/').split('/') if x]
+    used_levels = [len(parents)-i for i in range(len(parents)+1) if matches(parents[i:],0)]
+
+    def descend(path):
+        names = path[len(source_path):].replace('\\','/').strip('/').split('/')
+        return any(matches(names,used) for used in used_levels)
+    return descend
+
+def iter_source_files(source_path,rules,threads=None):
+    """Recursively scan the directory for valid files, lazily yielding the full-path of each one.
+
+    The lazy version of get_files, so the files found can be processed while the scan goes on.
 
     Parameters
     ----------
@@ -111,19 +292,20 @@ def get_files(source_path,rules):
         The path we want to obtain the files from.
     rules : str | pathlib.Path | dict
         The path to the rules file, or the rules dictionary.
+    threads : int | None, optional
+        Number of threads listing directories concurrently (see files.iter_files).
 
-    Returns
-    -------
+    Yields
+    ------
 
-    filepaths : list of str
-        A list containing the path to each valid file in the source_path.
+    str :
+        The path to each valid file in the source_path.
     """
     rules_copy = load_rules(rules)
     if not isinstance(source_path, list):
         source_path = _expand_path(os.fspath(source_path))
 
     if isinstance(source_path,str):
-        # Generate all files
         extensions = deep_get(rules_copy,'non-bids.eeg_extension',None)
         filters = deep_get(rules_copy,'non-bids.file_filter',[])
         if extensions is None:
@@ -135,17 +317,41 @@ def get_files(source_path,rules):
         # append dot to extensions if missing
         extensions = [x if x[0]=='.' else '.'+x for x in extensions]
 
-        filepaths = _get_files(source_path)
-        filepaths = [x for x in filepaths if os.path.splitext(x)[1] in extensions]
-        for filter_ in filters:
-            for key,val in filter_.items():
-                if key == 'include':
-                    filepaths = [x  for x in filepaths if _regex_match(val,x)]
-                if key == 'exclude':
-                    filepaths = [x  for x in filepaths if not _regex_match(val,x)]
+        descend = _directory_filter(source_path,rules_copy)
+        yield from iter_files(source_path,extensions=extensions,filters=filters,threads=threads,descend=descend)
     else:
         raise ValueError('The source_path should be str.')
-    return filepaths
+
+def get_files(source_path,rules,threads=None):
+    """Recursively scan the directory for valid files, returning a list with the full-paths to each.
+    
+    The valid files are given by the 'non-bids.eeg_extension' and 'non-bids.file_filter' rules.
+    If the 'non-bids.path_analysis.prune' rule is true, the folders that can't match the placeholder
+    pattern are not scanned. See the "Rules File Schema".
+
+    Parameters
+    ----------
+
+    source_path : str | pathlib.Path
+        The path we want to obtain the files from.
+    rules : str | pathlib.Path | dict
+        The path to the rules file, or the rules dictionary.
+    threads : int | None, optional
+        Number of threads listing directories concurrently (see files.iter_files).
+        Useful on network filesystems. None or 1 lists them sequentially.
+
+    Returns
+    -------
+
+    filepaths : list of str
+        A list containing the path to each valid file in the source_path.
+
+    See Also
+    --------
+
+    iter_source_files : The lazy version.
+    """
+    return list(iter_source_files(source_path,rules,threads=threads))
 
 def load_rules(rules):
     """Load rules if given a path, bypass if given a dict.
@@ -178,7 +384,23 @@ def load_rules(rules):
     else:
         raise ValueError(f'Expected str or dict as rules, got {type(rules)} instead.')
 
-def apply_rules_to_single_file(file,rules,bids_path,write=False,preview=False,persist=True):
+def _can_copy_through(fname,raw,rules,datatype,output_format):
+    """Whether the data file of a source can be copied into the bids directory as is.
+
+    That is when it already has the output format, is valid bids for the datatype
+    and the rules don't change its data or its channel names.
+    """
+    ext = os.path.splitext(fname)[1].lower()
+    if ext not in COPY_THROUGH_FORMATS or output_format not in ('auto',COPY_THROUGH_FORMATS[ext]):
+        return False
+    if ext not in ALLOWED_DATATYPE_EXTENSIONS.get(datatype,[]):
+        return False
+    if raw.preload or deep_get(rules,'non-bids.code_execution',None) is not None:
+        return False
+    names = deep_get(rules,'channels.name',None) or {}
+    return all(old == new for old,new in names.items())
+
+def apply_rules_to_single_file(file,rules,bids_path,write=False,preview=False,persist=True,probe='mne',chunk_size=DEFAULT_CHUNK_SIZE,copy_mode=None,native_dtype=True):
     """Apply rules to a single file.
 
     Parameters
@@ -186,8 +408,9 @@ def apply_rules_to_single_file(file,rules,bids_path,write=False,preview=False,pe
 
     file : str | pathlib.Path
         Path to the file.
-    rules : str | pathlib.Path | dict
-        Path to the rules file or rules dictionary.
+    rules : str | pathlib.Path | dict | CompiledRules
+        Path to the rules file, rules dictionary or the compiled rules.
+        Pass a CompiledRules when applying the same rules to many files.
     bids_path : str | pathlib.Path
         Path to the bids directory
     write : bool, optional
@@ -196,6 +419,30 @@ def apply_rules_to_single_file(file,rules,bids_path,write=False,preview=False,pe
         Whether to return a dictionary with a "preview" of the conversion.
         This dict will have the same schema as the "Mapping File Schema" but may have flat versions of its fields.
         *UNDER CONSTRUCTION*
+    persist : bool, optional
+        Whether to update the dataset_description.json of the bids directory.
+    probe : str, optional
+        How the file is read when only the mapping is needed (write and preview are False).
+        'mne' (the default) always reads the file with MNE. 'header' reads just the header of the file
+        (see sovabids.headers), falling back to MNE for formats without a header reader.
+        'none' never opens the file: the datatype comes from the `non-bids.datatype` rule,
+        the channel types of the rules or the extension of the file (see sovabids.headers.path_header),
+        the channel renaming and retyping are not checked against the file and the
+        `non-bids.code_execution` is left for the conversion.
+        Otherwise files are always read with MNE when the rules have a `non-bids.code_execution`.
+    chunk_size : int | None, optional
+        Only for write. Number of samples per channel read and written at a time when converting
+        the data (see sovabids.streaming), so the memory used doesn't grow with the length of the recording.
+        None or 0 lets mne-bids load the whole recording in memory.
+    copy_mode : str | None, optional
+        Only for write. If 'copy', 'reflink' or 'hardlink', BrainVision, EDF and BDF files whose data
+        would be written unchanged (same output format, no channel renaming, no `non-bids.code_execution`)
+        are copied, reflinked or hardlinked into the bids directory instead of being decoded and encoded again
+        (see sovabids.files.transfer_file). The sidecars are written as usual.
+        If None, every file is converted.
+    native_dtype : bool, optional
+        Only for write with a chunk_size. Whether BrainVision output keeps the integer sample format and resolution
+        of int16 and 24-bit sources instead of being written as float32 (see sovabids.streaming.native_sample_format).
 
     Returns
     -------
@@ -209,20 +456,44 @@ def apply_rules_to_single_file(file,rules,bids_path,write=False,preview=False,pe
     bids_path = _expand_path(os.fspath(bids_path))
     f = file
 
-    rules_copy = load_rules(rules)
+    compiled = rules if isinstance(rules,CompiledRules) else CompiledRules(rules)
 
-    # Read file with MNE
-    try:
-        raw = read_raw(f,preload=False)#not write)
-        # TODO:Should we try to artificially past MNE-BIDS CHECK?
-        # Which checks that
-        # ext in ALLOWED_INPUT_EXTENSIONS?
-        # raw.filenames[0]=''.join(raw.filenames[0].split('.')[:-1])+'.set'
-    except:
-        raise IOError(f'MNE couldnt read {f} .')
+    if probe not in ('header','mne','none'):
+        raise ValueError(f"Expected probe to be 'header', 'mne' or 'none', got {probe} instead")
+    if copy_mode is not None and copy_mode not in COPY_MODES:
+        raise ValueError(f"Expected copy_mode to be None or one of {COPY_MODES}, got {copy_mode} instead")
+
+    # Read file with MNE, unless the mapping only needs the header (or just the path)
+    # code_execution may use the raw object, so it needs MNE
+    raw,header = None,None
+    path_only = probe == 'none' and not write and not preview
+    if path_only:
+        pass # the header is built from the path once the path analysis is done
+    elif write or preview or probe == 'mne' or deep_get(compiled.rules,'non-bids.code_execution',None) is not None:
+        try:
+            with stage('read_raw'):
+                raw = read_raw(f,preload=False)#not write)
+            # TODO:Should we try to artificially past MNE-BIDS CHECK?
+            # Which checks that
+            # ext in ALLOWED_INPUT_EXTENSIONS?
+            # raw.filenames[0]=''.join(raw.filenames[0].split('.')[:-1])+'.set'
+        except:
+            raise IOError(f'MNE couldnt read {f} .')
+    else:
+        try:
+            with stage('read_header'):
+                header = read_header(f)
+        except:
+            raise IOError(f'Couldnt read the header of {f} .')
 
     # Get info from path
-    rules_copy = get_info_from_path(f,rules_copy)
+    with stage('get_info_from_path'):
+        rules_copy = compiled.info_from_path(f)
+
+    if path_only:
+        types = deep_get(rules_copy,'channels.type',None) or {}
+        types = compiled.mne_channel_types if types == compiled.channel_types else _to_mne_channel_types(types)
+        header = path_header(f,types.values(),deep_get(rules_copy,'non-bids.datatype',None))
 
     # Apply Rules
 
@@ -233,7 +504,7 @@ def apply_rules_to_single_file(file,rules,bids_path,write=False,preview=False,pe
     # Sidecar json
     if 'sidecar' in rules_copy:
         sidecar = rules_copy['sidecar']
-        if "PowerLineFrequency" in sidecar and sidecar['PowerLineFrequency'] not in NULL_VALUES:
+        if "PowerLineFrequency" in sidecar and sidecar['PowerLineFrequency'] not in NULL_VALUES and raw is not None:
             raw.info['line_freq'] = sidecar["PowerLineFrequency"]  # specify power line frequency as required by BIDS
         # Should we try to infer the line frequency automatically from the psd?
 
@@ -243,7 +514,10 @@ def apply_rules_to_single_file(file,rules,bids_path,write=False,preview=False,pe
 
         # Renaming
         if "name" in channels:
-            raw.rename_channels(channels['name'])
+            if raw is not None:
+                raw.rename_channels(channels['name'])
+            elif not path_only:
+                rename_header_channels(header,channels['name'])
 
         # Retyping
 
@@ -254,9 +528,14 @@ def apply_rules_to_single_file(file,rules,bids_path,write=False,preview=False,pe
             types = channels['type']
             
             # Map the bidstypes to mnetypes
-            types = {key:_get_ch_type_mapping(fro='bids',to='mne').get(val,None) for key,val in types.items() }
-            valid_types = {k: v for k, v in types.items() if v is not None} # invalid types for mne will be None,remove them
-            raw.set_channel_types(valid_types)
+            if types == compiled.channel_types:
+                valid_types = compiled.mne_channel_types
+            else: # the path analysis changed them
+                valid_types = _to_mne_channel_types(types)
+            if raw is not None:
+                raw.set_channel_types(valid_types)
+            elif not path_only:
+                set_header_channel_types(header,valid_types)
     #TODO: Document format option
     output_format = 'BrainVision'
     # Non-bids section
@@ -267,7 +546,7 @@ def apply_rules_to_single_file(file,rules,bids_path,write=False,preview=False,pe
             output_format = non_bids.get('format','BrainVision')
         if 'output_format' in non_bids:
             output_format = non_bids.get('output_format','BrainVision')
-        if "code_execution" in non_bids:
+        if "code_execution" in non_bids and not path_only:
             code_execution = non_bids.get('code_execution',None)
 
             if isinstance(code_execution,str):
@@ -286,16 +565,27 @@ def apply_rules_to_single_file(file,rules,bids_path,write=False,preview=False,pe
                 raise ValueError(f'Expected code_execution to be str or list, got {type(code_execution)} instead')
 
         # remember the `entities` key fields must have the same parameters as the BIDSPath constructor argument
-        datatype = _handle_datatype(raw, None)
+        if raw is not None:
+            datatype = _handle_datatype(raw, None)
+        elif path_only:
+            datatype = header['datatype']
+        else:
+            datatype = infer_datatype(header['ch_types'])
         bids_path = BIDSPath(**entities,root=bids_path,datatype=datatype,suffix=datatype)
         # BrainVision is wrong for MEG — auto-promote to FIF unless user explicitly set a format
         if datatype == 'meg' and output_format == 'BrainVision':
             output_format = 'FIF'
 
-        real_times = raw.times[-1] # Save real duration of the eeg, since it is lost if write is false
+        if raw is not None:
+            real_times = raw.times[-1] # Save real duration of the eeg, since it is lost if write is false
 
         if write:
-            write_raw_bids(raw, bids_path=bids_path,format=output_format,allow_preload=True,overwrite=True)
+            write_format,allow_preload,copying = output_format,True,nullcontext()
+            if copy_mode is not None and _can_copy_through(f,raw,rules_copy,datatype,output_format):
+                # mne-bids copies the files of non-preloaded raws it doesn't need to convert
+                write_format,allow_preload,copying = 'auto',False,copied_writers(copy_mode)
+            with streamed_writers(chunk_size,native=native_dtype) if chunk_size else nullcontext(), copying, stage('write_raw_bids'):
+                write_raw_bids(raw, bids_path=bids_path,format=write_format,allow_preload=allow_preload,overwrite=True)
         else:
             if preview:
                 # Crop the file for less computational cost
@@ -304,25 +594,25 @@ def apply_rules_to_single_file(file,rules,bids_path,write=False,preview=False,pe
                 raw.crop(tmax=tmax)
                 orig_files = _get_files(bids_path.root)
 
-                write_raw_bids(raw, bids_path=bids_path,overwrite=True,format=output_format,allow_preload=True,verbose=False)
+                with stage('write_raw_bids'):
+                    write_raw_bids(raw, bids_path=bids_path,overwrite=True,format=output_format,allow_preload=True,verbose=False)
 
             else:
                 # Since write_raw_bids is not called we must run 
                 # the following lines, which are taken from mne_bids.write
 
                 ################################################################
-                raw_fname = raw.filenames[0]
+                raw_fname = raw.filenames[0] if raw is not None else header['filename']
                 if isinstance(raw_fname,Path):
                     raw_fname = raw_fname.__str__()
-                if '.ds' in os.path.dirname(raw.filenames[0]):
-                    raw_fname = os.path.dirname(raw.filenames[0])
+                if '.ds' in os.path.dirname(raw_fname):
+                    raw_fname = os.path.dirname(raw_fname)
                 # point to file containing header info for multifile systems
                 raw_fname = raw_fname.replace('.eeg', '.vhdr')
                 raw_fname = raw_fname.replace('.fdt', '.set')
                 raw_fname = raw_fname.replace('.dat', '.lay')
                 _, ext = _parse_ext(raw_fname)
 
-                datatype = _handle_datatype(raw,None)
                 bids_path = bids_path.copy()
                 bids_path = bids_path.update(
                     datatype=datatype, suffix=datatype, extension=ext)
@@ -351,20 +641,9 @@ def apply_rules_to_single_file(file,rules,bids_path,write=False,preview=False,pe
             # sidecar json
             try:
                 sidecar_path = bids_path.copy().update(datatype=bids_path.datatype,suffix=bids_path.suffix, extension='.json')
-                with open(sidecar_path.fpath) as f:
-                    sidecarjson = json.load(f)
-                    sidecar = rules_copy.get('sidecar',{})
-                    #TODO Validate the sidecar rules so as not to include dangerous stuff??
-                    sidecarjson.update(sidecar)
-                    sidecarjson.update({'RecordingDuration':real_times}) # needed if preview,since we crop
-                    # maybe include an overwrite rule
-
-                    # remove count fields (may have wrong values)
-                    for count in ["EEGChannelCount" ,"EOGChannelCount" ,"ECGChannelCount" ,"EMGChannelCount" ,"MiscChannelCount" ,"TriggerChannelCount"]:
-                        if count in sidecarjson:
-                            del sidecarjson[count]
-
-                _write_json(sidecar_path.fpath,sidecarjson,overwrite=True)
+                # RecordingDuration is needed if preview,since we crop
+                with stage('sidecar_json'):
+                    update_sidecar_json(sidecar_path.fpath,rules_copy.get('sidecar',{}),RecordingDuration=real_times)
 
                 # Get flat version of the sidecar
                 with open(sidecar_path.fpath) as f:
@@ -376,19 +655,9 @@ def apply_rules_to_single_file(file,rules,bids_path,write=False,preview=False,pe
             # channels
             channels_path = bids_path.copy().update(datatype=bids_path.datatype,suffix='channels', extension='.tsv')
             try:
-                channels_table = read_csv (channels_path.fpath, sep = '\t',dtype=str,keep_default_na=False,na_filter=False,na_values=[],true_values=[],false_values=[])
-                channels_rules = rules_copy.get('channels',{})
-
-                # Modify the able with the new types
-                # Note that this will add the types even if they are not supported by mne
-                # Nevertheless, if a type was supported by mne, it was written to it previously
-
-                if 'type' in channels_rules: # types are post since they are not saved in vhdr (are they in edf??)
-                    for ch_name,ch_type in channels_rules['type'].items():
-                        channels_table.loc[(channels_table.name==str(ch_name)),'type'] = ch_type
-                
-                # Save
-                channels_table.to_csv(channels_path.fpath, index=False,sep='\t')
+                # types are post since they are not saved in vhdr (are they in edf??)
+                with stage('channels_tsv'):
+                    channels_table = update_channels_tsv(channels_path.fpath,rules_copy.get('channels',{}))
 
                 with open(channels_path.fpath) as f:
                     channels = f.read().replace('\n', '__').replace('\t',',')
@@ -453,7 +722,173 @@ def apply_rules_to_single_file(file,rules,bids_path,write=False,preview=False,pe
 
     return mapping,preview
 
-def apply_rules(source_path,bids_path,rules,mapping_path='',persist=True):
+class MappingError(Exception):
+    """Error mapping a file in a worker process, its message is the traceback of the worker."""
+
+def _apply_rules_in_worker(files):
+    """Map a chunk of files inside a worker of the pool used by iter_apply_rules.
+
+    The rules, the bids_path and the probe are taken from the state of the worker.
+
+    Parameters
+    ----------
+
+    files : list of str
+        Paths to the files.
+
+    Returns
+    -------
+
+    list of tuple :
+        For each file, (mapping, None) if the mapping succeeded, (None, traceback string) otherwise.
+    list of sovabids.timing.Span :
+        The stages of the mappings.
+    """
+    state = get_worker_state()
+    results = []
+    with collect_stages() as stages:
+        for file in files:
+            with stage('map_file',file=file):
+                result,error = call_safely(apply_rules_to_single_file,file,state['rules'],state['bids_path'],write=False,preview=False,persist=False,probe=state['probe'])
+            results.append((None,error) if error is not None else (result[0],None))
+    return results,list(stages)
+
+def _map_serially(filepaths,compiled,bids_path,persist,probe):
+    """Map the files in the current process, yielding (mapping, None) or (None, exception) in order."""
+    for f in filepaths:
+        try:
+            with stage('map_file',file=f):
+                map,_ = apply_rules_to_single_file(f,compiled,bids_path,write=False,preview=False,persist=persist,probe=probe) #TODO There should be a way to control how verbose this is
+            yield map,None
+        except Exception as exc:
+            LOGGER.exception(f'Error mapping {f}')
+            yield None,exc
+
+def _map_in_workers(filepaths,compiled,bids_path,probe,jobs):
+    """Map the files in a pool of workers, yielding (mapping, None) or (None, exception) in order.
+
+    Only a few chunks per worker are in flight at any time, so the results waiting to
+    be consumed don't grow with the number of files.
+    """
+    chunksize = max(1,min(64,len(filepaths)//(jobs*4)))
+    window = deque()
+    def drain():
+        chunk,future = window.popleft()
+        results,stages = future.result()
+        record_stages(stages)
+        for f,(map,error) in zip(chunk,results):
+            if error is None:
+                yield map,None
+            else:
+                LOGGER.error(f'Error mapping {f}\n{error}')
+                yield None,MappingError(error)
+    with get_pool(jobs,{'rules':compiled,'bids_path':bids_path,'probe':probe}) as pool:
+        for k in range(0,len(filepaths),chunksize):
+            chunk = filepaths[k:k+chunksize]
+            window.append((chunk,pool.submit(_apply_rules_in_worker,chunk)))
+            if len(window) >= jobs*4:
+                yield from drain()
+        while window:
+            yield from drain()
+
+def iter_apply_rules(source_path,bids_path,rules,persist=True,jobs=1,probe='mne',use_cache=True):
+    """Apply rules to a set of files, yielding the mapping of each file as soon as it is ready.
+
+    This is the streaming version of apply_rules: the mappings are not accumulated,
+    so they can be written to disk (see sovabids.mappings.MappingsWriter) or
+    consumed as they come. The logging is left to the caller to configure.
+
+    Parameters
+    ----------
+
+    source_path : str | pathlib.Path | list of str | list of pathlib.Path
+        If str or Path, the path with the files we want to convert to bids.
+        If list with the paths of the files we want to convert (ie the output of get_files).
+    bids_path : str | pathlib.Path
+        The path we want the converted files in.
+    rules : str | pathlib.Path | dict
+        The path to the rules file, or a dictionary with the rules.
+    persist : bool, optional
+        Whether to write the mapping cache and the dataset_description.json to disk.
+    jobs : int, optional
+        Number of worker processes used to map the files, see apply_rules.
+    probe : str, optional
+        How the files are read to map them, see apply_rules.
+    use_cache : bool, optional
+        Whether to reuse the mappings of the files that did not change since the last run, see apply_rules.
+
+    Yields
+    ------
+
+    tuple :
+        (source file, mapping dictionary) if the file was mapped,
+        (source file, exception) if it failed. In the order of the files.
+    """
+    bids_path = _expand_path(os.fspath(bids_path))
+    if isinstance(source_path, list):
+        source_path = [_expand_path(os.fspath(p)) for p in source_path]
+    else:
+        source_path = _expand_path(os.fspath(source_path))
+
+    # Safe Copy/Load Rules
+    rules_copy = load_rules(rules)
+    compiled = CompiledRules(rules_copy)
+
+    if isinstance(source_path,str):
+        LOGGER.info(f"Obtaining list of files.")
+        filepaths = get_files(source_path,rules_copy)
+        LOGGER.info(f"Found {len(filepaths)} files")
+        if len(filepaths) == 0:
+            LOGGER.warning(f"No files found in {source_path} matching the configured extensions/filters. Individual mappings will be empty.")
+    elif isinstance(source_path,list) and len(source_path)!= 0 and isinstance(source_path[0],str):
+        filepaths = list(source_path)
+    else:
+        raise ValueError(f'The source_path should be either str or a non-empty list of str. Got {type(source_path)}.')
+
+    num_files = len(filepaths)
+    cached = [None]*num_files
+
+    # Reuse the mappings of the files that did not change since the last run
+    cache = None
+    if persist and use_cache:
+        fingerprint = rules_fingerprint(rules_copy,bids_path=bids_path,probe=probe)
+        cache = MappingCache(os.path.join(bids_path,'code','sovabids','mappings_cache.jsonl'),fingerprint)
+        cached = [cache.get(f) for f in filepaths]
+    pending = [f for f,map in zip(filepaths,cached) if map is None]
+
+    jobs = min(resolve_jobs(jobs),max(len(pending),1))
+    if jobs == 1:
+        mapped = _map_serially(pending,compiled,bids_path,persist,probe)
+    else:
+        LOGGER.info(f"Mapping with {jobs} worker processes")
+        mapped = _map_in_workers(pending,compiled,bids_path,probe,jobs)
+
+    num_mapped = 0
+    try:
+        for i,f in enumerate(filepaths):
+            LOGGER.info(f"File {i+1} of {num_files} ({(i+1)*100/num_files}%) : {f}")
+            if cached[i] is not None:
+                map,error = cached[i],None
+                cached[i] = None
+            else:
+                map,error = next(mapped)
+                if cache is not None and error is None:
+                    cache.put(f,map)
+            if error is None:
+                num_mapped += 1
+                yield f,map
+            else:
+                yield f,error
+    finally:
+        mapped.close()
+        # Neither the workers nor the cached files touch the dataset_description.json, so update it once here
+        if persist and num_mapped and (jobs > 1 or len(pending) < num_files):
+            update_dataset_description(rules_copy.get('dataset_description',{}),bids_path)
+        if cache is not None:
+            cache.save()
+            LOGGER.info(f"Mapping cache: {cache.hits} hit(s), {cache.misses} miss(es).")
+
+def apply_rules(source_path,bids_path,rules,mapping_path='',persist=True,jobs=1,probe='mne',use_cache=True,delta=False):
     """Apply rules to a set of files.
 
     Parameters
@@ -466,9 +901,32 @@ def apply_rules(source_path,bids_path,rules,mapping_path='',persist=True):
         The path we want the converted files in.
     rules : str | pathlib.Path | dict
         The path to the rules file, or a dictionary with the rules.
+        The rules are compiled once (see CompiledRules) and reused for every file.
     mapping_path : str | pathlib.Path, optional
         The fullpath where we want to write the mappings file.
         If '', then bids_path/code/sovabids/mappings.yml will be used.
+        The file is written incrementally, so it holds the mappings done so far if the run is interrupted.
+        If it ends in .jsonl the mappings are stored as JSON Lines (see sovabids.mappings), otherwise as YAML.
+    persist : bool, optional
+        Whether to write the mappings file, the logs and the dataset_description.json to disk.
+        If False, the mappings are only computed.
+    jobs : int, optional
+        Number of worker processes used to map the files.
+        1 maps them serially, 0 or a negative number uses one process per cpu.
+        The order of the Individual mappings is the same as in the serial case.
+    probe : str, optional
+        How the files are read to map them, see apply_rules_to_single_file.
+        'mne' reads them with MNE (the default), 'header' reads only their headers and
+        'none' never opens them, mapping them from their paths and the rules alone.
+    use_cache : bool, optional
+        Whether to reuse the mappings of the files that did not change since the last run.
+        The cache is kept in bids_path/code/sovabids/mappings_cache.jsonl and is only used if persist is True.
+        A file is mapped again if its size or modification time changed, and every file is mapped again
+        if the rules, the bids_path or the probe changed.
+    delta : bool, optional
+        Whether to delta-encode the Individual mappings of the mappings file relative to General,
+        so that each one only holds what differs from it (see sovabids.mappings.compress_mapping).
+        The returned dictionary always has the expanded mappings.
     
     Returns
     -------
@@ -478,6 +936,18 @@ def apply_rules(source_path,bids_path,rules,mapping_path='',persist=True):
                                     'General': rules given,
                                     'Individual':list of mapping dictionaries for each file
                                 }
+
+    See Also
+    --------
+
+    iter_apply_rules : The streaming version, which does not keep the mappings in memory.
+
+    Notes
+    -----
+
+    The time spent in each stage of the mapping of the files (ie reading their headers, get_info_from_path)
+    and the throughput of the run are logged and, if persist, written to
+    bids_path/code/sovabids/apply_rules_timing.json (see sovabids.timing.StageTimer.summary).
     """
     
     bids_path = _expand_path(os.fspath(bids_path))
@@ -511,55 +981,58 @@ def apply_rules(source_path,bids_path,rules,mapping_path='',persist=True):
     LOGGER.info(SECTION_STRING + ' START APPLY_RULES ' + SECTION_STRING)
     LOGGER.info(f"source_path={source_path} bids_path={bids_path} mapping={str(full_mapping_path)} ")
 
-    if isinstance(source_path,str):
-        LOGGER.info(f"Obtaining list of files.")
-        filepaths = get_files(source_path,rules_copy)
-        LOGGER.info(f"Found {len(filepaths)} files")
-        if len(filepaths) == 0:
-            LOGGER.warning(f"No files found in {source_path} matching the configured extensions/filters. Individual mappings will be empty.")
-    elif isinstance(source_path,list) and len(source_path)!= 0 and isinstance(source_path[0],str):
-        filepaths = deepcopy(source_path)
-    else:
-        raise ValueError(f'The source_path should be either str or a non-empty list of str. Got {type(source_path)}.')
+    # ADD IO to General Rules (this is for the mapping file)
+    general = dict(rules_copy)
+    general['IO'] = {}
+    general['IO']['source'] = source_path
+    general['IO']['target'] = bids_path
 
+    writer = None
+    if persist:
+        LOGGER.info(f"Saving Mapping File at {full_mapping_path}")
+        try:
+            writer = get_mappings_writer(full_mapping_path,general,delta=delta)
+        except Exception:
+            LOGGER.warning(f'Couldn\'t write mapping file to:{full_mapping_path}', exc_info=True)
 
     #%% BIDS CONVERSION
     LOGGER.info(f"Generating Individual Mappings")
 
     all_mappings = []
     failed_mappings = []
-    num_files = len(filepaths)
-    for i,f in enumerate(filepaths):
-        try:
-            LOGGER.info(f"File {i+1} of {num_files} ({(i+1)*100/num_files}%) : {f}")
-            map,_ = apply_rules_to_single_file(f,rules_copy,bids_path,write=False,preview=False,persist=persist) #TODO There should be a way to control how verbose this is
-            all_mappings.append(map)
-        except Exception:
-            LOGGER.exception(f'Error mapping {f}')
-            failed_mappings.append(f)
+    timer = StageTimer('apply_rules')
+    try:
+        with timer.recording():
+            for f,result in iter_apply_rules(source_path,bids_path,rules_copy,persist=persist,jobs=jobs,probe=probe,use_cache=use_cache):
+                timer.add_file(source_bytes(f))
+                if isinstance(result,Exception):
+                    failed_mappings.append(f)
+                    continue
+                all_mappings.append(result)
+                if writer is not None:
+                    try:
+                        writer.write(result)
+                    except Exception:
+                        LOGGER.warning(f'Couldn\'t write mapping file to:{full_mapping_path}', exc_info=True)
+                        writer.close()
+                        writer = None
+    finally:
+        if writer is not None:
+            writer.close()
+            LOGGER.info(f"Mapping file written to:{full_mapping_path}")
 
+    num_files = len(all_mappings) + len(failed_mappings)
     LOGGER.info(f"Individual Mappings Done! {len(all_mappings)}/{num_files} files mapped successfully.")
     if failed_mappings:
         LOGGER.warning(f"{len(failed_mappings)} file(s) failed mapping:")
         for f in failed_mappings:
             LOGGER.warning(f"  FAILED: {f}")
 
-    # ADD IO to General Rules (this is for the mapping file)
-    LOGGER.info(f"Making General Mapping")
-    rules_copy['IO'] = {}
-    rules_copy['IO']['source'] = source_path
-    rules_copy['IO']['target'] = bids_path
-    mapping_data = {'General':rules_copy,'Individual':all_mappings}
-    LOGGER.info(f"General Mapping Done!")
-
+    timer.log(LOGGER)
     if persist:
-        LOGGER.info(f"Saving Mapping File at {full_mapping_path}")
-        try:
-            with open(full_mapping_path, 'w') as outfile:
-                yaml.dump(mapping_data, outfile, default_flow_style=False)
-            LOGGER.info(f"Mapping file written to:{full_mapping_path}")
-        except Exception:
-            LOGGER.warning(f'Couldn\'t write mapping file to:{full_mapping_path}', exc_info=True)
+        timer.write(os.path.join(bids_path,'code','sovabids','apply_rules_timing.json'))
+
+    mapping_data = {'General':general,'Individual':all_mappings}
 
     LOGGER.info(SECTION_STRING + ' END APPLY_RULES ' + SECTION_STRING)
 
@@ -580,14 +1053,20 @@ def sovapply():
     parser.add_argument('source_path',help='The path to the input data directory that will be converted to bids')  # add the name argument
     parser.add_argument('bids_path',help='The path to the output bids directory')  # add the name argument
     parser.add_argument('rules',help='The fullpath of the rules file')  # add the name argument
-    parser.add_argument('-m','--mapping', help='The fullpath of the mapping file to be written. If not set it will be located in bids_path/code/sovabids/mappings.yml',default='')
+    parser.add_argument('-m','--mapping', help='The fullpath of the mapping file to be written. If not set it will be located in bids_path/code/sovabids/mappings.yml. Use a .jsonl extension for the compact JSON Lines format.',default='')
+    parser.add_argument('-j','--jobs', type=int, help='Number of worker processes used to map the files. 0 uses one per cpu.',default=1)
+    parser.add_argument('--delta', action="store_true", help='Store in the mapping file only what each file changes from the General rules.')
+    parser.add_argument('--no-cache', action="store_true", help='Map every file again instead of reusing the mappings of the files that did not change.')
+    parser.add_argument('--probe', choices=['header','mne','none'], help='Read the files with MNE (default), read only their headers or never open them (none), mapping them from their paths alone.',default='mne')
+    parser.add_argument('--trace', help='Write a trace of the stages of each file, in the Chrome trace-event format, to this json file.',default=None)
     parser.add_argument('-v','--verbose', action="store_true", help='Make the output more verbose.')
     args = parser.parse_args()
 
     if args.verbose:
         LOGGER.setLevel(logging.INFO)
-        
-    apply_rules(args.source_path,args.bids_path,args.rules,args.mapping)
+
+    with tracing(args.trace):
+        apply_rules(args.source_path,args.bids_path,args.rules,args.mapping,jobs=args.jobs,probe=args.probe,use_cache=not args.no_cache,delta=args.delta)
 
 if __name__ == "__main__":
     sovapply()
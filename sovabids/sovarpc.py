@@ -9,6 +9,8 @@ import sovabids.rules as ru
 import sovabids.convert as co
 import sovabids.files as fi
 from sovabids.errors import ApplyError,ConvertError,SaveError,RulesError,FileListError
+from sovabids.timing import stage
+from sovabids.tracing import tracing
 app = jsonrpc.API()
 
 api = jsonrpc.Entrypoint('/api/sovabids')
@@ -53,10 +55,11 @@ def apply_rules(
     A wrapper of around rules.apply_rules function.
     See docstring of :py:func:`apply_rules() <rules.apply_rules>` in :py:mod:`rules`
     """
-    try:
-        mappings = ru.apply_rules(source_path=file_list,bids_path=bids_path,rules=rules,mapping_path=mapping_path)
-    except:
-        raise ApplyError(data={'details': traceback.format_exc()})
+    with stage('rpc.apply_rules'):
+        try:
+            mappings = ru.apply_rules(source_path=file_list,bids_path=bids_path,rules=rules,mapping_path=mapping_path)
+        except:
+            raise ApplyError(data={'details': traceback.format_exc()})
     return mappings
 
 @api.method(errors=[ConvertError])
@@ -72,6 +75,7 @@ def convert_them(
         The general rules
     individual:  list[dict]
         List with the individual mappings of each file.
+        They may be delta-encoded relative to general (see sovabids.mappings), they are expanded before converting.
 
     Notes
     -----
@@ -83,11 +87,12 @@ def convert_them(
     -------
     None
     """
-    try:
-        data = {'General':general,'Individual':individual}
-        co.convert_them(mappings_input=data)
-    except:
-        raise ConvertError(data={'details': traceback.format_exc()})
+    with stage('rpc.convert_them'):
+        try:
+            data = {'General':general,'Individual':individual}
+            co.convert_them(mappings_input=data)
+        except:
+            raise ConvertError(data={'details': traceback.format_exc()})
 
 @api.method(errors=[RulesError])
 def load_rules(
@@ -114,10 +119,11 @@ def load_rules(
     See docstring of :py:func:`load_rules() <rules.load_rules>` in :py:mod:`rules`
     """
 
-    try:
-        rules = ru.load_rules(rules_path)
-    except:
-        raise RulesError(data={'details': traceback.format_exc()})
+    with stage('rpc.load_rules'):
+        try:
+            rules = ru.load_rules(rules_path)
+        except:
+            raise RulesError(data={'details': traceback.format_exc()})
     return rules
 
 @api.method(errors=[ApplyError])
@@ -164,10 +170,11 @@ def apply_rules_to_single_file(
     See docstring of :py:func:`apply_rules_to_single_file() <rules.apply_rules_to_single_file>` in :py:mod:`rules`
     """
 
-    try:
-        mapping,preview=ru.apply_rules_to_single_file(file,rules,bids_path,write,preview)
-    except:
-        raise ApplyError(data={'details': traceback.format_exc()})
+    with stage('rpc.apply_rules_to_single_file',file=file):
+        try:
+            mapping,preview=ru.apply_rules_to_single_file(file,rules,bids_path,write,preview)
+        except:
+            raise ApplyError(data={'details': traceback.format_exc()})
     return {'mapping':mapping,'preview':preview}
 
 @api.method(errors=[SaveError])
@@ -197,10 +204,11 @@ def save_rules(
     See docstring of :py:func:`_write_yaml() <files._write_yaml>` in :py:mod:`files`
     """
 
-    try:
-        fi._write_yaml(rules,path)
-    except:
-        raise SaveError(data={'details': traceback.format_exc()})
+    with stage('rpc.save_rules'):
+        try:
+            fi._write_yaml(rules,path)
+        except:
+            raise SaveError(data={'details': traceback.format_exc()})
     return
 
 @api.method(errors=[SaveError])
@@ -234,11 +242,12 @@ def save_mappings(
     See docstring of :py:func:`_write_yaml() <files._write_yaml>` in :py:mod:`files`
     """
 
-    try:
-        data = {'General':general,'Individual':individual}
-        fi._write_yaml(data,path)
-    except:
-        raise SaveError(data={'details': traceback.format_exc()})
+    with stage('rpc.save_mappings'):
+        try:
+            data = {'General':general,'Individual':individual}
+            fi._write_yaml(data,path)
+        except:
+            raise SaveError(data={'details': traceback.format_exc()})
     return
 
 @api.method(errors=[FileListError])
@@ -249,6 +258,7 @@ def get_files(
     """Recursively scan the directory for valid files, returning a list with the full-paths to each.
     
     The valid files are given by the 'non-bids.eeg_extension' rule. See the "Rules File Schema".
+    Folders that can't match the placeholder pattern are skipped if 'non-bids.path_analysis.prune' is true.
 
     Parameters
     ----------
@@ -273,18 +283,29 @@ def get_files(
     See docstring of :py:func:`get_files() <rules.get_files>` in :py:mod:`rules`
     """
 
-    try:
-        filelist = ru.get_files(path,rules)
-    except:
-        raise FileListError(data={'details': traceback.format_exc()})
+    with stage('rpc.get_files'):
+        try:
+            filelist = ru.get_files(path,rules)
+        except:
+            raise FileListError(data={'details': traceback.format_exc()})
     return filelist
 
 
 app.bind_entrypoint(api)
 
-def main(entry='sovarpc:app',port=5000,debug=False):
+def main(entry='sovarpc:app',port=5000,debug=False,trace=None):
+    """Serve the api with uvicorn.
+
+    Parameters
+    ----------
+
+    trace : str | None, optional
+        If given, the json file a trace of the methods called (and of the stages of the files they go through)
+        is written to when the server stops, in the Chrome trace-event format (see sovabids.tracing).
+    """
     import uvicorn
-    uvicorn.run(entry, port=port, access_log=False)
+    with tracing(trace):
+        uvicorn.run(entry, port=port, access_log=False)
 
 if __name__ == '__main__':
     main(port=5100)
@@ -0,0 +1,469 @@
+"""Module with the writers that replace the mne-bids ones when converting files.
+
+Bounded-memory writers
+----------------------
+
+By default ``mne_bids.write_raw_bids`` builds the whole recording in memory
+as a float64 array before writing it. While :py:func:`streamed_writers` is active
+the data files are written in chunks of a fixed number of samples instead:
+
+- BrainVision output is written chunk by chunk (see :py:func:`write_brainvision`),
+  giving the same files mne-bids writes.
+- FIF output is saved by MNE in buffers of ``chunk_size`` samples, which never loads a non-preloaded file.
+- EDF and BDF output need the whole array, so the file is preloaded into a memory-mapped
+  file on disk before writing, instead of into RAM.
+
+Native sample formats
+---------------------
+
+mne-bids writes every BrainVision file as float32 with a resolution of 0.1 µV, whatever the source was.
+When the source stores integer samples (ie int16 BrainVision or FIF, EDF, 24-bit BDF)
+:py:func:`write_brainvision` can keep them as they are instead (see :py:func:`native_sample_format`):
+int16 sources are written as int16 and 24-bit sources as float32 holding the integer counts,
+both with the resolution of each source channel, so the samples go through the conversion unchanged.
+If some sample is not a whole number of steps (ie the data was modified by a `code_execution`)
+the file is written the mne-bids way instead.
+
+Copy-through writers
+--------------------
+
+Sources that are already BrainVision, EDF or BDF don't need to be decoded and encoded again.
+While :py:func:`copied_writers` is active the data files mne-bids copies are copied,
+reflinked or hardlinked, rewriting just the pointers of the BrainVision header and marker files.
+
+Everything else (sidecars, channels, events, scans) is still written by mne-bids.
+
+Private functions
+-----------------
+
+The writers replace private functions of ``mne_bids.write`` and call private functions of
+pybv and mne-bids. Each one is checked to exist before it is used: with a version of those
+packages that lacks some of them, the files concerned are written by plain ``write_raw_bids``
+(with a warning) instead of failing.
+
+Memory footprint
+----------------
+
+:py:func:`conversion_footprint` estimates from the header of a source how much memory
+its conversion needs and how much data it moves, which is what the worker mode of
+``convert_them`` schedules the files by.
+"""
+import os
+import logging
+import importlib
+import tempfile
+import threading
+import warnings
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from sovabids.files import transfer_file
+from sovabids.headers import read_header,read_edf_steps,_MNE_DTYPES
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 32768
+"""Default number of samples (per channel) read and written at a time."""
+
+NATIVE_FORMATS = {'int16':'binary_int16','int24':'binary_float32'}
+"""Source sample formats kept by the BrainVision writer, with the BrainVision format that holds them exactly."""
+
+WORKER_MEMORY = 256*2**20
+"""Estimated memory in bytes of a worker process before it reads any data (python, MNE and MNE-BIDS imported)."""
+
+_DTYPE_BYTES = {'int16':2,'int24':3,'int32':4,'float32':4,'float64':8}
+
+_BRAINVISION_INTERNALS = {'pybv.io':('_chk_events','_write_bveeg_file','_write_vmrk_file','_write_vhdr_file'),
+                          'mne.channels.channels':('_unit2human',)}
+"""Private functions write_brainvision relies on, by module."""
+
+_COPY_INTERNALS = {'mne_bids.copyfiles':('_get_brainvision_paths','_get_brainvision_encoding')}
+"""Private functions copy_brainvision relies on, by module."""
+
+_WARNED = set()
+
+def _warn_once(message):
+    if message not in _WARNED:
+        _WARNED.add(message)
+        LOGGER.warning(message)
+
+def _has_internals(internals):
+    """Check that the modules can be imported and still have the given private functions."""
+    for module,names in internals.items():
+        try:
+            module = importlib.import_module(module)
+        except ImportError:
+            return False
+        if not all(hasattr(module,name) for name in names):
+            return False
+    return True
+
+class _NotNative(Exception):
+    """Some sample is not a whole number of steps of the source format."""
+
+def native_sample_format(raw):
+    """Detect the sample format and the resolution of the file a raw object was read from.
+
+    Parameters
+    ----------
+
+    raw : mne.io.Raw
+        The raw object.
+
+    Returns
+    -------
+
+    tuple | None :
+        (dtype, steps), the format of the samples on disk (see sovabids.headers) and the value of
+        one digital step of each channel (V for voltages, as MNE reads them).
+        None if the samples aren't stored in one of the NATIVE_FORMATS or the steps are unknown.
+    """
+    fname = raw.filenames[0] if len(raw.filenames) else None
+    if fname is None:
+        return None
+    ext = os.path.splitext(os.fspath(fname))[1].lower()
+    try:
+        if ext in ('.edf','.bdf'): # MNE reads them already scaled, so the steps are in the header
+            dtype = 'int24' if ext == '.bdf' else 'int16'
+            steps = read_edf_steps(fname)
+        else:
+            dtype = _MNE_DTYPES.get(getattr(raw,'orig_format',None),None)
+            steps = [ch['cal']*ch['range'] for ch in raw.info['chs']]
+    except Exception:
+        LOGGER.debug(f'Could not read the sample format of {fname}',exc_info=True)
+        return None
+    if dtype not in NATIVE_FORMATS or len(steps) != len(raw.ch_names) or None in steps:
+        return None
+    return dtype,np.array(steps,dtype=float)
+
+def conversion_footprint(fname,chunk_size=DEFAULT_CHUNK_SIZE):
+    """Estimate the memory needed to convert a file and the amount of data it moves, from its header.
+
+    MNE holds the samples in memory as float64 and the writers make a copy of them to encode them,
+    so a recording loaded whole needs about 2 x samples x channels x 8 bytes besides the
+    WORKER_MEMORY. With a chunk_size only one chunk of samples is held at a time
+    (the memory-mapped EDF and BDF preloads live in the page cache, not counted).
+
+    Parameters
+    ----------
+
+    fname : str | pathlib.Path
+        The path of the source file.
+    chunk_size : int | None, optional
+        Number of samples per channel converted at a time, None or 0 if the recording is loaded whole.
+
+    Returns
+    -------
+
+    tuple :
+        (memory, work) in bytes. The work is the size of the samples on disk (samples x channels x dtype).
+        (WORKER_MEMORY, 0) if the header cannot be read.
+    """
+    try:
+        header = read_header(fname)
+    except Exception:
+        LOGGER.debug(f'Could not read the header of {fname} to estimate its footprint',exc_info=True)
+        return WORKER_MEMORY,0
+    n_samples,n_channels = header['n_samples'],len(header['ch_names'])
+    resident = min(n_samples,chunk_size) if chunk_size else n_samples
+    memory = WORKER_MEMORY + 2*resident*n_channels*8
+    work = n_samples*n_channels*_DTYPE_BYTES.get(header['dtype'],4)
+    return memory,work
+
+def _write_counts(fout,data,steps,dtype):
+    """Write a chunk of data as the integer counts of its steps, raising _NotNative if they aren't integers."""
+    counts = data / steps[:,np.newaxis]
+    rounded = np.rint(counts)
+    limit = 2**15 if dtype == 'int16' else 2**23
+    if not np.allclose(counts,rounded,rtol=0,atol=1e-3) or np.any(rounded < -limit) or np.any(rounded >= limit):
+        raise _NotNative()
+    fout.write(np.ascontiguousarray(rounded.T,dtype='<i2' if dtype == 'int16' else '<f4').tobytes())
+
+def write_brainvision(raw,fname,events=None,overwrite=True,chunk_size=DEFAULT_CHUNK_SIZE,native=False):
+    """Write a raw object in the BrainVision format reading it in chunks.
+
+    Mirrors what mne-bids does to convert a file to BrainVision (float32 data in µV with a 0.1 resolution),
+    but the data is read and written ``chunk_size`` samples at a time.
+    With native, the samples of integer sources keep their format and resolution instead.
+
+    Parameters
+    ----------
+
+    raw : mne.io.Raw
+        The raw object, it does not need to be preloaded.
+    fname : str | pathlib.Path
+        The path of the .vhdr file. The .eeg and .vmrk files are written next to it.
+    events : numpy.ndarray | None, optional
+        The events in the MNE format (sample, 0, id).
+    overwrite : bool, optional
+        Whether to overwrite existing files.
+    chunk_size : int, optional
+        Number of samples per channel read and written at a time.
+    native : bool, optional
+        Whether to keep the sample format of the source, see native_sample_format.
+        If the source has no native format, or some sample isn't a whole number of its steps,
+        the file is written as float32 like mne-bids does.
+    """
+    from pybv import io as pybv_io
+    from mne.io.constants import FIFF
+    from mne.channels.channels import _unit2human
+
+    # brainvision marks events from the first available data point, ignoring raw.first_samp
+    if events is not None:
+        events = np.array(events)
+        events[:, 0] -= raw.first_samp
+        events = events[:, [0, 2]]
+
+    # voltages in µV, every other unit as is
+    units = []
+    for ch in raw.info['chs']:
+        if ch['unit'] == FIFF.FIFF_UNIT_V:
+            units.append('µV')
+        else:
+            units.append(_unit2human.get(ch['unit'],'n/a'))
+    units = [u if u not in ['NA'] else 'n/a' for u in units]
+
+    ch_names = [str(ch) for ch in raw.ch_names]
+    n_times = raw.n_times
+    events = pybv_io._chk_events(events,ch_names,n_times)
+
+    fname = Path(fname)
+    folder = fname.parent
+    folder.mkdir(parents=True,exist_ok=True)
+    eeg_fname = folder / (fname.stem + '.eeg')
+    vmrk_fname = folder / (fname.stem + '.vmrk')
+    vhdr_fname = folder / (fname.stem + '.vhdr')
+    for f in (eeg_fname,vmrk_fname,vhdr_fname):
+        if f.exists() and not overwrite:
+            raise OSError(f'File already exists: {f}.\nConsider setting overwrite=True.')
+
+    source = native_sample_format(raw) if native else None
+    if source is not None:
+        dtype,steps = source
+        # the resolution is given in the unit of each channel
+        resolution = steps / np.array([1e-6 if u == 'µV' else 1. for u in units])
+        try:
+            _write_brainvision_files(raw,eeg_fname,vmrk_fname,vhdr_fname,events,ch_names,units,
+                NATIVE_FORMATS[dtype],resolution,chunk_size,(dtype,steps))
+            return
+        except _NotNative:
+            LOGGER.info(f'The data of {raw.filenames[0]} is not a whole number of {dtype} steps, writing it as float32.')
+    _write_brainvision_files(raw,eeg_fname,vmrk_fname,vhdr_fname,events,ch_names,units,
+        'binary_float32',np.atleast_1d(1e-1),chunk_size)
+
+def _write_brainvision_files(raw,eeg_fname,vmrk_fname,vhdr_fname,events,ch_names,units,fmt,resolution,chunk_size,counts=None):
+    """Write the BrainVision triplet, the data as pybv would or, if counts is (dtype, steps), as the counts of the steps."""
+    from pybv import io as pybv_io
+
+    n_times = raw.n_times
+    chunk_size = max(int(chunk_size),1)
+    try:
+        with open(eeg_fname,'wb') as fout:
+            for start in range(0,n_times,chunk_size):
+                data = raw.get_data(start=start,stop=min(start+chunk_size,n_times))
+                if counts is not None:
+                    _write_counts(fout,data,counts[1],counts[0])
+                    continue
+                with warnings.catch_warnings():
+                    if start: # the unit warnings were already given by the first chunk
+                        warnings.simplefilter('ignore')
+                    pybv_io._write_bveeg_file(fout,data,orientation='multiplexed',format=fmt,resolution=resolution,units=units)
+        pybv_io._write_vmrk_file(vmrk_fname,eeg_fname,events,None)
+        # only the length of data is used by the header writer
+        pybv_io._write_vhdr_file(vhdr_fname=vhdr_fname,vmrk_fname=vmrk_fname,eeg_fname=eeg_fname,data=ch_names,
+            sfreq=float(raw.info['sfreq']),ch_names=ch_names,ref_ch_names=['']*len(ch_names),orientation='multiplexed',
+            format=fmt,resolution=resolution,units=units)
+    except (ValueError,_NotNative):
+        for f in (eeg_fname,vmrk_fname,vhdr_fname):
+            if f.exists():
+                os.remove(f)
+        raise
+
+@contextmanager
+def memmap_preload(raw,folder=None):
+    """Preload a raw object into a temporary memory-mapped file instead of RAM.
+
+    Parameters
+    ----------
+
+    raw : mne.io.Raw
+        The raw object. Nothing is done if it is already preloaded.
+    folder : str | None, optional
+        Folder of the temporary file, the system temporary folder if None.
+
+    Yields
+    ------
+
+    mne.io.Raw :
+        The same raw object, preloaded.
+    """
+    if raw.preload:
+        yield raw
+        return
+    fd,path = tempfile.mkstemp(suffix='.dat',prefix='sovabids_',dir=folder)
+    os.close(fd)
+    try:
+        raw.load_data(memmap=path,verbose=False)
+        yield raw
+    finally:
+        try:
+            os.remove(path)
+        except OSError: # ie still mapped on windows
+            LOGGER.debug(f'Could not remove the temporary file {path}')
+
+_LOCK = threading.Lock()
+_PATCHES = {} # name -> [number of active contexts, the original mne-bids function]
+
+@contextmanager
+def _replaced_writers(replacements):
+    """Replace functions of the mne_bids.write module while the context is active.
+
+    Nested or concurrent contexts replacing the same function use the replacement of the first one.
+    Functions missing from the installed mne-bids are not replaced, so write_raw_bids writes those files as is.
+    """
+    import mne_bids.write as mbw
+    missing = sorted(name for name in replacements if not hasattr(mbw,name))
+    if missing:
+        _warn_once(f'mne_bids.write has no {", ".join(missing)} in mne-bids {_version("mne_bids")}, '
+                   'those files are written by write_raw_bids as is.')
+        replacements = {name:func for name,func in replacements.items() if name not in missing}
+    with _LOCK:
+        for name,func in replacements.items():
+            if name not in _PATCHES:
+                _PATCHES[name] = [0,getattr(mbw,name)]
+                setattr(mbw,name,func)
+            _PATCHES[name][0] += 1
+    try:
+        yield
+    finally:
+        with _LOCK:
+            for name in replacements:
+                _PATCHES[name][0] -= 1
+                if _PATCHES[name][0] == 0:
+                    setattr(mbw,name,_PATCHES.pop(name)[1])
+
+def _version(module):
+    try:
+        return importlib.import_module(module).__version__
+    except (ImportError,AttributeError):
+        return 'unknown'
+
+def _original(name):
+    """Get the mne-bids function replaced by an active context."""
+    return _PATCHES[name][1]
+
+@contextmanager
+def streamed_writers(chunk_size=DEFAULT_CHUNK_SIZE,memmap_folder=None,native=True):
+    """Make mne_bids.write_raw_bids write the data files in chunks while the context is active.
+
+    Parameters
+    ----------
+
+    chunk_size : int, optional
+        Number of samples per channel read and written at a time.
+    memmap_folder : str | None, optional
+        Folder of the memory-mapped files used for the formats that need the whole array (EDF, BDF).
+        The system temporary folder if None.
+    native : bool, optional
+        Whether BrainVision output keeps the sample format of integer sources (see native_sample_format),
+        instead of being float32 like the one of mne-bids.
+
+    Notes
+    -----
+    The writers are replaced in the mne_bids.write module, so they apply to every thread of the process.
+    Nested or concurrent contexts use the writers of the first one.
+    """
+    def _write_raw_brainvision(raw,bids_fname,events,overwrite):
+        write_brainvision(raw,bids_fname,events=events,overwrite=overwrite,chunk_size=chunk_size,native=native)
+
+    def _write_raw_edf_bdf(raw,bids_fname,overwrite,**kwargs):
+        with memmap_preload(raw,memmap_folder):
+            _original('_write_raw_edf_bdf')(raw,bids_fname,overwrite,**kwargs)
+
+    def _write_raw_fif(raw,bids_fname,*args,**kwargs):
+        buffer_size_sec = raw.buffer_size_sec
+        raw.buffer_size_sec = chunk_size/raw.info['sfreq']
+        try:
+            _original('_write_raw_fif')(raw,bids_fname,*args,**kwargs)
+        finally:
+            raw.buffer_size_sec = buffer_size_sec
+
+    replacements = {'_write_raw_edf_bdf':_write_raw_edf_bdf,'_write_raw_fif':_write_raw_fif}
+    if _has_internals(_BRAINVISION_INTERNALS):
+        replacements['_write_raw_brainvision'] = _write_raw_brainvision
+    else:
+        _warn_once(f'pybv {_version("pybv")} lacks the functions the chunked BrainVision writer uses, '
+                   'BrainVision files are written by write_raw_bids as is.')
+    with _replaced_writers(replacements):
+        yield
+
+COPY_THROUGH_FORMATS = {'.vhdr':'BrainVision','.edf':'EDF','.bdf':'BDF'}
+"""Source extensions whose files can be copied through, with the output format they already have."""
+
+def copy_brainvision(vhdr_src,vhdr_dest,mode='copy'):
+    """Copy a BrainVision file triplet, pointing the new header and marker files to the new names.
+
+    Parameters
+    ----------
+
+    vhdr_src : str | pathlib.Path
+        The path of the source .vhdr file.
+    vhdr_dest : str | pathlib.Path
+        The path of the new .vhdr file.
+    mode : str, optional
+        How the data (.eeg) file is transferred, see sovabids.files.transfer_file.
+        The .vhdr and .vmrk are always rewritten.
+    """
+    from mne_bids.copyfiles import _get_brainvision_paths,_get_brainvision_encoding
+
+    vhdr_src,vhdr_dest = os.fspath(vhdr_src),os.fspath(vhdr_dest)
+    eeg_src,vmrk_src = _get_brainvision_paths(vhdr_src)
+    encoding = _get_brainvision_encoding(vhdr_src)
+    base = os.path.splitext(vhdr_dest)[0]
+    name = os.path.basename(base)
+    os.makedirs(os.path.dirname(vhdr_dest) or '.',exist_ok=True)
+    transfer_file(eeg_src,base + '.eeg',mode)
+    for src,dest in ((vhdr_src,vhdr_dest),(vmrk_src,base + '.vmrk')):
+        with open(src,encoding=encoding) as fin, open(dest,'w',encoding=encoding) as fout:
+            for line in fin:
+                if line.startswith('DataFile='):
+                    line = f'DataFile={name}.eeg\n'
+                elif line.startswith('MarkerFile='):
+                    line = f'MarkerFile={name}.vmrk\n'
+                fout.write(line)
+
+@contextmanager
+def copied_writers(mode='copy'):
+    """Make mne_bids.write_raw_bids transfer the data files it copies with the given mode.
+
+    BrainVision payloads and EDF/BDF files are copied, reflinked or hardlinked (see sovabids.files.transfer_file)
+    and only the BrainVision header and marker files are rewritten. Anonymized copies are left to mne-bids.
+
+    Parameters
+    ----------
+
+    mode : str, optional
+        One of 'copy', 'reflink' or 'hardlink'.
+    """
+    def copyfile_brainvision(vhdr_src,vhdr_dest,anonymize=None,**kwargs):
+        if anonymize is not None:
+            return _original('copyfile_brainvision')(vhdr_src,vhdr_dest,anonymize=anonymize,**kwargs)
+        copy_brainvision(vhdr_src,vhdr_dest,mode)
+
+    def copyfile_edf(src,dest,anonymize=None,**kwargs):
+        if anonymize is not None:
+            return _original('copyfile_edf')(src,dest,anonymize=anonymize,**kwargs)
+        dest = os.fspath(dest)
+        root,ext = os.path.splitext(dest)
+        transfer_file(src,root + ext.lower(),mode) # bids only allows lowercase extensions
+
+    replacements = {'copyfile_edf':copyfile_edf}
+    if _has_internals(_COPY_INTERNALS):
+        replacements['copyfile_brainvision'] = copyfile_brainvision
+    else:
+        _warn_once(f'mne-bids {_version("mne_bids")} lacks the functions copy_brainvision uses, '
+                   'BrainVision files are copied by write_raw_bids as is.')
+    with _replaced_writers(replacements):
+        yield
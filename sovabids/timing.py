@@ -0,0 +1,280 @@
+"""Module with the per-stage timers of apply_rules and convert_them.
+
+The slow parts of mapping and converting a file are marked with :py:func:`stage`
+(ie ``read_raw``, ``get_info_from_path``, ``write_raw_bids``, ``sidecar_json``, ``channels_tsv``).
+While a :py:class:`StageTimer` is recording, the time spent in each stage of the current
+process is added to it; otherwise the stages cost next to nothing. Worker processes
+collect their stages with :py:func:`collect_stages` and send them back to be added to
+the timers of the parent with :py:func:`record_stages`.
+
+Each run of a stage is a :py:class:`Span`, which also tells when and where it ran,
+so the same stages feed the trace of sovabids.tracing.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+from sovabids.cache import source_files
+
+LOGGER = logging.getLogger(__name__)
+
+_LOCK = threading.Lock()
+_RECORDERS = [] # objects with a record(span) method (and optionally enter(name)), receiving the stages of this process
+
+Span = namedtuple('Span',['name','start','seconds','pid','tid','args'])
+"""A run of a stage: its name, when it started (seconds since the epoch), how long it took,
+the process and thread it ran in and the arguments given to :py:func:`stage` (ie the file)."""
+
+def _record(span):
+    with _LOCK:
+        recorders = list(_RECORDERS)
+    for recorder in recorders:
+        recorder.record(span)
+
+def _enter(name):
+    # recorders that need to know when a stage starts (ie to measure its memory) have an enter(name) method
+    with _LOCK:
+        recorders = [recorder for recorder in _RECORDERS if hasattr(recorder,'enter')]
+    for recorder in recorders:
+        recorder.enter(name)
+
+@contextmanager
+def recording(recorder):
+    """Send the stages run in this process while inside the block to a recorder.
+
+    Parameters
+    ----------
+
+    recorder : object
+        With a ``record(span)`` method called with the Span of each stage as it finishes,
+        and optionally an ``enter(name)`` method called as each stage starts.
+
+    Returns
+    -------
+
+    contextmanager :
+        Yielding the recorder.
+    """
+    with _LOCK:
+        _RECORDERS.append(recorder)
+    try:
+        yield recorder
+    finally:
+        with _LOCK:
+            _RECORDERS.remove(recorder)
+
+@contextmanager
+def stage(name,**args):
+    """Time a block of code as a stage of the current file.
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the stage.
+    **args :
+        Details of this run of the stage (ie the file), kept in its Span.
+    """
+    if not _RECORDERS:
+        yield
+        return
+    _enter(name)
+    start,counter = time.time(),time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(Span(name,start,time.perf_counter()-counter,os.getpid(),threading.get_ident(),args or None))
+
+class _StageList(list):
+    """A list receiving the spans of the process."""
+    def record(self,span):
+        self.append(span)
+
+def collect_stages():
+    """Collect the stages run inside the block, ie to send them from a worker process to its parent.
+
+    Returns
+    -------
+
+    contextmanager :
+        Yielding the list of Span filled as the stages finish.
+    """
+    return recording(_StageList())
+
+def record_stages(stages):
+    """Add stages measured somewhere else (ie in a worker process) to the timers recording in this process.
+
+    Parameters
+    ----------
+
+    stages : list of Span
+        The spans to add.
+    """
+    for span in stages or ():
+        _record(Span(*span))
+
+def percentile(values,q):
+    """Get a percentile of some values, interpolating linearly between the closest ranks.
+
+    Parameters
+    ----------
+
+    values : list of float
+        The values, in any order. Must not be empty.
+    q : float
+        The percentile, between 0 and 100.
+
+    Returns
+    -------
+
+    float :
+        The percentile.
+    """
+    values = sorted(values)
+    position = (len(values)-1)*q/100
+    low = int(position)
+    high = min(low+1,len(values)-1)
+    return values[low]+(values[high]-values[low])*(position-low)
+
+class StageTimer:
+    """Aggregate of the time spent in each stage of a run and of its throughput.
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the run (ie 'apply_rules' or 'convert_them').
+
+    Attributes
+    ----------
+
+    stages : dict
+        Stage name -> list of the seconds of each time it ran, in the order they finished.
+    files : int
+        Number of files processed.
+    bytes : int
+        Number of bytes of the source files processed.
+    """
+    def __init__(self,name):
+        self.name = name
+        self.stages = {}
+        self.files = 0
+        self.bytes = 0
+        self._start = None
+        self._seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self,name,seconds):
+        """Add one run of a stage.
+
+        Parameters
+        ----------
+
+        name : str
+            The name of the stage.
+        seconds : float
+            How long it took.
+        """
+        with self._lock:
+            self.stages.setdefault(name,[]).append(seconds)
+
+    def record(self,span):
+        """Add a Span."""
+        self.add(span.name,span.seconds)
+
+    def add_file(self,nbytes=0):
+        """Count a processed file.
+
+        Parameters
+        ----------
+
+        nbytes : int, optional
+            The size of its source files.
+        """
+        with self._lock:
+            self.files += 1
+            self.bytes += nbytes
+
+    @contextmanager
+    def recording(self):
+        """Record the stages run in this process (by any thread) while inside the block, and the wall time of the block."""
+        self._start = time.perf_counter()
+        try:
+            with recording(self):
+                yield self
+        finally:
+            self._seconds += time.perf_counter()-self._start
+            self._start = None
+
+    @property
+    def seconds(self):
+        """The wall time spent recording, in seconds."""
+        if self._start is not None:
+            return self._seconds + time.perf_counter()-self._start
+        return self._seconds
+
+    def summary(self):
+        """Get the aggregate statistics of the run.
+
+        Returns
+        -------
+
+        dict :
+            ``{'name','files','bytes','seconds','files_per_second','mb_per_second','stages'}``,
+            where stages maps each stage to ``{'count','total','p50','p95','max'}`` in seconds.
+            The throughput is over the wall time of the run, in megabytes (10^6 bytes) of source files.
+        """
+        with self._lock:
+            stages = {name:list(values) for name,values in self.stages.items()}
+            files,nbytes = self.files,self.bytes
+        seconds = self.seconds
+        return {
+            'name':self.name,
+            'files':files,
+            'bytes':nbytes,
+            'seconds':round(seconds,6),
+            'files_per_second':round(files/seconds,6) if seconds else None,
+            'mb_per_second':round(nbytes/1e6/seconds,6) if seconds else None,
+            'stages':{name:{'count':len(values),'total':round(sum(values),6),
+                            'p50':round(percentile(values,50),6),'p95':round(percentile(values,95),6),
+                            'max':round(max(values),6)} for name,values in stages.items()},
+        }
+
+    def log(self,logger=LOGGER):
+        """Log the summary of the run, one line per stage."""
+        summary = self.summary()
+        logger.info(f"{summary['files']} files ({summary['bytes']/1e6:.1f} MB) in {summary['seconds']:.2f} s : "
+                    f"{summary['files_per_second'] or 0:.2f} files/s, {summary['mb_per_second'] or 0:.2f} MB/s")
+        for name,stats in summary['stages'].items():
+            logger.info(f"  {name}: n={stats['count']} total={stats['total']:.3f}s p50={stats['p50']:.4f}s p95={stats['p95']:.4f}s max={stats['max']:.4f}s")
+
+    def write(self,path):
+        """Write the summary of the run to a json file.
+
+        Parameters
+        ----------
+
+        path : str | pathlib.Path
+            The path of the report.
+        """
+        path = os.fspath(path)
+        try:
+            os.makedirs(os.path.dirname(path) or '.',exist_ok=True)
+            with open(path,'w',encoding='utf-8') as f:
+                json.dump(self.summary(),f,indent=2)
+        except OSError:
+            LOGGER.warning(f'Could not write the timing report {path}',exc_info=True)
+
+def source_bytes(path):
+    """Get the size of the files of a recording (see sovabids.cache.source_files), 0 if they can't be stat'ed."""
+    total = 0
+    for f in source_files(path):
+        try:
+            total += os.path.getsize(f)
+        except OSError:
+            pass
+    return total
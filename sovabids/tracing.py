@@ -0,0 +1,95 @@
+"""Module with the trace of the activity of the processes and threads of a run.
+
+While a :py:class:`Tracer` is recording, every stage of sovabids.timing run by this
+process or sent back by its workers (ie ``map_file``, ``convert_file``, ``read_raw``,
+``write_raw_bids``, the ``rpc.*`` methods) is kept as a complete event of the
+Chrome Trace Event Format, tagged with the pid and thread id it ran in. The resulting json file can be opened
+in a local trace viewer, ie ``chrome://tracing`` or https://ui.perfetto.dev,
+to see how the work was laid out over time.
+"""
+import os
+import json
+import logging
+import threading
+from contextlib import contextmanager,nullcontext
+
+from sovabids.timing import recording
+
+LOGGER = logging.getLogger(__name__)
+
+class Tracer:
+    """Recorder of the stages of a run as trace events.
+
+    Parameters
+    ----------
+
+    path : str | pathlib.Path
+        The path of the json file the trace is written to.
+
+    Attributes
+    ----------
+
+    events : list of dict
+        The trace events recorded, in the order they finished.
+    """
+    def __init__(self,path):
+        self.path = os.fspath(path)
+        self.events = []
+        self._pids = set()
+        self._lock = threading.Lock()
+
+    def record(self,span):
+        """Add a sovabids.timing.Span as a complete ('X') event, in microseconds."""
+        event = {'name':span.name,'cat':'sovabids','ph':'X',
+                 'ts':round(span.start*1e6,3),'dur':round(span.seconds*1e6,3),
+                 'pid':span.pid,'tid':span.tid}
+        if span.args:
+            event['args'] = {key:str(value) for key,value in span.args.items()}
+        with self._lock:
+            self.events.append(event)
+            self._pids.add(span.pid)
+
+    def _metadata(self):
+        # name the processes so the main one is told apart from the workers
+        main = os.getpid()
+        return [{'name':'process_name','ph':'M','pid':pid,'tid':0,
+                 'args':{'name':'sovabids' if pid == main else f'sovabids worker {pid}'}} for pid in sorted(self._pids)]
+
+    def write(self):
+        """Write the trace recorded so far to its file."""
+        with self._lock:
+            trace = {'traceEvents':self._metadata()+list(self.events),'displayTimeUnit':'ms'}
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.',exist_ok=True)
+            with open(self.path,'w',encoding='utf-8') as f:
+                json.dump(trace,f)
+        except OSError:
+            LOGGER.warning(f'Could not write the trace {self.path}',exc_info=True)
+
+    @contextmanager
+    def recording(self):
+        """Record the stages run while inside the block, writing the trace when it is left."""
+        try:
+            with recording(self):
+                yield self
+        finally:
+            self.write()
+
+def tracing(path=None):
+    """Record a trace of the block if a path is given (ie the --trace option of the console scripts).
+
+    Parameters
+    ----------
+
+    path : str | pathlib.Path | None
+        The path of the trace file. None records nothing.
+
+    Returns
+    -------
+
+    contextmanager :
+        Yielding the Tracer, or None if there is no path.
+    """
+    if path is None:
+        return nullcontext()
+    return Tracer(path).recording()
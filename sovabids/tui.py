@@ -14,6 +14,7 @@ from textual.screen import ModalScreen
 from textual.validation import ValidationResult, Validator
 from textual.widgets import (
     Button,
+    Checkbox,
     DataTable,
     DirectoryTree,
     Footer,
@@ -718,6 +719,10 @@ class RulesPane(Static):
                 classes="pattern-examples",
             ),
             Input(placeholder="%subject%_%task%.vhdr", id="pattern-input"),
+            Checkbox(
+                "Placeholder mode: only scan folders that can match the pattern (written from the source folder; faster on big trees)",
+                id="prune-checkbox",
+            ),
             id="pattern-section",
         )
         with Horizontal(id="preview-row"):
@@ -775,6 +780,16 @@ class RulesPane(Static):
         dropping it (#102)."""
         return _plf_problem(self.query_one("#plf-input", Input).value.strip())
 
+    def on_checkbox_changed(self, event: Checkbox.Changed) -> None:
+        if event.checkbox.id == "prune-checkbox":
+            self._schedule_preview()
+
+    def _get_prune(self) -> bool:
+        try:
+            return bool(self.query_one("#prune-checkbox", Checkbox).value)
+        except Exception:
+            return False
+
     def on_select_changed(self, event: Select.Changed) -> None:
         if event.select.id == "ext-select":
             self._schedule_ext_count()
@@ -1017,10 +1032,10 @@ class RulesPane(Static):
             self._update_show_files_btn([])
             return
         self._set_preview("Scanning…", "muted")
-        self._preview_worker(gen, source, pattern, str(ext), mode, fields)
+        self._preview_worker(gen, source, pattern, str(ext), mode, fields, prune=self._get_prune())
 
     @work(thread=True, exclusive=True, group="preview")
-    def _preview_worker(self, gen: int, source: str, pattern: str, ext: str, mode: str, fields: list[str], io_src: str = "", io_tgt: str = "") -> None:
+    def _preview_worker(self, gen: int, source: str, pattern: str, ext: str, mode: str, fields: list[str], io_src: str = "", io_tgt: str = "", prune: bool = False) -> None:
         from sovabids.parsers import parse_from_placeholder, parse_from_regex
         from sovabids.rules import get_files
 
@@ -1057,6 +1072,8 @@ class RulesPane(Static):
             return
 
         rules = {"non-bids": {"eeg_extension": ext, "path_analysis": {"pattern": pattern}}}
+        if mode == "placeholder":
+            rules["non-bids"]["path_analysis"]["prune"] = prune
         try:
             files = get_files(source, rules)
         except Exception as exc:
@@ -1156,6 +1173,8 @@ class RulesPane(Static):
             path_analysis: dict = {"pattern": rules_pattern}
             if mode == "regex" and fields:
                 path_analysis["fields"] = fields
+            elif mode == "placeholder" and self._get_prune():
+                path_analysis["prune"] = True
             rules["non-bids"]["path_analysis"] = path_analysis
         if plf or ref:
             rules["sidecar"] = {}
@@ -1440,6 +1459,9 @@ class SovabidsApp(App):
     def on_select_changed(self, event: Select.Changed) -> None:
         self._invalidate_mappings_if_edit(event.control)
 
+    def on_checkbox_changed(self, event: Checkbox.Changed) -> None:
+        self._invalidate_mappings_if_edit(event.control)
+
     def on_radio_set_changed(self, event: RadioSet.Changed) -> None:
         self._invalidate_mappings_if_edit(event.control)
 
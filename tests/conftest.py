@@ -0,0 +1,27 @@
+"""Fixtures shared by the tests."""
+
+import pytest
+
+from .test_formats import _make_raw, _write_raw
+
+
+@pytest.fixture
+def vhdr_dataset(tmp_path):
+    """Get a function making a source folder of BrainVision recordings and an empty bids folder.
+
+    ``vhdr_dataset(n=3)`` writes ``00.vhdr``, ``01.vhdr``... in ``tmp_path / "source"`` and
+    returns ``(source, bids)``. With ``bad_file=True`` an unreadable ``99.vhdr`` is added too.
+    """
+    def make(n=3, bad_file=False):
+        source = tmp_path / "source"
+        source.mkdir()
+        bids = tmp_path / "bids"
+        bids.mkdir()
+        raw = _make_raw()
+        for i in range(n):
+            _write_raw(raw, source / f"{i:02d}.vhdr", "vhdr")
+        if bad_file:
+            (source / "99.vhdr").write_text("not a brainvision header")
+        return source, bids
+
+    return make
@@ -0,0 +1,109 @@
+"""Tests for the benchmark suite and the comparison against a baseline."""
+
+from benchmarks.memory import MemoryProfiler, memory_table, profile_recording
+from benchmarks.paths import (
+    PATTERN,
+    bids_path,
+    probes,
+    probes_table,
+    scaling,
+    scaling_table,
+    source_path,
+    synthetic_entities,
+)
+from benchmarks.suite import compare, load_results, run_suite, save_results
+from sovabids.parsers import (
+    parse_entities_from_bidspath,
+    parse_from_placeholder,
+    parse_path_pattern_from_entities,
+)
+from sovabids.timing import stage
+
+
+def _results(**medians):
+    return {"meta": {}, "results": {name: {"median": median} for name, median in medians.items()}}
+
+
+def test_compare_against_a_baseline():
+    baseline = _results(a=1.0, b=1.0, c=1.0, d=0.001, gone=1.0)
+    results = _results(a=1.1, b=1.5, c=0.5, d=0.003, added=1.0)
+    rows = {row["name"]: row for row in compare(results, baseline, threshold=0.25)}
+    assert rows["a"]["status"] == "ok"
+    assert rows["b"]["status"] == "regression"
+    assert rows["b"]["ratio"] == 1.5
+    assert rows["c"]["status"] == "improvement"
+    assert rows["d"]["status"] == "ok"  # 3x slower but within the noise
+    assert rows["gone"]["status"] == "missing"
+    assert rows["added"]["status"] == "new"
+    rows = {row["name"]: row for row in compare(results, baseline, threshold=0.6)}
+    assert rows["b"]["status"] == "ok"
+
+
+def test_run_suite(tmp_path):
+    params = {"files": 2, "channels": 4, "duration": 2, "format": "vhdr"}
+    results = run_suite([params], workdir=str(tmp_path), repeats=2,
+                        benchmarks=("get_files", "apply_rules", "convert_them"))
+    names = sorted(results["results"])
+    assert names == ["apply_rules[vhdr-2f-4ch-2s]", "convert_them[vhdr-2f-4ch-2s]", "get_files[vhdr-2f-4ch-2s]"]
+    for result in results["results"].values():
+        assert len(result["times"]) == 2
+        assert result["min"] <= result["median"]
+    assert (tmp_path / "datasets" / "vhdr-2f-4ch-2s" / "source").is_dir()
+    assert not (tmp_path / "bids").exists()
+
+    save_results(results, tmp_path / "results.json")
+    assert all(row["status"] == "ok" for row in
+               compare(load_results(tmp_path / "results.json"), results))
+
+
+def test_memory_profiler_measures_nested_stages():
+    def work():
+        with stage("outer"):
+            buffer = bytearray(40 * 2**20)
+            with stage("inner"):
+                other = bytearray(10 * 2**20)
+                del other
+            del buffer
+
+    profiler = MemoryProfiler()
+    profiler.profile(work)
+    peaks = {row["stage"]: row["traced_peak"] / 2**20 for row in profiler.stages}
+    assert [row["stage"] for row in profiler.stages] == ["inner", "outer", "total"]
+    # a few bytes of slack for the allocations of the interpreter between the stages
+    assert 9.5 <= peaks["inner"] < 20
+    assert 49.5 <= peaks["outer"] < 60
+    assert peaks["total"] >= peaks["outer"]
+
+
+def test_profile_recording(tmp_path):
+    rows = profile_recording(str(tmp_path), {"channels": 4, "duration": 10, "format": "vhdr"})
+    runs = {(row["run"], row["chunk_size"]) for row in rows}
+    assert len(runs) == 4
+    stages = {row["stage"] for row in rows}
+    assert {"read_raw", "write_raw_bids", "sidecar_json", "channels_tsv", "total"} <= stages
+    assert "write_raw_bids" in memory_table(rows)
+
+
+def test_synthetic_paths_parse_back():
+    entities = synthetic_entities(12)
+    parsed = parse_from_placeholder(source_path(12), PATTERN)["entities"]
+    assert parsed == {"task": entities["task"], "session": entities["ses"], "subject": entities["sub"],
+                      "acquisition": entities["acq"], "run": entities["run"]}
+    assert parse_entities_from_bidspath(bids_path(12)) == entities
+    assert parse_path_pattern_from_entities(source_path(12), entities) == PATTERN
+
+
+def test_path_parsers_scale_flat():
+    rows = scaling(counts=(10**3, 10**4), repeats=3, tolerance=1.0)
+    assert len(rows) == 6
+    assert all(row["flat"] for row in rows), scaling_table(rows)
+
+
+def test_backtracking_probes_time_out():
+    rows = probes(("greedy_groups_6", "deep_merge_N_length"), timeout=1, repeats=1)
+    greedy = [row for row in rows if row["probe"] == "greedy_groups_6"]
+    assert greedy[0]["seconds"] is not None
+    assert greedy[-1]["seconds"] is None  # backtracks for longer than the timeout
+    lengths = [row for row in rows if row["probe"] == "deep_merge_N_length"]
+    assert lengths[1]["exponent"] is not None
+    assert "timeout" in probes_table(rows)
@@ -0,0 +1,97 @@
+"""Tests for the incremental mapping cache of apply_rules."""
+
+import logging
+import os
+
+from sovabids.rules import apply_rules
+
+from .test_formats import _make_raw, _rules, _write_raw
+
+
+def _mapping_logs(caplog):
+    return [r.getMessage() for r in caplog.records if r.getMessage().startswith("Mapping cache")]
+
+
+def test_apply_rules_reuses_unchanged_files(vhdr_dataset, caplog):
+    source, bids = vhdr_dataset()
+    rules = _rules("vhdr", source, bids)
+    cache_file = bids / "code" / "sovabids" / "mappings_cache.jsonl"
+
+    with caplog.at_level(logging.INFO, logger="sovabids.rules"):
+        first = apply_rules(str(source), str(bids), rules)
+        assert cache_file.is_file()
+        assert _mapping_logs(caplog)[-1] == "Mapping cache: 0 hit(s), 3 miss(es)."
+
+        # A new subject and a changed file are the only ones mapped again
+        _write_raw(_make_raw(), source / "03.vhdr", "vhdr")
+        stat = os.stat(source / "00.vhdr")
+        os.utime(source / "00.vhdr", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        second = apply_rules(str(source), str(bids), rules)
+        assert _mapping_logs(caplog)[-1] == "Mapping cache: 2 hit(s), 2 miss(es)."
+        by_source = {m["IO"]["source"]: m for m in second["Individual"]}
+        assert len(by_source) == 4
+        for mapping in first["Individual"]:
+            assert by_source[mapping["IO"]["source"]] == mapping
+
+        # Changing the rules invalidates the whole cache
+        rules["entities"]["task"] = "other"
+        third = apply_rules(str(source), str(bids), rules, jobs=2)
+        assert _mapping_logs(caplog)[-1] == "Mapping cache: 0 hit(s), 4 miss(es)."
+        assert all(m["entities"]["task"] == "other" for m in third["Individual"])
+
+        fourth = apply_rules(str(source), str(bids), rules, jobs=2)
+        assert _mapping_logs(caplog)[-1] == "Mapping cache: 4 hit(s), 0 miss(es)."
+        assert fourth["Individual"] == third["Individual"]
+
+        logs = len(_mapping_logs(caplog))
+        apply_rules(str(source), str(bids), rules, use_cache=False)
+        assert len(_mapping_logs(caplog)) == logs
+
+
+def test_mapping_cache_tracks_companions_and_copies(tmp_path):
+    from sovabids.cache import MappingCache
+
+    vhdr = tmp_path / "00.vhdr"
+    vmrk = tmp_path / "00.vmrk"
+    vhdr.write_text("header")
+    vmrk.write_text("markers")
+    cache = MappingCache(tmp_path / "cache.jsonl", "fingerprint")
+    cache.put(str(vhdr), {"entities": {"subject": "00"}})
+    cache.save()
+
+    cache = MappingCache(tmp_path / "cache.jsonl", "fingerprint")
+    mapping = cache.get(str(vhdr))
+    mapping["entities"]["subject"] = "changed"
+    assert cache.get(str(vhdr)) == {"entities": {"subject": "00"}}
+
+    # A changed companion file invalidates the entry
+    vmrk.write_text("other markers")
+    assert MappingCache(tmp_path / "cache.jsonl", "fingerprint").get(str(vhdr)) is None
+
+
+def test_mapping_cache_keeps_the_sections_of_other_fingerprints(tmp_path):
+    from sovabids.cache import MAX_SECTIONS, MappingCache
+
+    vhdr = tmp_path / "00.vhdr"
+    vhdr.write_text("header")
+    path = tmp_path / "cache.jsonl"
+    # ie sovapply and sovarun with different probes, alternating, one of them interrupted
+    for fingerprint in ("mne", "header", "mne", "header"):
+        cache = MappingCache(path, fingerprint)
+        if cache.get(str(vhdr)) is None:
+            cache.put(str(vhdr), {"probe": fingerprint})
+        if fingerprint == "mne":
+            cache.save()
+    for fingerprint in ("mne", "header"):
+        cache = MappingCache(path, fingerprint)
+        assert cache.get(str(vhdr)) == {"probe": fingerprint}
+        assert cache.misses == 0
+        cache.save()
+
+    # Only the most recently used fingerprints are kept
+    for i in range(MAX_SECTIONS):
+        cache = MappingCache(path, str(i))
+        cache.put(str(vhdr), {"probe": i})
+        cache.save()
+    assert MappingCache(path, "header").get(str(vhdr)) is None
+    assert MappingCache(path, "1").get(str(vhdr)) == {"probe": 1}
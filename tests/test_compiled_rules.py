@@ -0,0 +1,57 @@
+"""Tests for rules.CompiledRules (path analysis compiled once per run)."""
+import pickle
+
+import pytest
+
+from sovabids.rules import CompiledRules, get_info_from_path
+
+
+def _rules(**path_analysis):
+    return {
+        'entities': {'task': 'rest'},
+        'dataset_description': {'Name': 'Compiled', 'Authors': ['A1', 'A2']},
+        'channels': {'type': {'heo': 'HEOG', 'veo': 'VEOG', 'foo': 'NOTATYPE'}},
+        'non-bids': {'eeg_extension': ['.vhdr'], 'path_analysis': path_analysis},
+    }
+
+
+def test_placeholder_and_regex_match_uncompiled():
+    path = 'data/T01/SA/subXY_1.vhdr'
+    placeholder = _rules(pattern='T%entities.task%/S%entities.session%/sub%entities.subject%_%entities.run%.vhdr')
+    regex = _rules(pattern=r'T(.+)\/S(.+)\/sub(.+)_(.+).vhdr',
+                   fields=['entities.task', 'entities.session', 'entities.subject', 'entities.run'])
+    for rules in (placeholder, regex):
+        compiled = CompiledRules(rules)
+        result = get_info_from_path(path, compiled)
+        assert result == get_info_from_path(path, rules)
+        assert result['entities'] == {'task': '01', 'session': 'A', 'subject': 'XY', 'run': '1'}
+
+
+def test_operation_and_ignore():
+    rules = _rules(pattern='%a%_%b%_%entities.task%.set', operation={'entities.subject': '[a] + [b]'})
+    compiled = CompiledRules(rules)
+    assert compiled.parse_path('Healthy_01_EyesOpen.set') == {
+        'a': 'Healthy', 'b': '01', 'entities': {'task': 'EyesOpen', 'subject': 'Healthy01'}}
+    # operations survive pickling (ie sending the rules to worker processes)
+    compiled = pickle.loads(pickle.dumps(compiled))
+    assert compiled.parse_path('Control_02_EyesOpen.set')['entities']['subject'] == 'Control02'
+
+
+def test_no_pattern_and_no_match():
+    compiled = CompiledRules(_rules())
+    assert compiled.pattern is None
+    assert compiled.info_from_path('any/path.vhdr')['entities'] == {'task': 'rest'}
+    compiled = CompiledRules(_rules(pattern='sub-%entities.subject%.vhdr'))
+    with pytest.raises(AttributeError):
+        compiled.info_from_path('nothing/here.edf')
+
+
+def test_channel_types_and_copies():
+    compiled = CompiledRules(_rules(pattern='sub-%entities.subject%.vhdr'))
+    assert compiled.mne_channel_types == {'heo': 'eog', 'veo': 'eog'}
+    first = compiled.info_from_path('sub-1.vhdr')
+    second = compiled.info_from_path('sub-2.vhdr')
+    # every mapping owns its data, so editing (or dumping) one doesn't affect the others
+    assert first['dataset_description']['Authors'] is not second['dataset_description']['Authors']
+    first['non-bids']['eeg_extension'].append('.edf')
+    assert compiled.rules['non-bids']['eeg_extension'] == ['.vhdr']
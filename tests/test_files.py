@@ -0,0 +1,78 @@
+"""Tests for the scandir based file scanner."""
+import os
+
+import pytest
+
+from sovabids.files import COPY_MODES, iter_files, transfer_file
+from sovabids.rules import get_files
+
+
+def _walk_files(root):
+    return [os.path.join(r, name).replace('\\', '/')
+            for r, _, files in os.walk(root, topdown=False) for name in files]
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for sub in ("a/x", "a/y/z", "b", "c.d/e"):
+        (tmp_path / sub).mkdir(parents=True)
+    for i, f in enumerate(("a/x/sub-1.vhdr", "a/x/sub-1.eeg", "a/y/z/sub-2.vhdr", "a/y/z/sub-2.VHDR",
+                           "b/sub-3.edf", "c.d/e/sub-4.vhdr", "top.vhdr", "noext")):
+        (tmp_path / f).write_text(str(i))
+    if hasattr(os, "symlink"):
+        os.symlink(tmp_path / "a", tmp_path / "link_to_a")  # not followed, as os.walk
+    return tmp_path
+
+
+@pytest.mark.parametrize("threads", [None, 4])
+def test_iter_files_matches_os_walk(tree, threads):
+    assert list(iter_files(tree, threads=threads)) == _walk_files(tree)
+
+
+@pytest.mark.parametrize("threads", [None, 3])
+def test_get_files_single_pass_filters(tree, threads):
+    rules = {"non-bids": {"eeg_extension": ["vhdr", ".edf"],
+                          "file_filter": [{"include": "sub-"}, {"exclude": r"c\.d"}, {"exclude": "sub-3"}]}}
+    expected = [f for f in _walk_files(tree)
+                if os.path.splitext(f)[1] in (".vhdr", ".edf") and "sub-" in f and "c.d" not in f and "sub-3" not in f]
+    files = get_files(str(tree), rules, threads=threads)
+    assert files == expected
+    assert sorted(os.path.basename(f) for f in files) == ["sub-1.vhdr", "sub-2.vhdr"]
+
+
+def test_get_files_prunes_folders_outside_the_pattern(tmp_path):
+    source = tmp_path / "source"
+    keep = ["T01/SA/subXY_1.vhdr", "T02/SB/subZ_2.vhdr"]
+    skip = ["derivatives/T01/SA/subXY_1.vhdr", "T01/SA/extra/subXY_1.vhdr", "T01/notes/subXY_1.vhdr"]
+    for f in keep + skip:
+        (source / f).parent.mkdir(parents=True, exist_ok=True)
+        (source / f).write_text("")
+    path_analysis = {"pattern": "T%entities.task%/S%entities.session%/sub%entities.subject%_%entities.run%.vhdr"}
+    rules = {"non-bids": {"eeg_extension": ".vhdr", "path_analysis": path_analysis}}
+
+    everything = get_files(str(source), rules)
+    assert len(everything) == 5
+    path_analysis["prune"] = True
+    for threads in (None, 2):
+        pruned = get_files(str(source), rules, threads=threads)
+        assert sorted(pruned) == sorted(str(source / f) for f in keep)
+    # The pattern may also start above the source path
+    assert get_files(str(source / "T01"), rules) == [str(source / keep[0])]
+    # Regex patterns can't be pruned, every folder is scanned
+    rules["non-bids"]["path_analysis"] = {"pattern": r"T(.+)/S(.+)/sub(.+)_(.+)\.vhdr", "prune": True,
+                                         "fields": ["entities.task", "entities.session", "entities.subject", "entities.run"]}
+    assert len(get_files(str(source), rules)) == 5
+
+
+def test_transfer_file_modes(tmp_path):
+    src = tmp_path / "a.eeg"
+    src.write_bytes(b"data")
+    for mode in COPY_MODES:
+        dst = tmp_path / f"{mode}.eeg"
+        dst.write_bytes(b"old")
+        used = transfer_file(src, dst, mode)
+        assert used in (mode, "copy")  # reflink and hardlink fall back to copying
+        assert dst.read_bytes() == b"data"
+        assert os.path.samefile(src, dst) == (used == "hardlink")
+    with pytest.raises(ValueError):
+        transfer_file(src, tmp_path / "b.eeg", "symlink")
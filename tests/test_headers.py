@@ -0,0 +1,125 @@
+"""Tests for the header-only readers used when mapping files."""
+
+import mne
+import pytest
+
+from sovabids.headers import header_from_raw, infer_datatype, path_header, read_header
+from sovabids.rules import apply_rules, apply_rules_to_single_file
+
+from .test_formats import _make_raw, _rules, _write_raw
+
+# (extension, optional_dep_required_to_write_it)
+FORMATS = [
+    ("vhdr", "pybv"),
+    ("edf", "edfio"),
+    ("bdf", "edfio"),
+    ("set", "eeglabio"),
+    ("fif", None),
+]
+
+
+@pytest.mark.parametrize("ext,dep", FORMATS, ids=[f[0] for f in FORMATS])
+def test_header_matches_mne(ext, dep, tmp_path):
+    if dep:
+        pytest.importorskip(dep)
+    raw = _make_raw()
+    raw.rename_channels({"Oz": "Status"})
+    fname = tmp_path / f"01.{ext}"
+    _write_raw(raw, fname, ext)
+
+    header = read_header(fname)
+    expected = header_from_raw(mne.io.read_raw(fname), str(fname))
+    for key in ("sfreq", "n_samples", "ch_names", "ch_types", "datatype"):
+        assert header[key] == expected[key], key
+    assert header["reader"] == ("mne" if ext == "fif" else "header")
+
+
+def test_set_with_embedded_data_falls_back_to_mne(tmp_path):
+    scipy_io = pytest.importorskip("scipy.io")
+    import numpy as np
+
+    fname = tmp_path / "01.set"
+    eeg = {"srate": 250.0, "pnts": 10, "trials": 1, "nbchan": 2, "data": np.zeros((2, 10))}
+    scipy_io.savemat(str(fname), {"EEG": eeg})
+    with pytest.raises(NotImplementedError):  # the whole struct, data included, would be loaded
+        read_header(fname, fallback=False)
+    (tmp_path / "01.fdt").write_bytes(b"")
+    eeg["data"] = "01.fdt"
+    scipy_io.savemat(str(fname), {"EEG": eeg})
+    header = read_header(fname, fallback=False)
+    assert header["sfreq"] == 250.0
+    assert header["ch_names"] == ["EEG 000", "EEG 001"]
+
+
+def test_infer_datatype():
+    assert infer_datatype(["eeg", "eog", "stim"]) == "eeg"
+    assert infer_datatype(["eeg", "seeg"]) == "ieeg"
+    assert infer_datatype(["grad", "mag", "eeg"]) == "meg"
+    with pytest.raises(ValueError):
+        infer_datatype(["misc", "stim"])
+    with pytest.raises(ValueError):
+        infer_datatype(["mag", "ecog"])
+
+
+def test_bad_header_raises(tmp_path):
+    fname = tmp_path / "bad.vhdr"
+    fname.write_text("not a brainvision header")
+    with pytest.raises(ValueError):
+        read_header(fname, fallback=False)
+
+
+@pytest.mark.parametrize("ext,dep", FORMATS[:2], ids=[f[0] for f in FORMATS[:2]])
+def test_probe_header_mapping_matches_mne(ext, dep, tmp_path):
+    pytest.importorskip(dep)
+    source = tmp_path / "source"
+    source.mkdir()
+    bids = tmp_path / "bids"
+    bids.mkdir()
+    for i in range(2):
+        _write_raw(_make_raw(), source / f"{i:02d}.{ext}", ext)
+    rules = _rules(ext, source, bids)
+    rules["channels"] = {"name": {"Fp1": "Fpz"}, "type": {"Fpz": "EOG", "Cz": "MISC"}}
+
+    header = apply_rules(str(source), str(bids), rules, persist=False, probe="header")
+    full = apply_rules(str(source), str(bids), rules, persist=False, probe="mne")
+    assert len(header["Individual"]) == 2
+    assert header["Individual"] == full["Individual"]
+
+    # Renaming a channel that doesn't exist fails as with MNE
+    rules["channels"] = {"name": {"Nope": "Fpz"}}
+    with pytest.raises(ValueError):
+        apply_rules_to_single_file(str(source / f"00.{ext}"), rules, str(bids), persist=False, probe="header")
+
+
+def test_probe_none_never_opens_the_files(tmp_path):
+    pytest.importorskip("pybv")
+    source = tmp_path / "source"
+    source.mkdir()
+    bids = tmp_path / "bids"
+    bids.mkdir()
+    _write_raw(_make_raw(), source / "00.vhdr", "vhdr")
+    rules = _rules("vhdr", source, bids)
+    rules["channels"] = {"name": {"Fp1": "Fpz"}, "type": {"Fpz": "EOG"}}
+
+    # Same mapping as reading the header for a real recording
+    header = apply_rules(str(source), str(bids), rules, persist=False, probe="header")
+    path_only = apply_rules(str(source), str(bids), rules, persist=False, probe="none")
+    assert path_only["Individual"] == header["Individual"]
+
+    # A file that is not a recording still maps to its target
+    (source / "01.vhdr").write_text("not a brainvision header")
+    mapping, _ = apply_rules_to_single_file(str(source / "01.vhdr"), rules, str(bids), persist=False, probe="none")
+    assert mapping["IO"]["target"].endswith("sub-01_task-test_eeg.vhdr")
+    with pytest.raises(IOError):
+        apply_rules_to_single_file(str(source / "01.vhdr"), rules, str(bids), persist=False, probe="header")
+
+    # The datatype comes from the rules or the extension
+    rules["channels"]["type"] = {"Fpz": "SEEG"}
+    mapping, _ = apply_rules_to_single_file(str(source / "01.vhdr"), rules, str(bids), persist=False, probe="none")
+    assert "/ieeg/" in mapping["IO"]["target"]
+    rules["non-bids"]["datatype"] = "eeg"
+    mapping, _ = apply_rules_to_single_file(str(source / "01.vhdr"), rules, str(bids), persist=False, probe="none")
+    assert "/eeg/" in mapping["IO"]["target"]
+    assert path_header("run.fif")["datatype"] == "meg"
+    assert path_header("rec.ds/rec.meg4")["datatype"] == "meg"
+    assert path_header("rec.edf")["datatype"] == "eeg"
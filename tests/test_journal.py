@@ -0,0 +1,214 @@
+"""Tests for the conversion journal and the resume mode of convert_them."""
+
+import json
+import os
+
+from sovabids.convert import convert_them
+from sovabids.journal import ConversionJournal
+from sovabids.rules import apply_rules
+
+from .test_formats import _make_raw, _rules, _write_raw
+
+
+def _journal_states(bids):
+    journal = bids / "code" / "sovabids" / "convert_journal.jsonl"
+    return {e["source"]: e["state"] for e in map(json.loads, journal.read_text().splitlines())}
+
+
+def test_journal_keeps_the_last_state(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = ConversionJournal(path)
+    journal.mark("a", "A", "running")
+    journal.mark("a", "A", "done")
+    journal.mark("b", "B", "running")
+    # as if the run crashed here, with a line cut in half
+    with open(path, "a") as f:
+        f.write('{"source": "c", "sta')
+
+    journal = ConversionJournal(path)
+    assert journal.state("a") == "done"
+    assert journal.state("a", "other target") is None
+    assert journal.state("b") == "running"
+    assert journal.state("c") is None
+    assert journal.entries["a"]["seconds"] >= 0
+    journal.save()
+    assert len(path.read_text().splitlines()) == 2
+
+
+def test_convert_them_resumes_unfinished_files(vhdr_dataset):
+    source, bids = vhdr_dataset()
+    mappings = apply_rules(str(source), str(bids), _rules("vhdr", source, bids), persist=False)
+    sources = [m["IO"]["source"] for m in mappings["Individual"]]
+
+    result = convert_them(mappings)
+    assert result["succeeded"] == sources
+    assert set(_journal_states(bids).values()) == {"done"}
+    assert not (bids / "code" / "sovabids" / "staging").exists()
+
+    # Simulate a crash while converting 01 (the files are listed in the order of the directory)
+    by_name = {os.path.basename(m["IO"]["source"]): m for m in mappings["Individual"]}
+    journal = ConversionJournal(bids / "code" / "sovabids" / "convert_journal.jsonl")
+    journal.mark(by_name["01.vhdr"]["IO"]["source"], by_name["01.vhdr"]["IO"]["target"], "running")
+    journal.save()
+    for f in bids.rglob("sub-00*eeg.vhdr"):  # done files are not checked on disk
+        f.unlink()
+
+    result = convert_them(mappings, resume=True)
+    assert result["succeeded"] == [by_name["01.vhdr"]["IO"]["source"]]
+    assert sorted(result["skipped"]) == [by_name["00.vhdr"]["IO"]["source"], by_name["02.vhdr"]["IO"]["source"]]
+    assert set(_journal_states(bids).values()) == {"done"}
+
+    # Without resume the output files are checked
+    result = convert_them(mappings)
+    assert result["succeeded"] == [by_name["00.vhdr"]["IO"]["source"]]
+
+
+def test_convert_them_reconverts_changed_files(vhdr_dataset):
+    source, bids = vhdr_dataset()
+    mappings = apply_rules(str(source), str(bids), _rules("vhdr", source, bids), persist=False)
+    sources = [m["IO"]["source"] for m in mappings["Individual"]]
+    by_name = {os.path.basename(m["IO"]["source"]): m for m in mappings["Individual"]}
+    convert_them(mappings)
+
+    # Touched but not changed
+    stat = os.stat(source / "00.vhdr")
+    os.utime(source / "00.vhdr", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    # Re-exported with other data
+    _write_raw(_make_raw().apply_function(lambda x: x * 2), source / "01.vhdr", "vhdr")
+    # Mapping changed
+    by_name["02.vhdr"]["sidecar"]["PowerLineFrequency"] = 60
+
+    result = convert_them(mappings)
+    assert sorted(result["succeeded"]) == [by_name["01.vhdr"]["IO"]["source"], by_name["02.vhdr"]["IO"]["source"]]
+    assert result["skipped"] == [by_name["00.vhdr"]["IO"]["source"]]
+
+    result = convert_them(mappings)
+    assert result["skipped"] == sources
+
+
+def test_patch_metadata_leaves_the_data(vhdr_dataset):
+    from sovabids.convert import patch_metadata
+
+    source, bids = vhdr_dataset()
+    mappings = apply_rules(str(source), str(bids), _rules("vhdr", source, bids), persist=False)
+    sources = [m["IO"]["source"] for m in mappings["Individual"]]
+    convert_them(mappings)
+    data = {f: f.stat().st_mtime_ns for f in bids.rglob("*_eeg.eeg")}
+
+    for mapping in mappings["Individual"]:
+        mapping["sidecar"]["EEGReference"] = "Cz"
+        mapping["channels"] = {"type": {"Fp1": "EOG"}}
+    mappings["General"]["dataset_description"]["Name"] = "Patched"
+    result = patch_metadata(mappings, jobs=2)
+
+    assert result["succeeded"] == sources
+    for sidecar in bids.rglob("*_eeg.json"):
+        assert json.loads(sidecar.read_text())["EEGReference"] == "Cz"
+    for channels in bids.rglob("*_channels.tsv"):
+        assert "Fp1\tEOG" in channels.read_text()
+    assert json.loads((bids / "dataset_description.json").read_text())["Name"] == "Patched"
+    assert {f: f.stat().st_mtime_ns for f in bids.rglob("*_eeg.eeg")} == data
+
+    # The journal knows the outputs match the new mappings
+    assert convert_them(mappings)["skipped"] == sources
+
+
+def test_patch_metadata_leaves_other_changes_pending(vhdr_dataset):
+    from sovabids.convert import patch_metadata
+
+    source, bids = vhdr_dataset(2)
+    mappings = apply_rules(str(source), str(bids), _rules("vhdr", source, bids), persist=False)
+    sources = [m["IO"]["source"] for m in mappings["Individual"]]
+    convert_them(mappings)
+
+    # A rename changes the data files, patching the metadata doesn't make them up to date
+    for mapping in mappings["Individual"]:
+        mapping["channels"] = {"name": {"Fp1": "Fp1x"}, "type": {"Fp2": "EOG"}}
+    assert patch_metadata(mappings)["succeeded"] == sources
+    assert set(_journal_states(bids).values()) == {"pending"}
+
+    assert sorted(convert_them(mappings, resume=True)["succeeded"]) == sorted(sources)
+    for channels in bids.rglob("*_channels.tsv"):
+        assert "Fp1x\t" in channels.read_text()
+    assert convert_them(mappings)["skipped"] == sources
+
+
+def test_remap_outputs_moves_the_files(vhdr_dataset):
+    import mne
+
+    from sovabids.convert import remap_outputs
+
+    source, bids = vhdr_dataset(2)
+    rules = _rules("vhdr", source, bids)
+    rules["entities"]["session"] = "A"
+    old = apply_rules(str(source), str(bids), rules, persist=False)
+    sources = [m["IO"]["source"] for m in old["Individual"]]
+    convert_them(old)
+
+    rules["entities"]["session"] = "B"
+    new = apply_rules(str(source), str(bids), rules, persist=False)
+    result = remap_outputs(new, jobs=2)
+
+    assert result["succeeded"] == sources
+    assert not any(bids.rglob("ses-A"))
+    for mapping in new["Individual"]:
+        target = mapping["IO"]["target"]
+        assert "ses-B" in target
+        assert mne.io.read_raw(target).n_times == _make_raw().n_times
+        scans = next(bids.rglob("*ses-B_scans.tsv")).read_text()
+        assert "ses-B" in scans and "ses-A" not in scans
+    assert convert_them(new)["skipped"] == sources
+
+
+def test_remap_outputs_moves_the_session_files(tmp_path):
+    from sovabids.convert import remap_outputs
+
+    source = tmp_path / "source"
+    source.mkdir()
+    bids = tmp_path / "bids"
+    for run in ("01", "02"):
+        _write_raw(_make_raw(), source / f"{run}.fif", "fif")
+    rules = _rules("fif", source, bids)
+    rules["entities"].update(subject="01", session="A")
+    rules["non-bids"]["path_analysis"]["fields"] = ["entities.run"]
+    old = apply_rules(str(source), str(bids), rules, persist=False)
+    sources = [m["IO"]["source"] for m in old["Individual"]]
+    convert_them(old)
+    ses_a = bids / "sub-01" / "ses-A" / "eeg"
+    shared = sorted(f.name for f in ses_a.iterdir() if f.name.endswith(("_electrodes.tsv", "_coordsystem.json")))
+    assert len(shared) == 2
+
+    # Run 01 still uses the electrodes of session A, they are copied
+    rules["entities"]["session"] = "B"
+    new = apply_rules(str(source), str(bids), rules, persist=False)
+    partial = dict(new, Individual=[o if o["IO"]["source"] == sources[0] else n for o, n in zip(old["Individual"], new["Individual"])])
+    assert remap_outputs(partial)["succeeded"] == sources[1:]
+    ses_b = bids / "sub-01" / "ses-B" / "eeg"
+    assert sorted(f.name for f in ses_a.iterdir() if f.name in shared) == shared
+    assert sorted(f.name for f in ses_b.iterdir() if f.name.endswith(("_electrodes.tsv", "_coordsystem.json"))) == [
+        name.replace("ses-A", "ses-B") for name in shared
+    ]
+
+    # They go away with the last recording of the session
+    assert remap_outputs(new)["succeeded"] == sources[:1]
+    assert not any(bids.rglob("ses-A"))
+    assert convert_them(new)["skipped"] == sources
+
+
+def test_rename_recording_keeps_the_split_parts(tmp_path):
+    from sovabids.bids import recording_files, rename_recording
+
+    folder = tmp_path / "sub-01" / "meg"
+    folder.mkdir(parents=True)
+    names = ["sub-01_task-a_split-01_meg.fif", "sub-01_task-a_split-02_meg.fif", "sub-01_task-a_meg.json",
+             "sub-01_task-a_run-1_meg.fif", "sub-01_coordsystem.json"]
+    for name in names:
+        (folder / name).write_text(name)
+
+    files = recording_files(folder / "sub-01_task-a_meg.fif")
+    assert [os.path.basename(f) for f in files] == sorted(names[:3] + names[4:])
+
+    moved = rename_recording(files, tmp_path / "sub-02" / "meg" / "sub-02_task-b_meg.fif")
+    assert sorted(os.path.basename(f) for f in moved) == [
+        "sub-02_coordsystem.json", "sub-02_task-b_meg.json", "sub-02_task-b_split-01_meg.fif", "sub-02_task-b_split-02_meg.fif"
+    ]
@@ -0,0 +1,160 @@
+"""Tests for the streaming mapping API and the mappings files."""
+
+import json
+import os
+
+import yaml
+
+from sovabids.convert import convert_them
+from sovabids.mappings import (JsonlMappings, MappingsWriter, compress_mapping, compress_mappings,
+                                expand_mapping, expand_mappings, is_delta, load_mappings, save_mappings)
+from sovabids.rules import apply_rules, iter_apply_rules, load_rules
+
+from .test_formats import _rules
+
+
+def test_iter_apply_rules_yields_mappings_and_errors(vhdr_dataset):
+    source, bids = vhdr_dataset(4, bad_file=True)
+    bad = str(source / "99.vhdr")
+    rules = _rules("vhdr", source, bids)
+
+    for jobs in (1, 2):
+        results = list(iter_apply_rules(str(source), str(bids), rules, persist=False, jobs=jobs))
+        assert len(results) == 5
+        errors = {f: r for f, r in results if isinstance(r, Exception)}
+        assert list(errors) == [bad]
+        for f, mapping in results:
+            if f != bad:
+                assert mapping["IO"]["source"] == f
+
+
+def test_mappings_file_is_written_incrementally(tmp_path, vhdr_dataset):
+    source, bids = vhdr_dataset(4, bad_file=True)
+    rules = _rules("vhdr", source, bids)
+    mappings_file = tmp_path / "mappings.yml"
+
+    mapping_data = apply_rules(str(source), str(bids), rules, mapping_path=str(mappings_file))
+    assert mappings_file.read_text() == yaml.dump(mapping_data, default_flow_style=False)
+    assert load_rules(str(mappings_file)) == mapping_data
+
+    # A writer that is never closed still leaves a readable file with what was written
+    general = mapping_data["General"]
+    partial = tmp_path / "partial.yml"
+    writer = MappingsWriter(partial, general)
+    for mapping in mapping_data["Individual"][:2]:
+        writer.write(mapping)
+    assert load_rules(str(partial)) == {"General": general, "Individual": mapping_data["Individual"][:2]}
+    writer.close()
+
+    with MappingsWriter(tmp_path / "empty.yml", general):
+        pass
+    assert load_rules(str(tmp_path / "empty.yml")) == {"General": general, "Individual": []}
+
+
+def test_jsonl_mappings_roundtrip_and_lazy_access(tmp_path, vhdr_dataset):
+    source, bids = vhdr_dataset(4, bad_file=True)
+    rules = _rules("vhdr", source, bids)
+    mappings_file = tmp_path / "mappings.jsonl"
+
+    mapping_data = apply_rules(str(source), str(bids), rules, mapping_path=str(mappings_file))
+    mappings = load_mappings(mappings_file)
+    assert isinstance(mappings, JsonlMappings)
+    assert mappings.general == json.loads(json.dumps(mapping_data["General"]))
+    assert len(mappings) == 4
+    assert list(mappings) == mapping_data["Individual"]
+    assert mappings[-1] == mapping_data["Individual"][-1]
+    assert mappings[1:3] == mapping_data["Individual"][1:3]
+
+    # Without (or with a stale) index the offsets are rebuilt from the file
+    os.remove(str(mappings_file) + ".idx")
+    assert list(load_mappings(mappings_file)) == mapping_data["Individual"]
+
+    # A last line cut by a crash is left out
+    with open(mappings_file, "a") as f:
+        f.write('{"IO": {"sou')
+    assert list(load_mappings(mappings_file)) == mapping_data["Individual"]
+
+    yaml_mappings = load_mappings(mapping_data)
+    assert yaml_mappings.to_dict() == mapping_data
+
+
+def test_convert_them_from_jsonl(tmp_path, vhdr_dataset):
+    source, bids = vhdr_dataset(2, bad_file=True)
+    rules = _rules("vhdr", source, bids)
+    mappings_file = tmp_path / "mappings.jsonl"
+    mapping_data = apply_rules(str(source), str(bids), rules, mapping_path=str(mappings_file))
+
+    for jobs in (1, 2):
+        result = convert_them(str(mappings_file), jobs=jobs)
+        assert len(result["succeeded"]) + len(result["skipped"]) == 2
+        assert result["failed"] == []
+    for mapping in mapping_data["Individual"]:
+        assert os.path.isfile(mapping["IO"]["target"])
+
+
+def test_delta_mappings_roundtrip(tmp_path):
+    general = {
+        "entities": {"task": "rest"},
+        "channels": {"type": {"HEOG": "EOG", "x.y": "MISC"}, "name": {"a": "b"}},
+        "sidecar": {"PowerLineFrequency": 50, "EEGReference": None},
+        "non-bids": {"eeg_extension": [".vhdr"]},
+        "IO": {"source": "src", "target": "bids"},
+    }
+    mapping = {
+        "entities": {"task": "rest", "subject": "01"},
+        "channels": {"type": {"HEOG": "EOG"}, "name": {"a": "c"}},
+        "sidecar": {"PowerLineFrequency": 60.0, "EEGReference": None},
+        "non-bids": {"eeg_extension": [".vhdr"]},
+        "IO": {"source": "src/01.vhdr", "target": "bids/sub-01/eeg/sub-01_task-rest_eeg.vhdr"},
+    }
+    delta = compress_mapping(mapping, general)
+    assert is_delta(delta)
+    assert delta["entities"] == {"subject": "01"}
+    assert delta["Delta"]["removed"] == [["channels", "type", "x.y"]]
+    assert "non-bids" not in delta
+    assert expand_mapping(delta, general) == mapping
+    assert expand_mapping(mapping, general) is mapping
+
+
+def test_delta_mappings_files_and_conversion(tmp_path, vhdr_dataset):
+    source, bids = vhdr_dataset(2, bad_file=True)
+    rules = _rules("vhdr", source, bids)
+    full = apply_rules(str(source), str(bids), rules, mapping_path=str(tmp_path / "full.yml"))
+    apply_rules(str(source), str(bids), rules, mapping_path=str(tmp_path / "delta.yml"), delta=True)
+
+    raw = load_rules(str(tmp_path / "delta.yml"))
+    assert all(is_delta(m) for m in raw["Individual"])
+    assert (tmp_path / "delta.yml").stat().st_size < (tmp_path / "full.yml").stat().st_size
+    assert expand_mappings(raw) == full
+    assert compress_mappings(full) == raw
+
+    # Converting between layouts and formats
+    save_mappings(tmp_path / "delta.yml", tmp_path / "delta.jsonl", delta=True)
+    assert load_mappings(tmp_path / "delta.jsonl").to_dict() == expand_mappings(full)
+    save_mappings(tmp_path / "delta.jsonl", tmp_path / "expanded.yml")
+    assert load_rules(str(tmp_path / "expanded.yml")) == full
+
+    result = convert_them(str(tmp_path / "delta.jsonl"))
+    assert len(result["succeeded"]) == 2
+    for mapping in full["Individual"]:
+        assert os.path.isfile(mapping["IO"]["target"])
+
+
+def test_rpc_convert_them_resolves_delta_mappings(vhdr_dataset):
+    from fastapi.testclient import TestClient
+    from sovabids.sovarpc import app
+
+    source, bids = vhdr_dataset(2, bad_file=True)
+    rules = _rules("vhdr", source, bids)
+    full = apply_rules(str(source), str(bids), rules, persist=False)
+    delta = compress_mappings(full)
+    request = json.dumps({
+        "jsonrpc": "2.0",
+        "id": 0,
+        "method": "convert_them",
+        "params": {"general": delta["General"], "individual": delta["Individual"]},
+    })
+    response = TestClient(app).post("/api/sovabids/convert_them", content=request)
+    assert "error" not in response.json()
+    for mapping in full["Individual"]:
+        assert os.path.isfile(mapping["IO"]["target"])
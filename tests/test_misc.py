@@ -1,7 +1,7 @@
 import sys
 import pytest
 from unittest.mock import patch
-from sovabids.misc import handle_unicode_dashes, _UNICODE_DASHES
+from sovabids.misc import handle_unicode_dashes, parse_size, _UNICODE_DASHES
 
 
 @pytest.fixture(autouse=True)
@@ -74,3 +74,14 @@ def test_value_arg_with_dash_in_content():
     sys.argv = ['prog', '--flag', 'file—name']
     handle_unicode_dashes()
     assert sys.argv == ['prog', '--flag', 'file-name']
+
+
+def test_parse_size():
+    assert parse_size(2048) == 2048
+    assert parse_size('100') == 100
+    assert parse_size('512M') == 512 * 2**20
+    assert parse_size('8G') == parse_size('8GB') == parse_size('8gib') == 8 * 2**30
+    assert parse_size('1.5K') == 1536
+    for bad in ('abc', 'G', '-1G'):
+        with pytest.raises(ValueError):
+            parse_size(bad)
@@ -0,0 +1,109 @@
+"""Tests for the parallel (process pool) execution modes."""
+
+import os
+import time
+
+from sovabids.convert import convert_them
+from sovabids.parallel import resolve_jobs, run_isolated, lpt_order
+from sovabids.rules import apply_rules
+
+from .test_formats import _rules
+
+
+def _square_crash_or_hang(x):
+    if x == -1:
+        os._exit(139)  # as if the reader segfaulted
+    if x == -2:
+        time.sleep(60)
+    if x == -3:
+        raise ValueError("bad value")
+    return x * x
+
+
+def test_resolve_jobs():
+    assert resolve_jobs(None) == 1
+    assert resolve_jobs(1) == 1
+    assert resolve_jobs(3) == 3
+    assert resolve_jobs(0) >= 1
+    assert resolve_jobs(-1) >= 1
+
+
+def test_apply_rules_parallel_matches_serial(vhdr_dataset):
+    source, bids = vhdr_dataset(4, bad_file=True)
+    bad = str(source / "99.vhdr")
+    rules = _rules("vhdr", source, bids)
+
+    serial = apply_rules(str(source), str(bids), rules, persist=False)
+    parallel = apply_rules(str(source), str(bids), rules, persist=False, jobs=2)
+
+    assert len(serial["Individual"]) == 4
+    assert parallel["Individual"] == serial["Individual"]
+    sources = [m["IO"]["source"] for m in parallel["Individual"]]
+    assert bad not in sources
+
+
+def test_run_isolated_only_fails_the_broken_task():
+    tasks = [(2,), (-1,), (3,), (-2,), (-3,), (4,)]
+    results = {i: (result, error) for i, result, error in
+               run_isolated(_square_crash_or_hang, tasks, jobs=3, timeout=5)}
+    assert sorted(results) == list(range(len(tasks)))
+    assert results[0] == (4, None)
+    assert results[2] == (9, None)
+    assert results[5] == (16, None)
+    assert "exit code 139" in results[1][1]
+    assert "timed out" in results[3][1]
+    assert "ValueError" in results[4][1]
+
+
+def _timed_sleep(seconds):
+    start = time.monotonic()
+    time.sleep(seconds)
+    return start, time.monotonic()
+
+
+def test_run_isolated_schedules_within_the_memory_budget():
+    # (memory, work) of each task, the work is also how long it sleeps
+    costs = [(1, 0.1), (3, 0.4), (2, 0.3), (1, 0.2), (5, 0.2)]
+    tasks = [(work,) for _, work in costs]
+    assert lpt_order(costs) == [1, 2, 3, 4, 0]
+
+    spans = {i: result for i, result, error in
+             run_isolated(_timed_sleep, tasks, jobs=3, costs=costs, max_memory=4)}
+    assert sorted(spans) == list(range(len(tasks)))
+    # the memory of the tasks running at any time never exceeds the budget,
+    # except for the task that doesn't fit alone, which runs by itself
+    for i, (start, _) in spans.items():
+        running = [k for k, (s, e) in spans.items() if s <= start < e]
+        if i == 4:
+            assert running == [4]
+        else:
+            assert sum(costs[k][0] for k in running) <= 4
+    # the largest task is started first
+    assert min(spans, key=lambda i: spans[i][0]) == 1
+
+
+def test_convert_them_parallel(vhdr_dataset):
+    source, bids = vhdr_dataset(4, bad_file=True)
+    bad = str(source / "99.vhdr")
+    rules = _rules("vhdr", source, bids)
+    mappings = apply_rules(str(source), str(bids), rules, persist=False)
+    good = [m["IO"]["source"] for m in mappings["Individual"]]
+    bad_mapping = dict(mappings["Individual"][0], IO={
+        "source": bad, "target": str(bids / "sub-99" / "eeg" / "sub-99_task-test_eeg.vhdr")})
+    mappings["Individual"].append(bad_mapping)
+
+    result = convert_them(mappings, jobs=2)
+
+    assert result["succeeded"] == good
+    assert result["failed"] == [bad]
+    participants = (bids / "participants.tsv").read_text()
+    for i in range(4):
+        assert f"sub-{i:02d}" in participants
+        assert any(bids.rglob(f"sub-{i:02d}*eeg.eeg"))
+    assert (bids / "dataset_description.json").is_file()
+    assert not (bids / "code" / "sovabids" / "staging").exists()
+
+    # Everything already exists now
+    result = convert_them(mappings, jobs=2, max_memory="4G")
+    assert result["succeeded"] == []
+    assert result["skipped"] == good
@@ -0,0 +1,71 @@
+"""Tests for the fused apply+convert pipeline."""
+
+import threading
+
+import pytest
+
+from sovabids.convert import convert_them
+from sovabids.mappings import load_mappings
+from sovabids.pipeline import _threaded, apply_and_convert
+from sovabids.rules import apply_rules
+
+from .test_formats import _rules
+
+
+def _tree(root):
+    return {p.relative_to(root).as_posix(): p.read_bytes() for p in sorted(root.rglob("*"))
+            if p.is_file() and "code" not in p.relative_to(root).parts and p.name != "dataset_description.json"}
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_apply_and_convert_matches_two_passes(jobs, tmp_path, vhdr_dataset):
+    source, _ = vhdr_dataset(bad_file=True)
+
+    two_passes = tmp_path / "two_passes"
+    two_passes.mkdir()
+    mappings = apply_rules(str(source), str(two_passes), _rules("vhdr", source, two_passes))
+    convert_them(mappings)
+
+    fused = tmp_path / "fused"
+    fused.mkdir()
+    rules = _rules("vhdr", source, fused)
+    result = apply_and_convert(str(source), str(fused), rules, jobs=jobs, queue_size=1)
+
+    assert len(result["succeeded"]) == 3
+    assert result["failed"] == [str(source / "99.vhdr").replace("\\", "/")]
+    assert _tree(fused) == _tree(two_passes)
+    written = load_mappings(str(fused / "code" / "sovabids" / "mappings.yml"))
+    assert [m["IO"]["source"] for m in written] == result["succeeded"]
+    assert all(m["IO"]["target"].startswith(str(fused)) for m in written)
+
+    # Nothing changed, so nothing is opened again
+    again = apply_and_convert(str(source), str(fused), rules, jobs=jobs)
+    assert again["skipped"] == result["succeeded"]
+    assert len(load_mappings(str(fused / "code" / "sovabids" / "mappings.yml"))) == 3
+
+
+def test_threaded_stops_the_producer_when_the_consumer_stops():
+    closed = threading.Event()
+
+    def endless():
+        try:
+            i = 0
+            while True:
+                yield i
+                i += 1
+        finally:
+            closed.set()
+
+    threads = threading.active_count()
+    items = _threaded(endless(), 1)
+    assert next(items) == 0
+    items.close()  # as if the consumer raised
+    assert closed.is_set()
+    assert threading.active_count() == threads
+
+    def failing():
+        yield 1
+        raise ValueError("unreadable folder")
+
+    with pytest.raises(ValueError):
+        list(_threaded(failing(), 1))
@@ -60,7 +60,7 @@ def test_convert_them_expands_per_file_io(tmp_path, monkeypatch):
     monkeypatch.setenv("SOVA_SRC", str(src))
     captured = {}
 
-    def fake_single(input_file, mapping, bids_path, write=False):
+    def fake_single(input_file, mapping, bids_path, write=False, **kwargs):
         captured["input"] = input_file
         captured["bids"] = bids_path
 
@@ -72,4 +72,5 @@ def test_convert_them_expands_per_file_io(tmp_path, monkeypatch):
     sc.convert_them(mappings)
     assert "$" not in captured["input"]                       # per-file IO.source expanded
     assert captured["input"] == str(src / "a.vhdr")
-    assert captured["bids"] == str(out)                       # General target expanded
+    # General target expanded; each file is written to a staging tree below it, then merged into it
+    assert os.path.dirname(captured["bids"]) == str(out / "code" / "sovabids" / "staging")
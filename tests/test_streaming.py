@@ -0,0 +1,172 @@
+"""Tests for the chunked writers used when converting files."""
+
+import os
+
+import mne
+import numpy as np
+import pytest
+
+from sovabids.rules import apply_rules_to_single_file
+
+from .test_formats import _make_raw, _rules, _write_raw
+
+
+def _tree(root):
+    return {p.relative_to(root).as_posix(): p.read_bytes() for p in sorted(root.rglob("*")) if p.is_file()}
+
+
+@pytest.mark.parametrize("ext,output_format", [("fif", "BrainVision"), ("set", "BrainVision"), ("fif", "EDF"), ("fif", "FIF")])
+def test_chunked_conversion_matches_mne_bids(ext, output_format, tmp_path):
+    if ext == "set":
+        pytest.importorskip("eeglabio")
+    if output_format == "EDF":
+        pytest.importorskip("edfio")
+    source = tmp_path / "source"
+    source.mkdir()
+    raw = _make_raw()
+    if output_format == "FIF":  # FIF is only accepted for MEG
+        raw.set_channel_types({ch: "mag" for ch in raw.ch_names})
+    raw.set_annotations(mne.Annotations([0.5, 2.0], [0.0, 1.0], ["a", "b"]))
+    fname = source / f"01.{ext}"
+    _write_raw(raw, fname, ext)
+
+    outputs = {}
+    for chunk_size in (None, 100):
+        bids = tmp_path / f"bids_{chunk_size}"
+        bids.mkdir()
+        rules = _rules(ext, source, bids)
+        rules["non-bids"]["output_format"] = output_format
+        apply_rules_to_single_file(str(fname), rules, str(bids), write=True, chunk_size=chunk_size)
+        outputs[chunk_size] = bids
+
+    if output_format == "FIF":  # the layout of the buffers differs, not the data
+        expected, streamed = (mne.io.read_raw(next(b.rglob("*_meg.fif"))) for b in outputs.values())
+        np.testing.assert_array_equal(expected.get_data(), streamed.get_data())
+        return
+    expected, streamed = _tree(outputs[None]), _tree(outputs[100])
+    assert expected.keys() == streamed.keys()
+    for name in expected:
+        if not name.endswith("dataset_description.json"):  # it has the name of the bids folder
+            assert expected[name] == streamed[name], name
+
+
+def test_streamed_writers_are_restored():
+    import mne_bids.write as mbw
+
+    from sovabids.streaming import streamed_writers
+
+    original = mbw._write_raw_brainvision
+    with streamed_writers(10):
+        with streamed_writers(20):
+            assert mbw._write_raw_brainvision is not original
+        assert mbw._write_raw_brainvision is not original
+    assert mbw._write_raw_brainvision is original
+
+
+def test_missing_private_functions_fall_back_to_mne_bids(tmp_path, monkeypatch):
+    import mne_bids.write as mbw
+    from sovabids import streaming
+
+    source = tmp_path / "source"
+    source.mkdir()
+    fname = source / "01.fif"
+    _write_raw(_make_raw(), fname, "fif")
+    original = mbw._write_raw_brainvision
+    monkeypatch.setattr(streaming, "_BRAINVISION_INTERNALS", {"pybv.io": ("_no_such_function",)})
+    monkeypatch.delattr(mbw, "_write_raw_fif")
+
+    with streaming.streamed_writers(100):
+        assert mbw._write_raw_brainvision is original
+        assert not hasattr(mbw, "_write_raw_fif")
+    bids = tmp_path / "bids"
+    bids.mkdir()
+    rules = _rules("fif", source, bids)
+    rules["non-bids"]["output_format"] = "BrainVision"
+    apply_rules_to_single_file(str(fname), rules, str(bids), write=True, chunk_size=100)
+    assert any(bids.rglob("*_eeg.vhdr"))
+
+
+@pytest.mark.parametrize("ext,dep", [("vhdr", "pybv"), ("edf", "edfio")])
+def test_copy_through_links_the_data(ext, dep, tmp_path):
+    pytest.importorskip(dep)
+    source = tmp_path / "source"
+    source.mkdir()
+    raw = _make_raw()
+    raw.set_annotations(mne.Annotations([0.5, 2.0], [0.0, 1.0], ["a", "b"]))
+    fname = source / f"01.{ext}"
+    _write_raw(raw, fname, ext)
+    payload = source / ("01.eeg" if ext == "vhdr" else f"01.{ext}")
+
+    outputs = {}
+    for copy_mode in (None, "hardlink", "reflink"):
+        bids = tmp_path / f"bids_{copy_mode}"
+        bids.mkdir()
+        rules = _rules(ext, source, bids)
+        rules["non-bids"]["output_format"] = "BrainVision" if ext == "vhdr" else "EDF"
+        rules["channels"] = {"type": {"Cz": "EOG"}}
+        apply_rules_to_single_file(str(fname), rules, str(bids), write=True, copy_mode=copy_mode)
+        outputs[copy_mode] = _tree(bids)
+        data_file = next(bids.rglob(f"*_eeg.{'eeg' if ext == 'vhdr' else ext}"))
+        if copy_mode is not None:
+            assert data_file.read_bytes() == payload.read_bytes()
+        if copy_mode == "hardlink":
+            assert os.path.samefile(data_file, payload)
+            linked = mne.io.read_raw(next(bids.rglob(f"*_eeg.{ext}")))
+            np.testing.assert_allclose(linked.get_data(), mne.io.read_raw(fname).get_data())
+
+    # The sidecars are the ones of the conversion
+    for name, content in outputs[None].items():
+        if name.endswith(("_events.tsv", "_eeg.json", "_scans.tsv")):
+            assert outputs["hardlink"][name] == content, name
+
+    # Renaming channels needs a conversion
+    bids = tmp_path / "bids_renamed"
+    bids.mkdir()
+    rules["channels"] = {"name": {"Cz": "Cpz"}}
+    apply_rules_to_single_file(str(fname), rules, str(bids), write=True, copy_mode="hardlink")
+    data_file = next(bids.rglob(f"*_eeg.{'eeg' if ext == 'vhdr' else ext}"))
+    assert not os.path.samefile(data_file, payload)
+    assert "Cpz" in mne.io.read_raw(next(bids.rglob(f"*_eeg.{ext}"))).ch_names
+
+
+def test_native_int16_is_kept(tmp_path):
+    pytest.importorskip("pybv")
+    source = tmp_path / "source"
+    source.mkdir()
+    fname = _native_source(source)
+    expected = mne.io.read_raw(fname).get_data()
+
+    sizes = {}
+    for native in (True, False):
+        bids = tmp_path / f"bids_{native}"
+        bids.mkdir()
+        rules = _rules("vhdr", source, bids)
+        rules["channels"] = {"name": {"Cz": "Cpz"}}  # not a copy
+        apply_rules_to_single_file(str(fname), rules, str(bids), write=True, chunk_size=100, native_dtype=native)
+        vhdr = next(bids.rglob("*_eeg.vhdr"))
+        assert ("INT_16" in vhdr.read_text(encoding="utf-8")) == native
+        converted = mne.io.read_raw(vhdr).get_data()
+        if native:
+            np.testing.assert_array_equal(converted, expected)
+        sizes[native] = next(bids.rglob("*_eeg.eeg")).stat().st_size
+    assert sizes[True] * 2 == sizes[False]
+
+
+def test_native_falls_back_to_float32(tmp_path):
+    pytest.importorskip("pybv")
+    from sovabids.streaming import write_brainvision
+
+    raw = mne.io.read_raw(_native_source(tmp_path), preload=True)
+    raw._data[0] += 1e-9  # not a whole number of steps anymore
+    write_brainvision(raw, tmp_path / "out.vhdr", chunk_size=100, native=True)
+    assert "IEEE_FLOAT_32" in (tmp_path / "out.vhdr").read_text(encoding="utf-8")
+    np.testing.assert_allclose(mne.io.read_raw(tmp_path / "out.vhdr").get_data(), raw.get_data(), atol=1e-7)
+
+
+def _native_source(folder):
+    import pybv
+
+    raw = _make_raw()
+    pybv.write_brainvision(data=raw.get_data(), sfreq=raw.info["sfreq"], ch_names=raw.ch_names, fname_base="01",
+                           folder_out=str(folder), fmt="binary_int16", resolution=0.5, unit="µV")
+    return folder / "01.vhdr"
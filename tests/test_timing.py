@@ -0,0 +1,71 @@
+"""Tests for the per-stage timers of apply_rules and convert_them."""
+
+import json
+import time
+
+from sovabids.convert import convert_them
+from sovabids.rules import apply_rules
+from sovabids.timing import Span, StageTimer, collect_stages, percentile, record_stages, stage
+
+from .test_formats import _make_raw, _rules, _write_raw
+
+
+def test_percentile():
+    assert percentile([3.0], 95) == 3.0
+    assert percentile([4.0, 1.0, 3.0, 2.0], 0) == 1.0
+    assert percentile([4.0, 1.0, 3.0, 2.0], 50) == 2.5
+    assert percentile([4.0, 1.0, 3.0, 2.0], 100) == 4.0
+
+
+def test_stage_timer_aggregates_the_stages():
+    with stage("outside"):  # nothing is recording
+        pass
+    timer = StageTimer("run")
+    with timer.recording():
+        for _ in range(3):
+            with stage("a"):
+                time.sleep(0.01)
+            timer.add_file(10**6)
+        with collect_stages() as stages:
+            with stage("b", file="x"):
+                pass
+        record_stages([Span("c", time.time(), 0.5, 1, 1, None)])
+    with stage("a"):  # not recording anymore
+        pass
+
+    assert [(span.name, span.args) for span in stages] == [("b", {"file": "x"})]
+    summary = timer.summary()
+    assert summary["files"] == 3
+    assert summary["bytes"] == 3 * 10**6
+    assert summary["files_per_second"] > 0
+    assert summary["mb_per_second"] > 0
+    assert set(summary["stages"]) == {"a", "b", "c"}
+    assert summary["stages"]["a"]["count"] == 3
+    assert summary["stages"]["a"]["p50"] >= 0.01
+    assert summary["stages"]["a"]["p50"] <= summary["stages"]["a"]["p95"] <= summary["stages"]["a"]["max"]
+    assert summary["stages"]["c"]["total"] == 0.5
+
+
+def test_timing_reports(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    bids = tmp_path / "bids"
+    bids.mkdir()
+    raw = _make_raw()
+    for i in range(2):
+        _write_raw(raw, source / f"{i:02d}.vhdr", "vhdr")
+    mappings = apply_rules(str(source), str(bids), _rules("vhdr", source, bids), use_cache=False)
+    report = json.loads((bids / "code" / "sovabids" / "apply_rules_timing.json").read_text())
+    assert report["files"] == 2
+    assert report["stages"]["get_info_from_path"]["count"] == 2
+
+    for jobs in (1, 2):
+        # convert everything again
+        for f in bids.rglob("sub-*_eeg.vhdr"):
+            f.unlink()
+        convert_them(mappings, jobs=jobs)
+        report = json.loads((bids / "code" / "sovabids" / "convert_timing.json").read_text())
+        assert report["files"] == 2
+        assert report["bytes"] > 0
+        for name in ("read_raw", "write_raw_bids", "sidecar_json", "channels_tsv", "merge_bids_tree"):
+            assert report["stages"][name]["count"] == 2
@@ -0,0 +1,78 @@
+"""Tests for the trace-event export of the stages of a run."""
+
+import json
+import os
+
+from sovabids.convert import convert_them
+from sovabids.rules import apply_rules
+from sovabids.timing import stage
+from sovabids.tracing import Tracer, tracing
+
+from .test_formats import _rules
+
+
+def _spans(trace_file):
+    events = json.loads(trace_file.read_text())["traceEvents"]
+    return [e for e in events if e["ph"] == "X"], [e for e in events if e["ph"] == "M"]
+
+
+def test_tracer_writes_complete_events(tmp_path):
+    trace_file = tmp_path / "trace.json"
+    with tracing(None) as tracer:
+        assert tracer is None
+    with tracing(trace_file):
+        with stage("outer", file="a"):
+            with stage("inner"):
+                pass
+    spans, metadata = _spans(trace_file)
+    assert [e["name"] for e in spans] == ["inner", "outer"]
+    inner, outer = spans
+    assert outer["args"] == {"file": "a"}
+    assert outer["ts"] <= inner["ts"] and inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"] + 1
+    assert {e["pid"] for e in spans} == {os.getpid()}
+    assert metadata[0]["args"]["name"] == "sovabids"
+
+
+def test_trace_of_parallel_runs(tmp_path, vhdr_dataset):
+    source, bids = vhdr_dataset()
+    rules = _rules("vhdr", source, bids)
+
+    trace_file = tmp_path / "apply.json"
+    with Tracer(trace_file).recording():
+        mappings = apply_rules(str(source), str(bids), rules, persist=False, jobs=2)
+    spans, _ = _spans(trace_file)
+    assert len([e for e in spans if e["name"] == "map_file"]) == 3
+    assert any(e["pid"] != os.getpid() for e in spans)
+
+    trace_file = tmp_path / "convert.json"
+    with Tracer(trace_file).recording():
+        convert_them(mappings, jobs=2)
+    spans, metadata = _spans(trace_file)
+    files = [e for e in spans if e["name"] == "convert_file"]
+    assert sorted(e["args"]["file"] for e in files) == sorted(m["IO"]["source"] for m in mappings["Individual"])
+    # each file in its own worker, merged by the parent
+    assert len({e["pid"] for e in files}) == 3
+    assert os.getpid() not in {e["pid"] for e in files}
+    assert {e["pid"] for e in spans if e["name"] == "merge_bids_tree"} == {os.getpid()}
+    assert {"read_raw", "write_raw_bids", "sidecar_json", "channels_tsv"} <= {e["name"] for e in spans}
+    assert len(metadata) == 4
+
+
+def test_trace_of_rpc_methods(tmp_path, vhdr_dataset):
+    from fastapi.testclient import TestClient
+    from sovabids.sovarpc import app
+
+    source, bids = vhdr_dataset(1)
+    request = json.dumps({
+        "jsonrpc": "2.0",
+        "id": 0,
+        "method": "get_files",
+        "params": {"path": str(source), "rules": _rules("vhdr", source, bids)},
+    })
+    trace_file = tmp_path / "rpc.json"
+    with tracing(trace_file):
+        response = TestClient(app).post("/api/sovabids/get_files", content=request)
+    assert "error" not in response.json()
+    spans, _ = _spans(trace_file)
+    assert [e["name"] for e in spans] == ["rpc.get_files"]
+    assert isinstance(spans[0]["tid"], int)
@@ -976,3 +976,19 @@ async def test_tui_files_modal(dummy_source):
         await pilot.click("#close-files")
         await pilot.pause()
         assert not isinstance(app.screen, FilesListScreen)
+
+
+@pytest.mark.anyio
+async def test_tui_prune_checkbox_goes_to_rules(dummy_source):
+    from textual.widgets import Checkbox
+    app = SovabidsApp()
+    async with app.run_test(size=(120, 40)) as pilot:
+        app.query_one("TabbedContent").active = "tab-rules"
+        await pilot.pause()
+        rules_pane = app.query_one("RulesPane")
+        rules_pane.query_one("#pattern-input", Input).value = "sub-%subject%_task-%task%_run-%run%.vhdr"
+        await pilot.pause()
+        assert "prune" not in rules_pane.get_rules()["non-bids"]["path_analysis"]
+        rules_pane.query_one("#prune-checkbox", Checkbox).value = True
+        await pilot.pause()
+        assert rules_pane.get_rules()["non-bids"]["path_analysis"]["prune"] is True